@@ -1,23 +1,31 @@
 """
 JoyCaption – local edition with batch-caption support.
-Save this file next to requirements.txt (or overwrite the old app.py),
+Save this file and prompts.json next to requirements.txt (or overwrite the old app.py),
 activate the Conda env, then run:  python app.py
+
+Headless use (no Gradio, model loaded on first caption):
+    python app2.py caption photos/ --jsonl captions.jsonl
+    >>> from app2 import Captioner
+    >>> Captioner(caption_type="Straightforward").caption("cat.jpg")
+
+torch / transformers / gradio are imported lazily so that importing this
+module or running ``--help`` stays fast.
 """
-import os, time, glob, json
+from __future__ import annotations
+
+import argparse, base64, io, os, re, sys, time, uuid, glob, json, hashlib, fnmatch, queue, threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from threading import Thread
-from typing import Generator, List
+from typing import TYPE_CHECKING, Generator, Iterable, Iterator, List
 
-import gradio as gr
-import torch
 from PIL import Image
-from transformers import (
-    LlavaForConditionalGeneration,
-    TextIteratorStreamer,
-    AutoProcessor,
-    AutoConfig,
-)
-from huggingface_hub import hf_hub_download
+
+if TYPE_CHECKING:
+    import torch
 
 
 LOGO_SRC = """data:image/svg+xml;base64,PD94bWwgdmVyc2lvbj0iMS4wIiBlbmNvZGluZz0iVVRGLTgiIHN0YW5kYWxvbmU9Im5vIj8+CjwhRE9DVFlQRSBzdmcgUFVCTElDICItLy9XM0MvL0RURCBTVkcgMS4xLy9FTiIgImh0dHA6Ly93d3cudzMub3JnL0dyYXBoaWNzL1NWRy8xLjEvRFREL3N2ZzExLmR0ZCI+Cjxzdmcgd2lkdGg9IjEwMCUiIGhlaWdodD0iMTAwJSIgdmlld0JveD0iMCAwIDUzOCA1MzUiIHZlcnNpb249IjEuMSIgeG1sbnM9Imh0dHA6Ly93d3cudzMub3JnLzIwMDAvc3ZnIiB4bWxuczp4bGluaz0iaHR0cDovL3d3dy53My5vcmcvMTk5OS94bGluayIgeG1sOnNwYWNlPSJwcmVzZXJ2ZSIgeG1sbnM6c2VyaWY9Imh0dHA6Ly93d3cuc2VyaWYuY29tLyIgc3R5bGU9ImZpbGwtcnVsZTpldmVub2RkO2NsaXAtcnVsZTpldmVub2RkO3N0cm9rZS1saW5lam9pbjpyb3VuZDtzdHJva2UtbWl0ZXJsaW1pdDoyOyI+CiAgICA8ZyB0cmFuc2Zvcm09Im1hdHJpeCgxLDAsMCwxLC0xNDcuODcxLDAuMDAxOTA4NjMpIj4KICAgICAgICA8cGF0aCBkPSJNMTk1LjY3LDIyMS42N0MxOTYuNzMsMjA1LjM3IDIwMC4yOCwxODkuNzYgMjA3LjkxLDE3NS4zN0MyMjcuOTgsMTM3LjUxIDI1OS4zMywxMTQuODggMzAyLjAxLDExMS42M0MzMzQuMTUsMTA5LjE4IDM2Ni41OSwxMTAuNiAzOTguODksMTEwLjNDNDAwLjUzLDExMC4yOCA0MDIuMTYsMTEwLjMgNDA0LjQsMTEwLjNDNDA0LjQsMTAxLjk5IDQwNC41Niw5NC4wNSA0MDQuMjMsODYuMTJDNDA0LjE4LDg0Ljg0IDQwMi4xNSw4My4xMyA0MDAuNjYsODIuNDlDMzgzLjIzLDc1LjAyIDM3My4wNSw1OS43OSAzNzMuOTYsNDAuOTZDMzc1LjA5LDE3LjU0IDM5MS40NywyLjY2IDQxMC42NSwwLjM3QzQzNy44OSwtMi44OSA0NTUuNTYsMTUuODQgNDU5LjI2LDM0LjY5QzQ2Mi45Niw1My41NyA0NTIuMTgsNzYuOTMgNDMyLjgxLDgyLjY2QzQzMS42NCw4My4wMSA0MzAuMzMsODUuMjMgNDMwLjI4LDg2LjYyQzQzMC4wMyw5NC4yNiA0MzAuMTYsMTAxLjkyIDQzMC4xNiwxMTAuM0w0MzUuNjMsMTEwLjNDNDYzLjc5LDExMC4zIDQ5MS45NiwxMTAuMjggNTIwLjEyLDExMC4zQzU3NC44NCwxMTAuMzYgNjIzLjA0LDE0OC4zNSA2MzUuNjcsMjAxLjU1QzYzNy4yMywyMDguMTMgNjM3LjgzLDIxNC45MyA2MzguODksMjIxLjY3QzY2MC40MywyMjQuOTQgNjc1LjE5LDIzNi42MiA2ODIuMzYsMjU3LjRDNjgzLjU5LDI2MC45NyA2ODQuNjUsMjY0LjgyIDY4NC42NywyNjguNTRDNjg0Ljc3LDI4My4zNCA2ODUuNzYsMjk4LjMxIDY4My45NCwzMTIuOTFDNjgwLjg5LDMzNy4yOSA2NjIuODYsMzUzLjM2IDYzOC40NywzNTUuODJDNjM1LjE0LDM4NS4wOCA2MjEuOTEsNDA5LjQxIDYwMC40NSw0MjkuMjFDNTgxLjYsNDQ2LjYxIDU1OS4xNCw0NTcuNSA1MzMuNTcsNDU5LjE4QzUwOC4xOCw0NjAuODQgNDgyLjY0LDQ2MC4yIDQ1Ny4xNiw0NjAuMzhDNDM1LjE2LDQ2MC41MyA0MTMuMTcsNDYwLjM0IDM5MS4xNyw0NjAuNTNDMzg4Ljc2LDQ2MC41NSAzODUuOTUsNDYxLjU2IDM4NC4wMyw0NjMuMDRDMzcxLjU0LDQ3Mi42MiAzNTkuMTMsNDgyLjMxIDM0Ni45Miw0OTIuMjVDMzM4Ljk0LDQ5OC43NSAzMzEuMzksNTA1Ljc3IDMyMy41Niw1MTIuNDZDMzE3LjQ1LDUxNy42OCAzMTAuOTMsNTIyLjQ0IDMwNS4xMSw1MjcuOTVDMzAxLjE5LDUzMS42NiAyOTYuNTIsNTMzLjE3IDI5MS42OSw1MzQuMzZDMjg1LjY1LDUzNS44NSAyNzkuMjIsNTI5LjEzIDI3OS4wMSw1MjEuMTlDMjc4LjgsNTEyLjg2IDI3OC45NSw1MDQuNTMgMjc4Ljk0LDQ5Ni4xOUwyNzguOTQsNDU2LjY5QzIzMi44Miw0MzguMTYgMjAzLjU2LDQwNi4yMyAxOTUuMDcsMzU2LjA4QzE5My4yNiwzNTUuNzUgMTkwLjg0LDM1NS40MSAxODguNDgsMzU0Ljg2QzE2Ny40NiwzNDkuOTEgMTU1LjA0LDMzNi4wMiAxNTAuNzIsMzE1LjYyQzE0Ni45OCwyOTcuOTkgMTQ2LjksMjc5LjY3IDE1MC42MSwyNjIuMDlDMTU1LjU1LDIzOC42OCAxNzEuNDIsMjI1LjU5IDE5NS42NiwyMjEuNjdMMTk1LjY3LDIyMS42N1pNMzA4LjA3LDQ4Ny44MkMzMTUuOTQsNDgxLjEzIDMyMi44NSw0NzUuMTMgMzI5LjksNDY5LjNDMzQ0LjM5LDQ1Ny4zMSAzNTguOSw0NDUuMzYgMzczLjU0LDQzMy41NkMzNzUuMTcsNDMyLjI1IDM3Ny42OCw0MzEuNCAzNzkuNzksNDMxLjM5QzQxNC43OCw0MzEuMjYgNDQ5Ljc4LDQzMS4zOCA0ODQuNzcsNDMxLjI0QzUwMC4zOSw0MzEuMTggNTE2LjEzLDQzMS43NiA1MzEuNjIsNDMwLjE2QzU3Ni45Miw0MjUuNDkgNjA5LjI0LDM4Ny43NyA2MDguOTUsMzQ0Ljg0QzYwOC42OCwzMDUuNTIgNjA4LjkzLDI2Ni4xOSA2MDguODcsMjI2Ljg2QzYwOC44NywyMjMuMjIgNjA4LjU4LDIxOS41NSA2MDcuOTksMjE1Ljk2QzYwMy4xMSwxODYuMjkgNTg4LjYxLDE2My4zMyA1NjEuMzIsMTQ5LjMyQzU0OS4wNCwxNDMuMDIgNTM2LjE1LDEzOS4yOSA1MjIuMjIsMTM5LjI5QzQ1My45LDEzOS4zMiAzODUuNTgsMTM5LjIgMzE3LjI2LDEzOS4zNUMzMDkuMiwxMzkuMzcgMzAwLjk2LDEzOS44OSAyOTMuMTEsMTQxLjZDMjU0LjE5LDE1MC4wNyAyMjUuMzMsMTg1LjY5IDIyNS4wMywyMjUuNDJDMjI0LjgsMjU2LjA4IDIyNC44NiwyODYuNzQgMjI0Ljk5LDMxNy40QzIyNS4wNSwzMzAuNTMgMjI0Ljc0LDM0My43NiAyMjYuMTgsMzU2Ljc3QzIyOC43NCwzODAuMDUgMjQwLjYsMzk4LjYyIDI1OC43OSw0MTIuOTNDMjczLjA0LDQyNC4xNCAyODkuNjMsNDMwLjAyIDMwNy42MSw0MzEuNTVDMzA3LjgyLDQzMi4wMyAzMDguMDYsNDMyLjMzIDMwOC4wNiw0MzIuNjNDMzA4LjA4LDQ1MC42IDMwOC4wOCw0NjguNTcgMzA4LjA4LDQ4Ny44MUwzMDguMDcsNDg3LjgyWk00MzUuNzksNDMuMzNDNDM1Ljk1LDMzLjQyIDQyNy42MSwyNC42NSA0MTcuOCwyNC40QzQwNi43NiwyNC4xMiAzOTguMjUsMzIuMDUgMzk4LjEzLDQyLjc0QzM5OC4wMSw1My4wNCA0MDYuNiw2Mi4xMiA0MTYuNDIsNjIuMDhDNDI3LjExLDYyLjA0IDQzNS42MSw1My44MSA0MzUuNzgsNDMuMzNMNDM1Ljc5LDQzLjMzWiIgc3R5bGU9ImZpbGw6cmdiKDczLDQ3LDExOCk7ZmlsbC1ydWxlOm5vbnplcm87Ii8+CiAgICAgICAgPHBhdGggZD0iTTQxOS4zLDM5MS42M0MzNzQuNDYsMzkwLjQgMzQxLjUxLDM3Mi42MyAzMTguMDEsMzM3LjcxQzMxNS42NywzMzQuMjMgMzEzLjc3LDMzMC4wNCAzMTMuMSwzMjUuOTVDMzExLjg0LDMxOC4yOCAzMTYuNTMsMzExLjcgMzIzLjcyLDMwOS40NkMzMzAuNjYsMzA3LjI5IDMzOC4zMiwzMTAuMSAzNDEuOTgsMzE3LjAzQzM0OS4xNSwzMzAuNjMgMzU5LjE2LDM0MS4zNSAzNzIuMywzNDkuMzFDNDAxLjMyLDM2Ni44OSA0NDQuNTYsMzYzLjcgNDcwLjYxLDM0Mi4zNUM0NzkuMSwzMzUuMzkgNDg2LjA4LDMyNy40MSA0OTEuNTUsMzE3Ljk3QzQ5NS4wNSwzMTEuOTMgNTAwLjIsMzA4LjE4IDUwNy40NywzMDguOTVDNTEzLjczLDMwOS42MSA1MTguODYsMzEyLjg4IDUyMC4xMiwzMTkuMjFDNTIwLjksMzIzLjEzIDUyMC43MywzMjguMjIgNTE4LjgzLDMzMS41NUM1MDAuNjMsMzYzLjMyIDQ3My41NSwzODIuOTUgNDM3LjI5LDM4OS4zN0M0MzAuNDQsMzkwLjU4IDQyMy40OCwzOTEuMTIgNDE5LjI5LDM5MS42M0w0MTkuMywzOTEuNjNaIiBzdHlsZT0iZmlsbDpyZ2IoMjUwLDEzOSwxKTtmaWxsLXJ1bGU6bm9uemVybzsiLz4KICAgICAgICA8cGF0aCBkPSJNNDYyLjcxLDI0MC4xOUM0NjIuOCwyMTYuOTEgNDgwLjI0LDE5OS43OSA1MDQuMDEsMTk5LjY3QzUyNi41NywxOTkuNTUgNTQ0Ljg5LDIxOC4wNyA1NDQuNTEsMjQxLjM0QzU0NC4xOCwyNjEuODUgNTMwLjA5LDI4MS45NiA1MDEuOTEsMjgxLjIzQzQ4MC42OCwyODAuNjggNDYyLjE1LDI2My44IDQ2Mi43MSwyNDAuMkw0NjIuNzEsMjQwLjE5WiIgc3R5bGU9ImZpbGw6cmdiKDI1MCwxMzksMSk7ZmlsbC1ydWxlOm5vbnplcm87Ii8+CiAgICAgICAgPHBhdGggZD0iTTM3MC45OSwyNDAuMDhDMzcxLDI2Mi43OSAzNTIuNTMsMjgxLjM1IDMyOS44OSwyODEuMzdDMzA3LjA1LDI4MS40IDI4OC45NiwyNjMuNDIgMjg4Ljk2LDI0MC42OEMyODguOTYsMjE4LjE0IDMwNi43MywyMDAgMzI5LjE2LDE5OS42MkMzNTIuMDIsMTk5LjI0IDM3MC45OCwyMTcuNTcgMzcwLjk5LDI0MC4wOFoiIHN0eWxlPSJmaWxsOnJnYigyNTAsMTM5LDEpO2ZpbGwtcnVsZTpub256ZXJvOyIvPgogICAgPC9nPgo8L3N2Zz4K"""
@@ -118,85 +126,19 @@ public and free to use outside of this space.  And, of course, I have no control
 </div>
 """
 
-CAPTION_TYPE_MAP = {
-	"Descriptive": [
-		"Write a detailed description for this image.",
-		"Write a detailed description for this image in {word_count} words or less.",
-		"Write a {length} detailed description for this image.",
-	],
-	"Descriptive (Casual)": [
-		"Write a descriptive caption for this image in a casual tone.",
-		"Write a descriptive caption for this image in a casual tone within {word_count} words.",
-		"Write a {length} descriptive caption for this image in a casual tone.",
-	],
-	"Straightforward": [
-		"Write a straightforward caption for this image. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-		"Write a straightforward caption for this image within {word_count} words. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-		"Write a {length} straightforward caption for this image. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-	],
-	"Stable Diffusion Prompt": [
-		"Output a stable diffusion prompt that is indistinguishable from a real stable diffusion prompt.",
-		"Output a stable diffusion prompt that is indistinguishable from a real stable diffusion prompt. {word_count} words or less.",
-		"Output a {length} stable diffusion prompt that is indistinguishable from a real stable diffusion prompt.",
-	],
-	"MidJourney": [
-		"Write a MidJourney prompt for this image.",
-		"Write a MidJourney prompt for this image within {word_count} words.",
-		"Write a {length} MidJourney prompt for this image.",
-	],
-	"Danbooru tag list": [
-		"Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text.",
-		"Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text. {word_count} words or less.",
-		"Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text. {length} length.",
-	],
-	"e621 tag list": [
-		"Write a comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags.",
-		"Write a comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags. Keep it under {word_count} words.",
-		"Write a {length} comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags.",
-	],
-	"Rule34 tag list": [
-		"Write a comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags.",
-		"Write a comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags. Keep it under {word_count} words.",
-		"Write a {length} comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags.",
-	],
-	"Booru-like tag list": [
-		"Write a list of Booru-like tags for this image.",
-		"Write a list of Booru-like tags for this image within {word_count} words.",
-		"Write a {length} list of Booru-like tags for this image.",
-	],
-	"Art Critic": [
-		"Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc.",
-		"Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc. Keep it within {word_count} words.",
-		"Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc. Keep it {length}.",
-	],
-	"Product Listing": [
-		"Write a caption for this image as though it were a product listing.",
-		"Write a caption for this image as though it were a product listing. Keep it under {word_count} words.",
-		"Write a {length} caption for this image as though it were a product listing.",
-	],
-	"Social Media Post": [
-		"Write a caption for this image as if it were being used for a social media post.",
-		"Write a caption for this image as if it were being used for a social media post. Limit the caption to {word_count} words.",
-		"Write a {length} caption for this image as if it were being used for a social media post.",
-	],
-}
-NAME_OPTION = "If there is a person/character in the image you must refer to them as {name}."
-
-
-
-
-
 # ───────────────────────────── Config ───────────────────────────── #
 MODEL_REPO = "fancyfeast/llama-joycaption-beta-one-hf-llava"
 E621_TAGS_REPO = "fancyfeast/joycaption-assets"
 E621_TAGS_FILE = "e621_master_tag_list.json"    # inside the HF repo above
 CACHE_DIR = Path.home() / ".cache" / "joycaption"
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tiff"}
 
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 # ─────────────────────────── Utilities ──────────────────────────── #
 def ensure_asset(repo: str, filename: str) -> Path:
     """Download <repo>/<filename> to the HF cache the first time it is needed."""
+    from huggingface_hub import hf_hub_download
     return Path(hf_hub_download(repo_id=repo, filename=filename, cache_dir=CACHE_DIR))
 
 def seconds_to_hms(sec: float) -> str:
@@ -204,87 +146,667 @@ def seconds_to_hms(sec: float) -> str:
     h, m = divmod(m, 60)
     return f"{h:02d}:{m:02d}:{s:02d}"
 
+class LRUCache:
+    """Tiny thread-safe LRU mapping for the in-process caches below."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Metrics:
+    """
+    Minimal Prometheus-style registry (counters + histograms, text
+    exposition via render()) with optional JSON-lines event logging.
+    Every hook returns immediately while disabled, so instrumentation can
+    stay on the hot path.
+    """
+    # Seconds; covers per-token decode (ms) up to whole batches (minutes)
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float("inf"))
+    RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+    def __init__(self):
+        self.enabled = False
+        self.log_stream = None  # file object for log_event() JSON lines
+        self._counters: dict[tuple, float] = {}
+        self._hists: dict[tuple, list] = {}  # key -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name,) + tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [[0] * len(buckets), 0.0, 0, buckets]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def log_event(self, event: str, **fields):
+        """One structured JSON line per caption / request (when --log-json is set)."""
+        if self.log_stream is None:
+            return
+        line = json.dumps({"ts": time.time(), "event": event, **fields},
+                          ensure_ascii=False, default=str)
+        with self._lock:
+            self.log_stream.write(line + "\n")
+            self.log_stream.flush()
+
+    def render(self) -> str:
+        """Prometheus text exposition format (for GET /metrics)."""
+        def fmt(name, labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra)]
+            return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+        out, typed = [], set()
+        with self._lock:
+            for (name, *labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f"# TYPE {name} counter")
+                out.append(f"{fmt(name, labels)} {value:g}")
+            for (name, *labels), (counts, total, n, buckets) in sorted(self._hists.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f"# TYPE {name} histogram")
+                running = 0
+                for bound, c in zip(buckets, counts):
+                    running += c
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    out.append(f"{fmt(name + '_bucket', labels, [('le', le)])} {running}")
+                out.append(f"{fmt(name + '_sum', labels)} {total:g}")
+                out.append(f"{fmt(name + '_count', labels)} {n}")
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+
+def build_tiny_model(out_dir: Path) -> Path:
+    """
+    Save a randomly initialised, few-MB Llava (SigLIP + Llama) with a byte-level
+    tokenizer to <out_dir>.  It mimics the JoyCaption chat template and image
+    token so every inference path can be exercised on CPU without downloads.
+    """
+    if (out_dir / "config.json").exists():
+        return out_dir
+
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import (
+        LlamaConfig,
+        LlavaConfig,
+        LlavaForConditionalGeneration,
+        LlavaProcessor,
+        PreTrainedTokenizerFast,
+        SiglipImageProcessor,
+        SiglipVisionConfig,
+    )
+
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    backend = Tokenizer(models.BPE(vocab={c: i for i, c in enumerate(alphabet)}, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|eot_id|>",
+        pad_token="<|finetune_right_pad_id|>",
+        additional_special_tokens=["<|start_header_id|>", "<|end_header_id|>", "<image>"],
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    chat_template = (
+        "{{ bos_token }}{% for m in messages %}"
+        "<|start_header_id|>{{ m['role'] }}<|end_header_id|>\n\n"
+        "{% if m['role'] == 'user' and loop.index0 == 1 %}<image>{% endif %}"
+        "{{ m['content'] }}<|eot_id|>{% endfor %}"
+        "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+    )
+    tiny_processor = LlavaProcessor(
+        image_processor=SiglipImageProcessor(size={"height": 32, "width": 32}),
+        tokenizer=tokenizer,
+        patch_size=8,
+        vision_feature_select_strategy="full",
+        chat_template=chat_template,
+        image_token="<image>",
+        num_additional_image_tokens=0,
+    )
+    config = LlavaConfig(
+        vision_config=SiglipVisionConfig(
+            hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+            num_attention_heads=2, image_size=32, patch_size=8,
+        ),
+        text_config=LlamaConfig(
+            vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128,
+            num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+            max_position_embeddings=4096,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        ),
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+        vision_feature_select_strategy="full",
+        vision_feature_layer=-1,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(0)
+    tiny_processor.save_pretrained(out_dir)
+    LlavaForConditionalGeneration(config).save_pretrained(out_dir)
+    return out_dir
+
 # ──────────────────────── Model & processor ─────────────────────── #
-processor = AutoProcessor.from_pretrained(MODEL_REPO, cache_dir=CACHE_DIR)
-model = LlavaForConditionalGeneration.from_pretrained(
-    MODEL_REPO,
-    torch_dtype="bfloat16",
-    device_map=0,
-    cache_dir=CACHE_DIR,
-)
-model.eval()
-try:
-    from liger_kernel.transformers import apply_liger_kernel_to_llama
-    apply_liger_kernel_to_llama(model.language_model)
-except ModuleNotFoundError:
-    print("⚠  liger-kernel not found – running without fused kernels.")
+# Populated by load_model() on first use, never at import time
+processor = None
+model = None
+# Whether load_model() without arguments picks the tiny stand-in; batch
+# worker processes inherit this so they load the same model as the parent.
+model_tiny = False
+# Memory/speed trade-off used by load_model() (see _load_kwargs), plus
+# optional torch.compile of the language model; inherited by workers too.
+LOAD_PROFILES = ("bf16", "int8", "int4", "offload", "cpu")
+load_profile = "bf16"
+compile_model = False
+gpu_memory_gb: float | None = None  # GPU budget for the "offload" profile
+# Checkpoint loaded for the real (non-tiny) model: --model, or ModelManager.swap()
+model_repo = MODEL_REPO
+
+
+def model_id() -> str:
+    """Repo id / local dir of the model load_model() (has or would have) loaded."""
+    return str(CACHE_DIR / "tiny-llava") if model_tiny else model_repo
+
+
+def _load_kwargs(profile: str, device: str | None) -> dict:
+    """from_pretrained() arguments for a LOAD_PROFILES entry."""
+    import torch
+    if profile not in LOAD_PROFILES:
+        raise ValueError(f"unknown load profile {profile!r}; expected one of {LOAD_PROFILES}")
+    if profile == "cpu":
+        return {"torch_dtype": torch.bfloat16, "device_map": {"": "cpu"}}
+    gpu = device or "cuda:0"
+    kwargs = {"torch_dtype": torch.bfloat16, "device_map": {"": gpu}}
+    if profile in ("int8", "int4"):
+        # Weight-only quantisation of the LLM; the small vision tower,
+        # projector and lm_head stay in bf16 for caption quality.
+        import importlib.util
+        if importlib.util.find_spec("bitsandbytes") is None:
+            raise ModuleNotFoundError(f"the {profile} profile needs bitsandbytes "
+                                      "(pip install bitsandbytes)")
+        from transformers import BitsAndBytesConfig
+        keep = ["vision_tower", "multi_modal_projector", "lm_head"]
+        kwargs["quantization_config"] = (
+            BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=keep)
+            if profile == "int8" else
+            BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4",
+                               bnb_4bit_compute_dtype=torch.bfloat16,
+                               bnb_4bit_use_double_quant=True, llm_int8_skip_modules=keep)
+        )
+    elif profile == "offload":
+        # Layers beyond the GPU budget live in CPU RAM and are streamed in
+        # per forward pass (accelerate hooks): slow, but fits small cards.
+        index = torch.device(gpu).index or 0
+        budget = gpu_memory_gb or torch.cuda.mem_get_info(index)[0] / 2**30 * 0.9
+        kwargs["device_map"] = "auto"
+        kwargs["max_memory"] = {index: f"{budget:.1f}GiB", "cpu": "1024GiB"}
+        kwargs["offload_folder"] = str(CACHE_DIR / "offload")
+    return kwargs
+
+
+def load_model(tiny: bool | None = None, device: str | None = None,
+               profile: str | None = None):
+    """
+    Load the processor + model into the module globals (no-op once loaded).
+    tiny=True loads the random stand-in from build_tiny_model() on CPU, for
+    benchmarks and smoke tests without the real weights or a GPU.
+    <device> ("cuda:1", "cpu", …) overrides the default placement (GPU 0).
+    <profile> picks one of LOAD_PROFILES (default: load_profile).
+    Waits for a load already in progress (see ModelManager).
+    """
+    return model_manager.load(tiny, device, profile)
+
+
+def _effective_profile(device: str | None, profile: str) -> str:
+    """The load profile _load_checkpoint really uses for <profile> on <device>."""
+    if model_tiny:
+        return "tiny"
+    return "cpu" if device == "cpu" else profile
+
+
+def _load_checkpoint(device: str | None, timings: dict, profile: str) -> tuple:
+    """
+    from_pretrained() + kernels/compile for model_id() with load <profile>;
+    seconds per phase go to <timings>.  Returns (processor, model, profile
+    actually used): "tiny" for the stand-in, "cpu" whenever <device> is the CPU.
+    """
+    t_import = time.perf_counter()
+    import torch
+    from transformers import AutoProcessor, LlavaForConditionalGeneration
+
+    t0 = time.perf_counter()
+    timings["imports"] = t0 - t_import
+    profile = _effective_profile(device, profile)
+    if model_tiny:
+        tiny_dir = build_tiny_model(CACHE_DIR / "tiny-llava")
+        new_processor = AutoProcessor.from_pretrained(tiny_dir)
+        t1 = time.perf_counter()
+        new_model = LlavaForConditionalGeneration.from_pretrained(
+            tiny_dir, torch_dtype=torch.float32
+        ).to(device or "cpu")
+    else:
+        new_processor = AutoProcessor.from_pretrained(model_repo, cache_dir=CACHE_DIR)
+        t1 = time.perf_counter()
+        new_model = LlavaForConditionalGeneration.from_pretrained(
+            model_repo, cache_dir=CACHE_DIR, **_load_kwargs(profile, device),
+        )
+    new_model.eval()
+    t2 = time.perf_counter()
+    timings.update(processor=t1 - t0, weights=t2 - t1)
+    if new_model.device.type == "cuda":  # Triton kernels: GPU only
+        try:
+            from liger_kernel.transformers import apply_liger_kernel_to_llama
+            apply_liger_kernel_to_llama(new_model.language_model)
+        except ModuleNotFoundError:
+            print("⚠  liger-kernel not found – running without fused kernels.", file=sys.stderr)
+        timings["kernels"] = time.perf_counter() - t2
+    if compile_model:
+        # dynamic=True: batch size and sequence length change every call
+        new_model.language_model.forward = torch.compile(new_model.language_model.forward,
+                                                         dynamic=True)
+
+    # Batched generate() needs prompts right-aligned so new tokens line up
+    new_processor.tokenizer.padding_side = "left"
+    if new_processor.tokenizer.pad_token is None:
+        new_processor.tokenizer.pad_token = new_processor.tokenizer.eos_token
+    return new_processor, new_model, profile
+
+
+def _warmup():
+    """
+    One short greedy caption of a synthetic image, so kernel selection,
+    torch.compile and allocator growth happen before the first request.
+    """
+    img = Image.effect_noise((64, 64), 64).convert("RGB")
+    _caption_batch([img], [build_prompt("Descriptive", "short", [], "")], 0.0, 0.9, 4)
+
+
+class ModelManager:
+    """
+    Lifecycle of the module-level processor/model.  load() loads on first
+    use, waiting for a background start() rather than racing it; swap()
+    switches to another checkpoint and unload() frees the model once no
+    in_use() section is running.  With an idle timeout the model is
+    unloaded after that long without requests and reloaded by the next.
+    status() reports the state ("unloaded", "loading", "warming", "ready",
+    "unloading", "failed") and the seconds each load phase took.
+    <profile> is the load profile of the loaded model (None when unloaded);
+    a profile passed to load() is kept for later reloads without touching
+    the load_profile default.  <generation> counts loads, so work prepared
+    for one model (preprocessed pixels, cache keys) can tell it is stale.
+    """
+    BUSY = ("loading", "warming", "unloading")
+
+    def __init__(self):
+        self.state = "unloaded"
+        self.error: str | None = None
+        self.timings: dict[str, float] = {}
+        self.profile: str | None = None
+        self.generation = 0
+        self._requested_profile: str | None = None
+        self.idle_timeout = 0.0
+        self.last_used = time.monotonic()
+        self._users = 0
+        self._cond = threading.Condition()
+        self._watchdog: Thread | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def status(self) -> dict:
+        with self._cond:
+            return {"state": self.state, "model": model_id(), "profile": self.profile,
+                    "error": self.error,
+                    "in_use": self._users,
+                    "idle_s": round(time.monotonic() - self.last_used, 1),
+                    "idle_unload_s": self.idle_timeout or None,
+                    "load_seconds": {k: round(v, 3) for k, v in self.timings.items()}}
+
+    def load(self, tiny: bool | None = None, device: str | None = None,
+             profile: str | None = None, warmup: bool = False):
+        global model_tiny
+        with self._cond:
+            self.last_used = time.monotonic()
+            while self.state in self.BUSY:
+                self._cond.wait()
+            if self.state == "ready":
+                return processor, model
+            self.state, self.error = "loading", None
+            if tiny is not None:
+                model_tiny = tiny
+            if profile is not None:
+                self._requested_profile = profile
+        self._load(device, warmup)
+        return processor, model
+
+    def start(self, tiny: bool | None = None, device: str | None = None,
+              profile: str | None = None, warmup: bool = True) -> Thread:
+        """load() (plus warm-up) in a background thread, e.g. while the web server starts."""
+        def run():
+            try:
+                self.load(tiny, device, profile, warmup)
+            except Exception:
+                pass  # kept in status(); the next load() retries
+        thread = Thread(target=run, daemon=True, name="joycaption-loader")
+        thread.start()
+        return thread
+
+    def _load(self, device: str | None, warmup: bool):
+        """Load model_id() with the state already claimed as "loading"."""
+        global processor, model
+        timings: dict[str, float] = {}
+        start = time.perf_counter()
+        try:
+            processor, model, profile = _load_checkpoint(
+                device, timings, self._requested_profile or load_profile)
+            _prompt_ids_cache.clear()
+            _prompt_tensor_cache.clear()
+            _prefix_kv_cache.clear()
+            _pixel_cache.clear()
+            t0 = time.perf_counter()
+            _precompute_prompt_ids()
+            timings["prompts"] = time.perf_counter() - t0
+            if warmup:
+                with self._cond:
+                    self.state = "warming"
+                t0 = time.perf_counter()
+                _warmup()
+                timings["warmup"] = time.perf_counter() - t0
+        except BaseException as e:
+            processor = model = None
+            with self._cond:
+                self.state, self.error = "failed", f"{type(e).__name__}: {e}"
+                self._cond.notify_all()
+            print(f"❌ Loading {model_id()} failed: {self.error}", file=sys.stderr)
+            raise
+        total = time.perf_counter() - start
+        with self._cond:
+            self.state, self.timings = "ready", dict(timings, total=total)
+            self.profile = profile
+            self.generation += 1
+            self.last_used = time.monotonic()
+            self._cond.notify_all()
+        for phase, seconds in timings.items():
+            metrics.observe("joycaption_model_load_seconds", seconds, phase=phase)
+        metrics.log_event("model_load", model=model_id(), **self.status()["load_seconds"])
+        print(f"✅ Loaded {model_id()} in {total:.1f}s ("
+              + " · ".join(f"{k} {v:.1f}s" for k, v in timings.items()) + ")", file=sys.stderr)
+
+    def _claim(self, state: str) -> str:
+        """Wait out other loads and every in_use() section, then enter <state>; returns the old state."""
+        with self._cond:
+            while self.state in self.BUSY:
+                self._cond.wait()
+            previous, self.state = self.state, state
+            while self._users:  # no new users once the state is not "ready"
+                self._cond.wait()
+            return previous
+
+    def _free(self):
+        global processor, model
+        import gc
+        processor = model = None
+        self.profile = None
+        _prompt_ids_base.clear()
+        _prompt_ids_cache.clear()
+        _prompt_tensor_cache.clear()
+        _prefix_kv_cache.clear()
+        _pixel_cache.clear()
+        gc.collect()
+        if "torch" in sys.modules and sys.modules["torch"].cuda.is_available():
+            sys.modules["torch"].cuda.empty_cache()
+
+    def unload(self, reason: str = "request"):
+        """Free the model (after in-flight work); the next load() brings it back."""
+        previous = self._claim("unloading")
+        if previous == "ready":
+            name = model_id()
+            self._free()
+            print(f"✅ Unloaded {name} ({reason}).", file=sys.stderr)
+            metrics.log_event("model_unload", model=name, reason=reason)
+        with self._cond:
+            if previous == "ready":
+                self.state, self.timings = "unloaded", {}
+            else:
+                self.state = previous
+            self._cond.notify_all()
+
+    def swap(self, repo: str, tiny: bool = False, warmup: bool = True,
+             background: bool = False):
+        """
+        Switch to another checkpoint (repo id or local folder; tiny=True for
+        the stand-in) without restarting.  Waits for in-flight work; if the
+        new one fails to load, the next load() goes back to the old one.
+        """
+        global model_repo, model_tiny
+        if background:
+            def run():
+                try:
+                    self.swap(repo, tiny, warmup)
+                except Exception:
+                    pass  # kept in status()
+            Thread(target=run, daemon=True, name="joycaption-swap").start()
+            return
+        previous = self._claim("unloading")
+        old = model_repo, model_tiny
+        if previous == "ready":
+            self._free()
+        with self._cond:
+            model_repo, model_tiny = repo, tiny
+            self.state, self.error = "loading", None
+        try:
+            self._load(None, warmup)
+        except BaseException:
+            model_repo, model_tiny = old
+            raise
+
+    @contextmanager
+    def in_use(self):
+        """
+        Wraps generation: loads the model if needed and keeps swap(),
+        unload() and the idle timeout from pulling it away meanwhile.
+        Must not call load() inside (it would wait for itself).
+        """
+        while True:
+            self.load()
+            with self._cond:
+                if self.state == "ready":
+                    self._users += 1
+                    break
+        try:
+            yield model
+        finally:
+            with self._cond:
+                self._users -= 1
+                self.last_used = time.monotonic()
+                self._cond.notify_all()
+
+    def set_idle_timeout(self, seconds: float):
+        """Unload after <seconds> without requests (0 = never)."""
+        self.idle_timeout = max(0.0, float(seconds))
+        if self.idle_timeout and self._watchdog is None:
+            self._watchdog = Thread(target=self._watch_idle, daemon=True, name="joycaption-idle")
+            self._watchdog.start()
+
+    def _watch_idle(self):
+        while True:
+            time.sleep(min(30.0, max(0.5, self.idle_timeout / 4)))
+            with self._cond:
+                idle = (self.idle_timeout and self.state == "ready" and not self._users
+                        and time.monotonic() - self.last_used > self.idle_timeout)
+            if idle and (scheduler is None or not scheduler.stats()["queue_depth"]):
+                self.unload(reason="idle")
+
+
+model_manager = ModelManager()
 
 # ───────────────────────── Prompt helpers ───────────────────────── #
 
-CAPTION_TYPE_MAP = {
-    "Descriptive": [
-        "Write a detailed description for this image.",
-        "Write a detailed description for this image in {word_count} words or less.",
-        "Write a {length} detailed description for this image.",
-    ],
-    "Descriptive (Casual)": [
-        "Write a descriptive caption for this image in a casual tone.",
-        "Write a descriptive caption for this image in a casual tone within {word_count} words.",
-        "Write a {length} descriptive caption for this image in a casual tone.",
-    ],
-    "Straightforward": [
-        "Write a straightforward caption for this image. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-        "Write a straightforward caption for this image within {word_count} words. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-        "Write a {length} straightforward caption for this image. Begin with the main subject and medium. Mention pivotal elements—people, objects, scenery—using confident, definite language. Focus on concrete details like color, shape, texture, and spatial relationships. Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. Note any watermarks, signatures, or compression artifacts. Never mention what's absent, resolution, or unobservable details. Vary your sentence structure and keep the description concise, without starting with “This image is…” or similar phrasing.",
-    ],
-    "Stable Diffusion Prompt": [
-        "Output a stable diffusion prompt that is indistinguishable from a real stable diffusion prompt.",
-        "Output a stable diffusion prompt that is indistinguishable from a real stable diffusion prompt. {word_count} words or less.",
-        "Output a {length} stable diffusion prompt that is indistinguishable from a real stable diffusion prompt.",
-    ],
-    "MidJourney": [
-        "Write a MidJourney prompt for this image.",
-        "Write a MidJourney prompt for this image within {word_count} words.",
-        "Write a {length} MidJourney prompt for this image.",
-    ],
-    "Danbooru tag list": [
-        "Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text.",
-        "Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text. {word_count} words or less.",
-        "Generate only comma-separated Danbooru tags (lowercase_underscores). Strict order: `artist:`, `copyright:`, `character:`, `meta:`, then general tags. Include counts (1girl), appearance, clothing, accessories, pose, expression, actions, background. Use precise Danbooru syntax. No extra text. {length} length.",
-    ],
-    "e621 tag list": [
-        "Write a comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags.",
-        "Write a comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags. Keep it under {word_count} words.",
-        "Write a {length} comma-separated list of e621 tags in alphabetical order for this image. Start with the artist, copyright, character, species, meta, and lore tags (if any), prefixed by 'artist:', 'copyright:', 'character:', 'species:', 'meta:', and 'lore:'. Then all the general tags.",
-    ],
-    "Rule34 tag list": [
-        "Write a comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags.",
-        "Write a comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags. Keep it under {word_count} words.",
-        "Write a {length} comma-separated list of rule34 tags in alphabetical order for this image. Start with the artist, copyright, character, and meta tags (if any), prefixed by 'artist:', 'copyright:', 'character:', and 'meta:'. Then all the general tags.",
-    ],
-    "Booru-like tag list": [
-        "Write a list of Booru-like tags for this image.",
-        "Write a list of Booru-like tags for this image within {word_count} words.",
-        "Write a {length} list of Booru-like tags for this image.",
-    ],
-    "Art Critic": [
-        "Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc.",
-        "Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc. Keep it within {word_count} words.",
-        "Analyze this image like an art critic would with information about its composition, style, symbolism, the use of color, light, any artistic movement it might belong to, etc. Keep it {length}.",
-    ],
-    "Product Listing": [
-        "Write a caption for this image as though it were a product listing.",
-        "Write a caption for this image as though it were a product listing. Keep it under {word_count} words.",
-        "Write a {length} caption for this image as though it were a product listing.",
-    ],
-    "Social Media Post": [
-        "Write a caption for this image as if it were being used for a social media post.",
-        "Write a caption for this image as if it were being used for a social media post. Limit the caption to {word_count} words.",
-        "Write a {length} caption for this image as if it were being used for a social media post.",
-    ],
-}
-
-NAME_OPTION = "If there is a person/character in the image you must refer to them as {name}."
+# Caption types and extra options live in prompts.json next to this file.
+# Files listed in $JOYCAPTION_PROMPTS (os.pathsep-separated) are merged on
+# top: caption types with the same name are replaced, extra options appended.
+PROMPTS_FILE = Path(__file__).with_name("prompts.json")
+PROMPT_TEMPLATE_KEYS = ("any", "word_count", "length")  # by caption length, see PromptRegistry.prompt
+
+
+class PromptRegistry:
+    """
+    Caption types and extra options, validated once on load.  prompt()
+    replaces build_prompt's per-call template formatting: every caption type
+    × CAPTION_LENGTH_CHOICES prompt without extras is built up front, the
+    rest are memoised on first use.
+    """
+
+    def __init__(self, *paths: str | Path):
+        self.caption_types: dict[str, tuple[str, str, str]] = {}
+        self.tag_types: dict[str, bool] = {}  # caption type -> tags use namespaces
+        self.extra_options: List[str] = []
+        self.name_option = ""
+        self.sources: List[str] = []
+        for n, path in enumerate(paths):
+            try:
+                self._merge(json.loads(Path(path).read_text(encoding="utf-8")), str(path))
+            except (OSError, ValueError) as e:
+                if n == 0:  # the shipped file must be valid
+                    raise
+                print(f"⚠ Prompt file {path} ignored ({type(e).__name__}: {e})", file=sys.stderr)
+        self._memo = LRUCache(4096)
+        self._base = {(t, length, (), ""): self._format(t, length, (), "")
+                      for t in self.caption_types for length in CAPTION_LENGTH_CHOICES}
+
+    @staticmethod
+    def _check(text, where: str, allowed: set[str]) -> str:
+        import string
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"{where}: expected a non-empty string")
+        fields = {f for _, f, _, _ in string.Formatter().parse(text) if f is not None}
+        if fields - allowed:
+            raise ValueError(f"{where}: unknown placeholder(s) {sorted(fields - allowed)}, "
+                             f"expected {sorted(allowed)}")
+        return text
+
+    def _merge(self, data: dict, source: str):
+        """Validate everything in <data> before taking any of it."""
+        caption_types, tag_types = {}, {}
+        for name, spec in (data.get("caption_types") or {}).items():
+            where = f"{source}: caption type {name!r}"
+            if not isinstance(spec, dict):
+                raise ValueError(f"{where}: expected an object with {list(PROMPT_TEMPLATE_KEYS)}")
+            caption_types[name] = tuple(
+                self._check(spec.get(key), f"{where} {key!r}", {"name", key} - {"any"})
+                for key in PROMPT_TEMPLATE_KEYS)
+            if spec.get("tags") not in (None, "namespaced", "plain"):
+                raise ValueError(f"{where}: 'tags' must be \"namespaced\" or \"plain\"")
+            if spec.get("tags"):
+                tag_types[name] = spec["tags"] == "namespaced"
+        extras = [self._check(o, f"{source}: extra option", {"name"})
+                  for o in data.get("extra_options") or []]
+        name_option = data.get("name_option")
+        if name_option is not None:
+            self._check(name_option, f"{source}: name_option", {"name"})
+        for name in caption_types:
+            self.tag_types.pop(name, None)
+        self.caption_types.update(caption_types)
+        self.tag_types.update(tag_types)
+        self.extra_options += [o for o in extras if o not in self.extra_options]
+        self.name_option = name_option or self.name_option
+        self.sources.append(source)
+
+    def _format(self, caption_type: str, caption_length: str | int,
+                extra_options: tuple, name: str) -> str:
+        if caption_length == "any":
+            idx = 0
+        elif isinstance(caption_length, str) and caption_length.isdigit():
+            idx = 1  # numeric-word-count template
+        else:
+            idx = 2  # length-descriptor template
+        prompt = self.caption_types[caption_type][idx]
+        if extra_options:
+            prompt += " " + " ".join(extra_options)
+        return prompt.format(name=name or "{NAME}", length=caption_length,
+                             word_count=caption_length)
+
+    def prompt(self, caption_type: str, caption_length: str | int,
+               extra_options: Iterable[str] = (), name: str = "") -> str:
+        """The final text prompt; KeyError for an unknown caption type."""
+        key = (caption_type, caption_length, tuple(extra_options), name or "")
+        text = self._base.get(key) or self._memo.get(key)
+        if text is None:
+            text = self._format(*key)
+            self._memo.put(key, text)
+        return text
+
+
+CAPTION_LENGTH_CHOICES = (["any", "very short", "short", "medium-length", "long", "very long"] +
+                          [str(i) for i in range(20, 261, 10)])
+
+prompt_registry = PromptRegistry(
+    PROMPTS_FILE, *filter(None, os.environ.get("JOYCAPTION_PROMPTS", "").split(os.pathsep)))
+# Caption type -> (any, word_count, length) templates
+CAPTION_TYPE_MAP = prompt_registry.caption_types
+NAME_OPTION = prompt_registry.name_option
+EXTRA_OPTIONS = [NAME_OPTION] + prompt_registry.extra_options  # the UI's check-boxes
+
+# Rough word counts the length descriptors produce, for token_budget()
+LENGTH_WORDS = {"very short": 25, "short": 50, "medium-length": 100, "long": 200, "very long": 300}
+
+
+def token_budget(caption_type: str, caption_length: str | int, max_new_tokens: int) -> int:
+    """
+    Token cap for one caption derived from its requested length: about 1.6
+    tokens per word for prose and 3 for tag lists (underscored tags split
+    into more pieces), plus slack.  "any" keeps <max_new_tokens>.
+    """
+    length = str(caption_length)
+    words = int(length) if length.isdigit() else LENGTH_WORDS.get(length)
+    if words is None:
+        return max_new_tokens
+    per_word = 3.0 if caption_type in TAG_CAPTION_TYPES else 1.6
+    return min(max_new_tokens, int(words * per_word) + 32)
 
 
 def build_prompt(
@@ -293,318 +815,4551 @@ def build_prompt(
     extra_options: list[str],
     name_input: str,
 ) -> str:
-    """Assemble the final text prompt passed to the model."""
-    # Choose the correct template row in CAPTION_TYPE_MAP
-    if caption_length == "any":
-        map_idx = 0
-    elif isinstance(caption_length, str) and caption_length.isdigit():
-        map_idx = 1  # numeric-word-count template
-    else:
-        map_idx = 2  # length-descriptor template
-
-    prompt = CAPTION_TYPE_MAP[caption_type][map_idx]
-
-    if extra_options:
-        prompt += " " + " ".join(extra_options)
-
-    return prompt.format(
-        name=name_input or "{NAME}",
-        length=caption_length,
-        word_count=caption_length,
-    )
+    """Assemble the final text prompt passed to the model (see PromptRegistry)."""
+    return prompt_registry.prompt(caption_type, caption_length, extra_options or (), name_input)
 
 
 def toggle_name_box(selected_options: list[str]):
     """Show / hide the name textbox depending on the checkbox."""
+    import gradio as gr
     return gr.update(visible=NAME_OPTION in selected_options)
 
 # ─────────────────────── End Prompt helpers ─────────────────────── #
 
 
+# ──────────────────────── Tag vocabulary ────────────────────────── #
+# e621 tag categories; tag-list captions put the namespaced ones first, in
+# this order (as the e621 / Rule34 prompts ask), then the general tags.
+TAG_CATEGORIES = {0: "general", 1: "artist", 3: "copyright", 4: "character",
+                  5: "species", 6: "invalid", 7: "meta", 8: "lore"}
+TAG_NAMESPACES = ("artist", "copyright", "character", "species", "meta", "lore")
+_TAG_ORDER = {c: i for i, c in enumerate(TAG_NAMESPACES + ("general",))}
+# Caption types post-processed against the tag list -> write namespace prefixes?
+TAG_CAPTION_TYPES = prompt_registry.tag_types  # caption type -> namespaced tags ("tags" in prompts.json)
+TAG_MODES = ("off", "normalize", "strict", "constrained")
+_TAG_INDEX_VERSION = 1
+
+
+class TagIndex:
+    """
+    Compact index over the master tag list: tag names sorted in one list
+    (exact and prefix lookups by bisection, no per-character trie nodes),
+    their categories in a parallel bytes object, and an alias -> tag map.
+    Names are stored the booru way: lowercase with underscores.
+    """
+
+    def __init__(self, names: List[str], categories: bytes, aliases: dict[str, str]):
+        self.names = names
+        self.categories = categories
+        self.aliases = aliases
+        # Everything the model may legitimately write, for prefix checks
+        self._surface = sorted(set(names) | set(aliases))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @staticmethod
+    def canonical(tag: str) -> str:
+        return "_".join(tag.strip().lower().split())
+
+    def resolve(self, tag: str) -> tuple[str, str] | None:
+        """(canonical name, category) of a tag or alias, None if unknown/invalid."""
+        from bisect import bisect_left
+        name = self.aliases.get(tag, tag)
+        i = bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            return None
+        category = TAG_CATEGORIES.get(self.categories[i], "general")
+        return None if category == "invalid" else (name, category)
+
+    def has_prefix(self, prefix: str) -> bool:
+        from bisect import bisect_left
+        i = bisect_left(self._surface, prefix)
+        return i < len(self._surface) and self._surface[i].startswith(prefix)
+
+    def normalize(self, text: str, namespaces: bool = True, drop_unknown: bool = False) -> str:
+        """
+        Validate, alias-normalise, deduplicate and re-sort a comma-separated
+        tag caption.  Unknown tags are kept (after the known ones) unless
+        <drop_unknown>.  Multi-word tags keep the model's separator style.
+        """
+        raw = [t.strip() for t in text.replace("\n", ",").split(",")]
+        raw = [t for t in raw if t]
+        spaces = any(" " in t for t in raw) and not any("_" in t for t in raw)
+        seen, known, unknown = set(), [], []
+        for tag in raw:
+            ns, sep, rest = tag.partition(":")
+            ns = ns.strip().lower()
+            if sep and ns in TAG_NAMESPACES and rest.strip():
+                tag = rest
+            else:
+                ns = None
+            name = self.canonical(tag)
+            hit = self.resolve(name)
+            if hit:
+                name, category = hit
+            elif drop_unknown:
+                continue
+            if name in seen:
+                continue
+            seen.add(name)
+            if hit:
+                known.append((_TAG_ORDER.get(category, len(TAG_NAMESPACES)), name, category))
+            else:
+                unknown.append((name, ns))
+
+        def render(name: str, category: str | None) -> str:
+            if spaces:
+                name = name.replace("_", " ")
+            if namespaces and category in TAG_NAMESPACES:
+                return f"{category}:{name}"
+            return name
+
+        out = [render(name, category) for _, name, category in sorted(known)]
+        out += [render(name, ns) for name, ns in unknown]
+        return ", ".join(out)
+
+
+def _parse_tag_list(path: Path) -> tuple[dict[str, int], dict[str, str]]:
+    """
+    Read a tag list into ({name: category}, {alias: name}).  Accepts the e621
+    CSV export (name, category columns) or JSON as a list of names, a list of
+    {"name", "category", "aliases"} objects, a {name: category | object}
+    mapping, or {"tags": ..., "aliases": {alias: name}}.
+    """
+    tags: dict[str, int] = {}
+    aliases: dict[str, str] = {}
+    cat_ids = {v: k for k, v in TAG_CATEGORIES.items()}
+
+    def category(value) -> int:
+        if isinstance(value, str):
+            return int(value) if value.isdigit() else cat_ids.get(value.lower(), 0)
+        return int(value or 0)
+
+    def add(name: str, value=None):
+        name = TagIndex.canonical(name)
+        if not name:
+            return
+        if isinstance(value, dict):
+            tags[name] = category(value.get("category", value.get("type", 0)))
+            alias_list = value.get("aliases") or []
+            if isinstance(alias_list, str):
+                alias_list = alias_list.split(",")
+            for a in alias_list:
+                if TagIndex.canonical(a):
+                    aliases[TagIndex.canonical(a)] = name
+        else:
+            tags[name] = category(value)
+
+    if path.suffix.lower() == ".csv":
+        import csv
+        with path.open(encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                add(row.get("name") or row.get("tag") or "", row.get("category", 0))
+        return tags, aliases
+
+    data = json.loads(path.read_text(encoding="utf-8"))
+    if isinstance(data, dict) and "tags" in data:
+        aliases.update({TagIndex.canonical(a): TagIndex.canonical(t)
+                        for a, t in (data.get("aliases") or {}).items()})
+        data = data["tags"]
+    if isinstance(data, dict):
+        # {name: int} is ambiguous: small ints are categories, big ones post counts
+        ints = [v for v in data.values() if isinstance(v, int)]
+        counts = bool(ints) and max(ints) > max(TAG_CATEGORIES)
+        for name, value in data.items():
+            add(name, None if counts and isinstance(value, int) else value)
+    else:
+        for item in data:
+            if isinstance(item, str):
+                add(item)
+            else:
+                add(item.get("name") or item.get("tag") or "", item)
+    return tags, aliases
+
+
+tag_list_path: str | None = None  # --tag-list; default: the e621 master list
+_tag_index: TagIndex | None = None
+_tag_index_lock = threading.Lock()
+
+
+def load_tag_index(path: str | Path | None = None) -> TagIndex:
+    """
+    TagIndex for <path> (default: the e621 master list, downloaded once).
+    The parsed index is pickled under CACHE_DIR, keyed by the source file's
+    size and mtime, so later startups skip the JSON parse.
+    """
+    import pickle
+    global _tag_index
+    with _tag_index_lock:
+        if _tag_index is not None and path is None:
+            return _tag_index
+        src = Path(path or tag_list_path or ensure_asset(E621_TAGS_REPO, E621_TAGS_FILE))
+        st = src.stat()
+        stamp = f"{src.resolve()}:{st.st_size}:{st.st_mtime_ns}:{_TAG_INDEX_VERSION}"
+        cached = CACHE_DIR / f"tags-{hashlib.sha256(stamp.encode()).hexdigest()[:16]}.pkl"
+        try:
+            with cached.open("rb") as f:
+                names, categories, aliases = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            tags, aliases = _parse_tag_list(src)
+            names = sorted(tags)
+            categories = bytes(tags[n] & 0xFF for n in names)
+            aliases = {a: t for a, t in aliases.items() if t in tags and a != t}
+            tmp = cached.with_suffix(".tmp")
+            with tmp.open("wb") as f:
+                pickle.dump((names, categories, aliases), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cached)
+        index = TagIndex(names, categories, aliases)
+        if path is None:
+            _tag_index = index
+        return index
+
+
+_tag_list_failed = False
+
+
+def postprocess_tags(caption: str, caption_type: str, tag_mode: str) -> str:
+    """
+    Apply the tag-list cleanup of <tag_mode> to tag-type captions.  If the
+    tag list cannot be loaded (e.g. offline) captions pass through unchanged.
+    """
+    global _tag_list_failed
+    if tag_mode == "off" or caption_type not in TAG_CAPTION_TYPES or _tag_list_failed:
+        return caption
+    try:
+        index = load_tag_index()
+    except Exception as e:
+        _tag_list_failed = True
+        print(f"⚠  Tag list unavailable ({type(e).__name__}: {e}) – tags are left unchecked.",
+              file=sys.stderr)
+        return caption
+    return index.normalize(caption, namespaces=TAG_CAPTION_TYPES[caption_type],
+                           drop_unknown=tag_mode != "normalize")
+
+
+def _tag_logits_processor(index: TagIndex, top_k: int = 64, rows: List[bool] | None = None):
+    """
+    Constrained decoding for tag lists: only tokens that keep the current tag
+    a prefix of a known tag (or end it, with ',' or EOS, on a complete one)
+    survive.  Each row's <top_k> most likely tokens are checked first and
+    the rest of the vocabulary only when none of those fit, which keeps the
+    per-step cost small.  <rows> limits the constraint to the flagged batch
+    rows (mixed-prompt batches); by default every row is constrained.
+    """
+    import torch
+    from transformers import LogitsProcessor, LogitsProcessorList
+
+    tok = processor.tokenizer
+    eos = set(_eos_token_ids())
+    pieces: dict[int, str] = {}
+
+    def piece(token_id: int) -> str:
+        if token_id not in pieces:
+            pieces[token_id] = tok.decode([token_id])
+        return pieces[token_id]
+
+    def known(tag: str) -> bool:
+        ns, sep, rest = tag.partition(":")
+        if sep and ns.strip().lower() in TAG_NAMESPACES:
+            tag = rest
+        return index.resolve(TagIndex.canonical(tag)) is not None
+
+    def prefix_ok(partial: str) -> bool:
+        partial = partial.lstrip().lower()
+        if not partial:
+            return True
+        if any(f"{ns}:".startswith(partial) for ns in TAG_NAMESPACES):
+            return True
+        ns, sep, rest = partial.partition(":")
+        if sep and ns in TAG_NAMESPACES:
+            partial = rest.lstrip()
+        # Keep a trailing space (next word of a multi-word tag) as "_"
+        name = "_".join(partial.split()) + ("_" if partial[-1:].isspace() else "")
+        return not name or index.has_prefix(name)
+
+    def allowed(text: str, partial: str, token_id: int) -> bool:
+        if token_id in eos:  # never an empty caption
+            return known(partial) or (not partial.strip() and bool(text.strip()))
+        text = piece(token_id)
+        if "\ufffd" in text or not text.isprintable():  # partial UTF-8, newlines, controls
+            return False
+        head, comma, tail = text.partition(",")
+        if comma:
+            return known(partial + head) and (not tail.strip() or prefix_ok(tail))
+        return prefix_ok(partial + text)
+
+    class TagConstraint(LogitsProcessor):
+        def __init__(self):
+            self.start: int | None = None
+
+        def __call__(self, input_ids, scores):
+            if self.start is None:  # prompt length (0 with the prefix-cache path)
+                self.start = input_ids.shape[1]
+            mask = torch.full_like(scores, float("-inf"))
+            for row in range(scores.shape[0]):
+                if rows is not None and not rows[row]:
+                    mask[row] = 0
+                    continue
+                text = tok.decode(input_ids[row, self.start:], skip_special_tokens=True)
+                partial = text.rpartition(",")[2]
+                top = scores[row].topk(min(top_k, scores.shape[1])).indices.tolist()
+                keep = [t for t in top if allowed(text, partial, t)]
+                if not keep:  # rare: walk the rest of the vocabulary by score
+                    rest = scores[row].argsort(descending=True)[len(top):].tolist()
+                    keep = next(([t] for t in rest if allowed(text, partial, t)), top[:1])
+                mask[row, keep] = 0
+            return scores + mask
+
+    return LogitsProcessorList([TagConstraint()])
+
+
+
 # ─────────────────────── Batch-caption helpers ──────────────────────
-@torch.no_grad()
-def _caption_once(img: Image.Image,
-                  prompt: str,
-                  temperature: float,
-                  top_p: float,
-                  max_new_tokens: int) -> str:
-    """One-shot caption without streaming; re-uses the same args as single-mode."""
-    convo = [
-        {"role": "system",
-         "content": "You are a helpful assistant."},
-        {"role": "user",
-         "content": prompt.strip()},
-    ]
+def _preprocess_images(imgs: List[Image.Image]) -> torch.Tensor:
+    """Image-processor half of AutoProcessor: resize + normalise to pixel_values."""
+    t0 = time.perf_counter()
+    pixel_values = processor.image_processor(imgs, return_tensors="pt")["pixel_values"]
+    metrics.observe("joycaption_stage_seconds", time.perf_counter() - t0, stage="processor")
+    return pixel_values
+
+
+def _cached_pixels(img: Image.Image, digest: str) -> torch.Tensor:
+    """
+    Preprocessed pixels of <img> (image_digest <digest>) on the model's
+    device, reused from _pixel_cache when the same image was captioned
+    recently, e.g. after editing the prompt or clicking Caption again.
+    """
+    pixel_values = _pixel_cache.get(digest)
+    if pixel_values is None:
+        metrics.inc("joycaption_cache_misses_total", cache="pixels")
+        pixel_values = _preprocess_images([img]).to(model.device, model.dtype)
+        _pixel_cache.put(digest, pixel_values)
+    else:
+        metrics.inc("joycaption_cache_hits_total", cache="pixels")
+    return pixel_values
+
+
+BATCH_SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Templated + tokenised prompt ids per (system, prompt, image-token count):
+# every registry prompt without extras at the model's image size, built
+# once per load, and an LRU for the rest.  Then the padded id / mask tensors
+# of whole prompt lists already on the device, the KV cache of the text in
+# front of the first image token, and the pixel tensors of the last
+# interactive images.  All are reset by load_model() when a different model
+# comes in.
+_prompt_ids_base: dict[tuple, List[int]] = {}
+_prompt_ids_cache = LRUCache(256)
+_prompt_tensor_cache = LRUCache(64)
+_prefix_kv_cache = LRUCache(4)
+_pixel_cache = LRUCache(8)
+
+
+def _image_token_count(height: int, width: int) -> int:
+    """Image tokens the loaded processor expands <image> to for pixels of this size."""
+    n_image_tokens = (height // processor.patch_size) * (width // processor.patch_size)
+    n_image_tokens += processor.num_additional_image_tokens
+    if processor.vision_feature_select_strategy == "default":
+        n_image_tokens -= 1
+    return n_image_tokens
+
+
+def _convo_str(system: str, prompt: str, n_image_tokens: int) -> str:
+    # WARNING: HF's handling of chat's on Llava models is very fragile.  This specific combination of
+    # processor.apply_chat_template() + tokenizer() reproduces what processor() produces, but if using other
+    # combinations always inspect the final input_ids.  Often you end up with multiple <bos> tokens if not
+    # careful, which can make the model perform poorly.
     convo_str = processor.apply_chat_template(
-        convo, tokenize=False, add_generation_prompt=True
+        [{"role": "system", "content": system},
+         {"role": "user", "content": prompt.strip()}],
+        tokenize=False, add_generation_prompt=True,
     )
-    inputs = processor(text=[convo_str], images=[img],
-                       return_tensors="pt").to("cuda")
-    inputs["pixel_values"] = inputs["pixel_values"].to(torch.bfloat16)
+    return convo_str.replace(processor.image_token, processor.image_token * n_image_tokens)
+
+
+def _prompt_ids(system: str, prompt: str, n_image_tokens: int) -> List[int]:
+    """Chat-templated, image-expanded token ids for one prompt (cached)."""
+    key = (system, prompt, n_image_tokens)
+    ids = _prompt_ids_base.get(key) or _prompt_ids_cache.get(key)
+    if ids is None:
+        ids = processor.tokenizer(_convo_str(system, prompt, n_image_tokens))["input_ids"]
+        _prompt_ids_cache.put(key, ids)
+    return ids
+
+
+def _precompute_prompt_ids():
+    """
+    Tokenise every registry prompt without extras (all caption types ×
+    lengths, no name) at the loaded processor's image size in one tokenizer
+    call, so the common requests never reach the tokenizer.
+    """
+    _prompt_ids_base.clear()
+    size = processor.image_processor.size
+    height = size.get("height") or size.get("shortest_edge")
+    width = size.get("width") or height
+    if not height:
+        return
+    n_image_tokens = _image_token_count(height, width)
+    prompts = list(prompt_registry._base.values())
+    rows = processor.tokenizer([_convo_str(BATCH_SYSTEM_PROMPT, p, n_image_tokens)
+                                for p in prompts])["input_ids"]
+    _prompt_ids_base.update(((BATCH_SYSTEM_PROMPT, p, n_image_tokens), ids)
+                            for p, ids in zip(prompts, rows))
+
 
-    gen_tokens = model.generate(
-        **inputs,
+def _encode_batch(prompts: List[str], pixel_values: torch.Tensor | None,
+                  system: str = BATCH_SYSTEM_PROMPT,
+                  image_features: torch.Tensor | None = None):
+    """
+    Text half of AutoProcessor for already preprocessed pixels.  Mirrors
+    LlavaProcessor.__call__: each <image> placeholder is expanded to one token
+    per vision patch, then rows are left-padded.  Token ids come from the
+    per-prompt cache, so a batch run tokenises its prompt exactly once, and
+    the padded tensors per prompt list are kept on the device (callers must
+    not modify them in place); registry prompts without extras are
+    tokenised right after load (_precompute_prompt_ids).
+    Pass <image_features> (one row per prompt, see _image_features) instead
+    of pixels to reuse vision-tower output across prompts.
+    """
+    import torch
+    if image_features is not None:
+        n_image_tokens = image_features.shape[1]
+    else:
+        n_image_tokens = _image_token_count(*pixel_values.shape[-2:])
+
+    t0 = time.perf_counter()
+    key = (system, tuple(prompts), n_image_tokens)
+    tensors = _prompt_tensor_cache.get(key)
+    if tensors is None:
+        rows = [_prompt_ids(system, p, n_image_tokens) for p in prompts]
+        width = max(len(r) for r in rows)
+        pad = processor.tokenizer.pad_token_id
+        tensors = (torch.tensor([[pad] * (width - len(r)) + r for r in rows], device=model.device),
+                   torch.tensor([[0] * (width - len(r)) + [1] * len(r) for r in rows],
+                                device=model.device))
+        _prompt_tensor_cache.put(key, tensors)
+    inputs = {"input_ids": tensors[0], "attention_mask": tensors[1]}
+    if image_features is not None:
+        inputs["image_features"] = image_features
+    else:
+        inputs["pixel_values"] = pixel_values.to(model.device, model.dtype)
+    metrics.observe("joycaption_stage_seconds", time.perf_counter() - t0, stage="h2d")
+    return inputs
+
+
+def _image_features(pixel_values: torch.Tensor) -> torch.Tensor:
+    """Projected vision-tower features, one row of image tokens per image."""
+    import torch
+    with torch.no_grad():
+        return model.get_image_features(
+            pixel_values=pixel_values.to(model.device, model.dtype),
+            vision_feature_layer=model.config.vision_feature_layer,
+            vision_feature_select_strategy=model.config.vision_feature_select_strategy,
+        )
+
+
+def _merge_image_embeds(input_ids: torch.Tensor, inputs: dict) -> torch.Tensor:
+    """Token embeddings with the projected image features scattered into the image slots."""
+    embeds = model.get_input_embeddings()(input_ids)
+    features = inputs.get("image_features")
+    if features is None:
+        features = _image_features(inputs["pixel_values"])
+    mask = (input_ids == model.config.image_token_index).unsqueeze(-1).expand_as(embeds)
+    return embeds.masked_scatter(mask, features.to(embeds.device, embeds.dtype))
+
+
+def _with_prefix_cache(inputs):
+    """
+    Rewrite a batch so generate() starts from the cached KV of the text in
+    front of the image (system prompt + user header) instead of prefilling it
+    per image.  Rows of different lengths (several prompts) keep working: their
+    padding is moved from the front to just after the shared prefix, where
+    the attention mask hides it and position ids (from the mask) stay those
+    of the unpadded row.  Returns None when rows do not share that prefix,
+    in which case the plain path is used.
+    """
+    import copy
+    import torch
+    from transformers import DynamicCache
+
+    ids, mask = inputs["input_ids"], inputs["attention_mask"]
+    lengths = mask.sum(dim=1).tolist()
+    width = ids.shape[1]
+    row0 = ids[0, width - lengths[0]:]
+    hits = (row0 == model.config.image_token_index).nonzero()
+    if not len(hits) or hits[0].item() == 0:
+        return None
+    first = hits[0].item()
+    for r, n in enumerate(lengths):
+        if n <= first or not bool((ids[r, width - n:width - n + first] == row0[:first]).all()):
+            return None
+    if min(lengths) < width:
+        pad = processor.tokenizer.pad_token_id
+        rows = [ids[r, width - n:].tolist() for r, n in enumerate(lengths)]
+        ids = torch.tensor([row[:first] + [pad] * (width - len(row)) + row[first:] for row in rows],
+                           device=ids.device)
+        mask = torch.tensor([[1] * first + [0] * (width - len(row)) + [1] * (len(row) - first)
+                             for row in rows], device=mask.device)
+
+    key = tuple(ids[0, :first].tolist())
+    prefix_kv = _prefix_kv_cache.get(key)
+    if prefix_kv is None:
+        prefix_kv = model.language_model.model(
+            input_ids=ids[:1, :first], past_key_values=DynamicCache(), use_cache=True,
+        ).past_key_values
+        _prefix_kv_cache.put(key, prefix_kv)
+    kv = copy.deepcopy(prefix_kv)
+    kv.batch_repeat_interleave(len(ids))
+    # With only inputs_embeds, generate() feeds the positions past the cache
+    # and returns just the new tokens.
+    return {
+        "inputs_embeds": _merge_image_embeds(ids, inputs),
+        "attention_mask": mask,
+        "past_key_values": kv,
+    }
+
+
+def _generate_batch(inputs,
+                    temperature: float,
+                    top_p: float,
+                    max_new_tokens: int,
+                    prefix_cache: bool = True,
+                    row_stats: list | None = None,
+                    early_stop=None,
+                    **generate_kwargs) -> List[str]:
+    """
+    Single left-padded generate() call; returns one stripped caption per row.
+    Extra keyword arguments (streamer, stopping_criteria, …) go to generate().
+    <early_stop> is an _early_stopping() criterion (loops / token budgets).
+    <row_stats>, if given, is extended with one {"prompt_tokens",
+    "completion_tokens", "finish_reason"} dict per row.
+    """
+    import torch
+    gen_kwargs = dict(
         max_new_tokens=max_new_tokens,
         do_sample=temperature > 0,
         temperature=temperature if temperature > 0 else None,
         top_p=top_p if temperature > 0 else None,
         use_cache=True,
+        pad_token_id=processor.tokenizer.pad_token_id,
+        **generate_kwargs,
     )
-    return processor.batch_decode(
-        gen_tokens[:, inputs["input_ids"].shape[-1]:]
-    )[0].strip()
+    if early_stop is not None:
+        gen_kwargs["stopping_criteria"] = list(gen_kwargs.get("stopping_criteria") or []) + [early_stop]
+    if metrics.enabled:
+        gen_kwargs["stopping_criteria"] = _step_timer(gen_kwargs.get("stopping_criteria"))
+    start = time.perf_counter()
+    with torch.no_grad():
+        cached = _with_prefix_cache(inputs) if prefix_cache else None
+        if cached is not None:
+            new_tokens = model.generate(**cached, **gen_kwargs)
+        elif "image_features" in inputs:
+            # Only inputs_embeds: generate() returns just the new tokens
+            new_tokens = model.generate(
+                inputs_embeds=_merge_image_embeds(inputs["input_ids"], inputs),
+                attention_mask=inputs["attention_mask"], **gen_kwargs,
+            )
+        else:
+            new_tokens = model.generate(**inputs, **gen_kwargs)
+            new_tokens = new_tokens[:, inputs["input_ids"].shape[-1]:]
+    if early_stop is not None:
+        new_tokens = early_stop.trim(new_tokens)
+    if row_stats is not None:
+        eos = torch.tensor(_eos_token_ids(), device=new_tokens.device)
+        ended = torch.isin(new_tokens, eos).any(dim=1).tolist()
+        reasons = early_stop.reasons if early_stop is not None else {}
+        for row, (n_prompt, n_new) in enumerate(zip(
+                inputs["attention_mask"].sum(dim=1).tolist(),
+                (new_tokens != processor.tokenizer.pad_token_id).sum(dim=1).tolist())):
+            row_stats.append({"prompt_tokens": n_prompt, "completion_tokens": n_new,
+                              "finish_reason": reasons.get(row) or ("stop" if ended[row] else "length")})
+    if metrics.enabled:
+        elapsed = time.perf_counter() - start
+        n = int((new_tokens != processor.tokenizer.pad_token_id).sum())
+        metrics.inc("joycaption_tokens_generated_total", n)
+        metrics.observe("joycaption_stage_seconds", elapsed, stage="generate")
+        metrics.observe("joycaption_tokens_per_second", n / elapsed if elapsed else 0.0,
+                        buckets=Metrics.RATE_BUCKETS)
+    # Shorter rows are padded after their EOS, so special tokens must go
+    return [
+        text.strip()
+        for text in processor.batch_decode(new_tokens, skip_special_tokens=True)
+    ]
 
 
-def run_batch(in_dir: str,
-              caption_type: str,
-              caption_length: str | int,
-              extra_opts: list[str],
-              name_field: str,
-              temperature: float,
-              top_p: float,
-              max_new_tokens: int):
-    """Iterate over all images in <in_dir> using *current* UI settings."""
-    paths = [p for p in Path(in_dir).glob("*")
-             if p.suffix.lower() in {".png", ".jpg", ".jpeg", ".webp",
-                                     ".bmp", ".gif", ".tiff"}]
-    if not paths:
-        yield "❌ No images found."
-        return
+def _loop_start(tokens: List[int], max_period: int = 32, min_span: int = 24) -> int | None:
+    """
+    If <tokens> ends in a pattern of period <= <max_period> repeated over at
+    least <min_span> tokens (and 3 times), the index where the first
+    repeat starts, so tokens[:index] keeps one copy; otherwise None.
+    """
+    n = len(tokens)
+    for period in range(1, max_period + 1):
+        span = max(min_span, 3 * period)
+        if span > n:
+            break
+        if all(tokens[n - k] == tokens[n - k - period] for k in range(1, span - period + 1)):
+            return n - span + period
+    return None
 
-    out_dir = Path(in_dir) / "_joycaption_output"
-    out_dir.mkdir(exist_ok=True)
 
-    start = time.time()
-    for i, p in enumerate(paths, 1):
-        img = Image.open(p).convert("RGB")
-        prompt = build_prompt(
-            caption_type, caption_length, extra_opts, name_field
-        )
-        caption = _caption_once(
-            img, prompt, temperature, top_p, max_new_tokens
-        )
-        (out_dir / f"{p.stem}.txt").write_text(caption, encoding="utf-8")
+def _early_stopping(budgets: List[int | None] | None = None, loop_stop: bool = True):
+    """
+    Per-row stopping criterion for generate(): a row ends at its own token
+    budget or as soon as it is caught looping (_loop_start), instead of
+    running to max_new_tokens.  reasons maps stopped rows to "budget" /
+    "loop"; trim() cuts looping rows back to one copy of the loop.
+    """
+    import torch
+    from transformers import StoppingCriteria
 
-        eta = (time.time() - start) / i * (len(paths) - i)
-        yield f"{i}/{len(paths)} done – ETA {int(eta)//60:02d}:{int(eta)%60:02d}"
+    class EarlyStop(StoppingCriteria):
+        def __init__(self):
+            self.start: int | None = None
+            self.reasons: dict[int, str] = {}
+            self.cuts: dict[int, int] = {}
+            self.ignore = set(_eos_token_ids()) | {processor.tokenizer.pad_token_id}
 
-    yield f"✅ Finished {len(paths)} images → {out_dir}"
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.start is None:  # called after the first new token
+                self.start = input_ids.shape[1] - 1
+            n = input_ids.shape[1] - self.start
+            stop = [False] * input_ids.shape[0]
+            for row in range(input_ids.shape[0]):
+                if row in self.reasons:
+                    stop[row] = True
+                    continue
+                if int(input_ids[row, -1]) in self.ignore:  # finished on EOS
+                    continue
+                budget = budgets[row] if budgets else None
+                if budget is not None and n >= budget:
+                    self.reasons[row] = "budget"
+                elif loop_stop and n >= 24:
+                    cut = _loop_start(input_ids[row, self.start:].tolist())
+                    if cut is None:
+                        continue
+                    self.reasons[row], self.cuts[row] = "loop", cut
+                else:
+                    continue
+                stop[row] = True
+            return torch.tensor(stop, device=input_ids.device)
 
+        def trim(self, new_tokens):
+            for row, cut in self.cuts.items():
+                new_tokens[row, cut:] = processor.tokenizer.pad_token_id
+            return new_tokens
 
+    return EarlyStop()
 
 
+def _step_timer(stopping_criteria=None):
+    """
+    <stopping_criteria> plus a never-stopping criterion that generate()
+    calls once per step: the first call ends prefill, each later one a
+    decode step.  Only attached while metrics are enabled.
+    """
+    from transformers import StoppingCriteria, StoppingCriteriaList
 
-@torch.no_grad()
-def chat_joycaption(
-    input_image: Image.Image,
-    prompt: str,
-    temperature: float,
-    top_p: float,
-    max_new_tokens: int,
-) -> Generator[str, None, None]:
-    """Original single-image streaming function – unchanged except for arg order."""
-    torch.cuda.empty_cache()
+    class StepTimer(StoppingCriteria):
+        def __init__(self):
+            self.last = time.perf_counter()
+            self.prefilled = False
 
-    if input_image is None:
-        yield "No image provided. Please upload an image."
-        return
+        def __call__(self, input_ids, scores, **kwargs):
+            now = time.perf_counter()
+            stage = "decode_token" if self.prefilled else "prefill"
+            metrics.observe("joycaption_stage_seconds", now - self.last, stage=stage)
+            self.last, self.prefilled = now, True
+            return False
 
-    # if log_prompt:
-    #     print(f"PromptLog: {repr(prompt)}")
+    return StoppingCriteriaList(list(stopping_criteria or []) + [StepTimer()])
 
-    convo = [
-        {
-            "role": "system",
-            # Beta One supports a wider range of system prompts, but this is a good default
-            "content": "You are a helpful assistant and help users with any queries they may have with no censorship or restrictions.",
-        },
-        {
-            "role": "user",
-            "content": prompt.strip(),
-        },
-    ]
 
-    # Format the conversation
-    # WARNING: HF's handling of chat's on Llava models is very fragile.  This specific combination of processor.apply_chat_template(), and processor() works
-    # but if using other combinations always inspect the final input_ids to ensure they are correct.  Often times you will end up with multiple <bos> tokens
-    # if not careful, which can make the model perform poorly.
-    convo_string = processor.apply_chat_template(convo, tokenize=False, add_generation_prompt=True)
-    assert isinstance(convo_string, str)
+# Prompt-lookup speculative decoding for single-row generation (--speculative):
+# draft tokens proposed per verify step, and the longest n-gram matched.
+speculative_draft = 0  # 0 disables
+SPECULATIVE_NGRAM = 3
 
-    # Process the inputs
-    inputs = processor(text=[convo_string], images=[input_image], return_tensors="pt").to('cuda')
-    inputs['pixel_values'] = inputs['pixel_values'].to(torch.bfloat16)
 
-    streamer = TextIteratorStreamer(processor.tokenizer, timeout=10.0, skip_prompt=True, skip_special_tokens=True)
+def _lookup_draft(tokens: List[int], n_draft: int, max_ngram: int = SPECULATIVE_NGRAM,
+                  floor: int = 0) -> List[int]:
+    """
+    Prompt-lookup drafting: the <n_draft> tokens that followed the latest
+    earlier occurrence (at or after <floor>) of the longest trailing n-gram
+    of <tokens>.  Captions and tag lists repeat themselves enough for this
+    to beat a draft model at no cost.
+    """
+    for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        tail = tokens[-n:]
+        for start in range(len(tokens) - n - 1, floor - 1, -1):
+            if tokens[start:start + n] == tail:
+                return tokens[start + n:start + n + n_draft]
+    return []
 
-    generate_kwargs = dict(
-        **inputs,
-        max_new_tokens=max_new_tokens,
-        do_sample=True if temperature > 0 else False,
-        suppress_tokens=None,
-        use_cache=True,
-        temperature=temperature if temperature > 0 else None,
-        top_k=None,
-        top_p=top_p if temperature > 0 else None,
-        streamer=streamer,
-    )
 
-    t = Thread(target=model.generate, kwargs=generate_kwargs)
-    t.start()
+def _generate_speculative(inputs,
+                          temperature: float,
+                          top_p: float,
+                          max_new_tokens: int,
+                          n_draft: int | None = None,
+                          on_token=None,
+                          stats: dict | None = None,
+                          min_new_tokens: int = 0) -> str:
+    """
+    Generate one row (batch size 1) with prompt-lookup speculative decoding:
+    each step feeds the last token plus up to <n_draft> drafted ones
+    (_lookup_draft) and keeps the drafts the model would have chosen
+    itself, so one forward pass can emit several tokens.  Every token is
+    still picked from the model's own (warped) distribution, so greedy
+    output matches _generate_batch.  <on_token>(id) is called per token and
+    may return True to stop; <stats> gets drafted / accepted / forwards /
+    completion_tokens / finish_reason ("stop", "length", or "caller" when
+    <on_token> ended it).  EOS is masked for the first <min_new_tokens>.
+    """
+    import torch
+    from transformers import (DynamicCache, LogitsProcessorList, TemperatureLogitsWarper,
+                              TopPLogitsWarper)
 
-    outputs = []
-    for text in streamer:
-        outputs.append(text)
-        yield "".join(outputs)
+    n_draft = (speculative_draft or 8) if n_draft is None else n_draft
+    lm = model.language_model
+    eos = _eos_token_ids()
+    warp = LogitsProcessorList([TemperatureLogitsWarper(temperature), TopPLogitsWarper(top_p)]
+                               if temperature > 0 else [])
 
-# ──────────────────────────── Gradio UI ─────────────────────────── #
-with gr.Blocks(title="JoyCaption – local") as demo:
-    gr.HTML(TITLE)
+    def choose(logits, n_before: int):
+        """The model's token after each position of <logits>."""
+        scores = logits.float()
+        if n_before < min_new_tokens:
+            scores[:min_new_tokens - n_before, eos] = float("-inf")
+        if temperature > 0:
+            return torch.multinomial(warp(None, scores).softmax(dim=-1), 1).squeeze(1).tolist()
+        return scores.argmax(dim=-1).tolist()
 
-    gr.Markdown(
-        "<h2 style='text-align:center'>JoyCaption – local build</h2>"
-        "<p style='text-align:center'>Single image *or* folder batch-mode</p>"
-    )
+    ids = inputs["input_ids"]
+    history = ids[0].tolist()
+    # Drafts come from the text after the image, never the image placeholders
+    floor = max((i + 1 for i, t in enumerate(history) if t == model.config.image_token_index),
+                default=0)
+    tokens: List[int] = []
+    drafted = accepted = forwards = 0
+    kv = DynamicCache()
+    start = time.perf_counter()
+    with torch.no_grad():
+        logits = lm(inputs_embeds=_merge_image_embeds(ids, inputs),
+                    attention_mask=inputs.get("attention_mask"), past_key_values=kv,
+                    use_cache=True, logits_to_keep=1).logits[0]
+        forwards += 1
+        pending = choose(logits, 0)
+        while True:
+            reason = None
+            for tok in pending:
+                tokens.append(tok)
+                if on_token is not None and on_token(tok):
+                    reason = "stop" if tok in eos else "caller"
+                elif tok in eos:
+                    reason = "stop"
+                elif len(tokens) >= max_new_tokens:
+                    reason = "length"
+                else:
+                    continue
+                break
+            if reason is not None:
+                break
+            draft = _lookup_draft(history + tokens, min(n_draft, max_new_tokens - len(tokens) - 1),
+                                  floor=floor)
+            logits = lm(input_ids=torch.tensor([[tokens[-1]] + draft], device=ids.device),
+                        past_key_values=kv, use_cache=True).logits[0]
+            forwards += 1
+            chosen = choose(logits, len(tokens))
+            n_ok = 0
+            while n_ok < len(draft) and chosen[n_ok] == draft[n_ok]:
+                n_ok += 1
+            drafted += len(draft)
+            accepted += n_ok
+            kv.crop(len(history) + len(tokens) + n_ok)  # drop the rejected drafts
+            pending = chosen[:n_ok + 1]
+    metrics.inc("joycaption_tokens_generated_total", len(tokens))
+    metrics.inc("joycaption_draft_tokens_total", drafted)
+    metrics.inc("joycaption_draft_accepted_total", accepted)
+    metrics.observe("joycaption_stage_seconds", time.perf_counter() - start, stage="generate")
+    if stats is not None:
+        stats.update(drafted=drafted, accepted=accepted, forwards=forwards,
+                     completion_tokens=len(tokens), finish_reason=reason)
+    return processor.tokenizer.decode(tokens, skip_special_tokens=True).strip()
 
-    with gr.Tabs():
-        # ──────────── Tab 1 – Single image (unchanged) ──────────── #
-        with gr.Tab("Single image"):
-            with gr.Row():
-                with gr.Column():
-                    input_image = gr.Image(type="pil", label="Input Image", height=512, width=512)
-
-                    caption_type = gr.Dropdown(
-                        choices=list(CAPTION_TYPE_MAP.keys()),
-                        value="Descriptive",
-                        label="Caption Type",
-                    )
 
-                    caption_length = gr.Dropdown(
-                        choices=["any", "very short", "short", "medium-length", "long", "very long"] +
-                                [str(i) for i in range(20, 261, 10)],
-                        label="Caption Length",
-                        value="long",
-                    )
+def _caption_batch(imgs: List[Image.Image],
+                   prompts: List[str],
+                   temperature: float,
+                   top_p: float,
+                   max_new_tokens: int,
+                   **generate_kwargs) -> List[str]:
+    """Caption several images with a single left-padded generate() call."""
+    inputs = _encode_batch(prompts, _preprocess_images(imgs))
+    return _generate_batch(inputs, temperature, top_p, max_new_tokens, **generate_kwargs)
 
-                    with gr.Accordion("Extra Options", open=False):
-                        extra_options = gr.CheckboxGroup(
-                            choices=[
-                                NAME_OPTION,
-                                "Do NOT include information about people/characters that cannot be changed (like ethnicity, gender, etc), but do still include changeable attributes (like hair style).",
-                                "Include information about lighting.",
-                                "Include information about camera angle.",
-                                "Include information about whether there is a watermark or not.",
-                                "Include information about whether there are JPEG artifacts or not.",
-                                "If it is a photo you MUST include information about what camera was likely used and details such as aperture, shutter speed, ISO, etc.",
-                                "Do NOT include anything sexual; keep it PG.",
-                                "Do NOT mention the image's resolution.",
-                                "You MUST include information about the subjective aesthetic quality of the image from low to very high.",
-                                "Include information on the image's composition style, such as leading lines, rule of thirds, or symmetry.",
-                                "Do NOT mention any text that is in the image.",
-                                "Specify the depth of field and whether the background is in focus or blurred.",
-                                "If applicable, mention the likely use of artificial or natural lighting sources.",
-                                "Do NOT use any ambiguous language.",
-                                "Include whether the image is sfw, suggestive, or nsfw.",
-                                "ONLY describe the most important elements of the image.",
-                                "If it is a work of art, do not include the artist's name or the title of the work.",
-                                "Identify the image orientation (portrait, landscape, or square) and aspect ratio if obvious.",
-                                """Use vulgar slang and profanity, such as (but not limited to) "fucking," "slut," "cock," etc.""",
-                                "Do NOT use polite euphemisms—lean into blunt, casual phrasing.",
-                                "Include information about the ages of any people/characters when applicable.",
-                                "Mention whether the image depicts an extreme close-up, close-up, medium close-up, medium shot, cowboy shot, medium wide shot, wide shot, or extreme wide shot.",
-                                "Do not mention the mood/feeling/etc of the image.",
-                                "Explicitly specify the vantage height (eye-level, low-angle worm’s-eye, bird’s-eye, drone, rooftop, etc.).",
-                                "If there is a watermark, you must mention it.",
-                                """Your response will be used by a text-to-image model, so avoid useless meta phrases like “This image shows…”, "You are looking at...", etc.""",
-                            ],
-                            label="Select one or more",
-                        )
 
-                    name_input = gr.Textbox(label="Person / Character Name", visible=False)
+def _caption_once(img: Image.Image,
+                  prompt: str,
+                  temperature: float,
+                  top_p: float,
+                  max_new_tokens: int,
+                  **generate_kwargs) -> str:
+    """
+    One-shot caption without streaming; re-uses the same args as single-mode.
+    With --speculative (and no extra generate() arguments) it decodes with
+    _generate_speculative.
+    """
+    if speculative_draft and not generate_kwargs:
+        inputs = _encode_batch([prompt], _preprocess_images([img]))
+        return _generate_speculative(inputs, temperature, top_p, max_new_tokens)
+    return _caption_batch([img], [prompt], temperature, top_p, max_new_tokens,
+                          **generate_kwargs)[0]
 
-                    with gr.Accordion("Generation settings", open=False):
-                        temperature_slider = gr.Slider(
-                            minimum=0.0, maximum=2.0, value=0.6, step=0.05,
-                            label="Temperature",
-                            info="Higher values make the output more random, lower values make it more deterministic."
-                        )
-                        top_p_slider = gr.Slider(
-                            minimum=0.0, maximum=1.0, value=0.9, step=0.01,
-                            label="Top-p"
-                        )
-                        max_tokens_slider = gr.Slider(
-                            minimum=1, maximum=2048, value=512, step=1,
-                            label="Max New Tokens",
-                            info="Maximum number of tokens to generate.  The model will stop generating if it reaches this limit."
-                        )
 
-                    # log_prompt = gr.Checkbox(value=True, label="Help improve JoyCaption by logging your text query")
+def _load_batch(paths: List[Path], digests: bool = False, features: bool = False):
+    """
+    Decode + preprocess one batch.  Unreadable files are reported instead of
+    raised so one bad image cannot abort a run.  Returns
+    (ok_paths, pixel_values | None, [(path, error)], decode_s, preprocess_s,
+    [image_digest] | None, [features | None] | None), digests only when asked
+    for (caption cache).  With <features> each image is looked up in the
+    FeatureCache first and pixel_values only holds the misses, in order.
+    """
+    t0 = time.perf_counter()
+    ok, imgs, errors = [], [], []
+    for p, img in zip(paths, _load_images(paths)):
+        if isinstance(img, Exception):
+            errors.append((p, f"{type(img).__name__}: {img}"))
+            metrics.inc("joycaption_errors_total", stage="image_load")
+        else:
+            imgs.append(img)
+            ok.append(p)
+    hashes = [image_digest(img) for img in imgs] if digests or features else None
+    cached = None
+    if features and imgs:
+        cache = get_feature_cache()
+        cached = [cache.get(h) for h in hashes]
+        imgs = [img for img, c in zip(imgs, cached) if c is None]
+    t1 = time.perf_counter()
+    pixel_values = _preprocess_images(imgs) if imgs else None
+    return ok, pixel_values, errors, t1 - t0, time.perf_counter() - t1, hashes, cached
 
-                with gr.Column():
-                    prompt_box = gr.Textbox(lines=4, label="Prompt", interactive=True)
 
-                    # Show the name input box only when the specific option is selected
-                    extra_options.change(
-                        toggle_name_box,
-                        inputs=extra_options,
-                        outputs=name_input,
-                    )
+class Manifest:
+    """
+    Append-only JSONL log (``manifest.jsonl`` in the output dir) of every
+    image a batch run has handled.  An entry is still valid while the file's
+    size, mtime and the settings hash match, so reruns only caption new or
+    changed images, images under changed settings, and earlier failures.
+    """
 
-                    # Auto-update prompt box whenever any of the inputs change
-                    for ctrl in (caption_type, caption_length, extra_options, name_input):
-                        ctrl.change(
-                            build_prompt,
-                            inputs=[caption_type, caption_length, extra_options, name_input],
-                            outputs=prompt_box,
-                        )
+    def __init__(self, out_dir: Path, name: str = "manifest.jsonl"):
+        self.path = out_dir / name
+        self.entries: dict[str, dict] = {}
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    self.entries[entry["path"]] = entry
+            # Compact: keep only the newest entry per image
+            tmp = self.path.with_suffix(".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.path)
+        self._fh = self.path.open("a", encoding="utf-8")
 
-                    run_button = gr.Button("Caption")
+    @staticmethod
+    def settings_hash(**settings) -> str:
+        blob = json.dumps(settings, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
 
-                    output_caption = gr.Textbox(label="Caption")
+    def is_done(self, key: str, src: Path, settings: str,
+                caption_files: Path | Iterable[Path]) -> bool:
+        entry = self.entries.get(key)
+        if entry is None or entry.get("error") is not None:
+            return False
+        st = src.stat()
+        if isinstance(caption_files, Path):
+            caption_files = [caption_files]
+        return (entry["size"] == st.st_size
+                and entry["mtime_ns"] == st.st_mtime_ns
+                and entry["settings"] == settings
+                and all(f.exists() for f in caption_files))
 
-        # ──────────────────────── Batch tab UI wiring ───────────────────────
-        with gr.Tab("Batch folder"):
-            folder_in = gr.Textbox(
-                label="Input folder",
-                placeholder="C:\\path\\to\\images  or  /home/me/dataset",
-            )
-            run_batch_btn = gr.Button("Run batch caption")
-            progress_box = gr.Textbox(label="Progress / ETA", interactive=False)
-
-            run_batch_btn.click(
-                run_batch,
-                inputs=[
-                    folder_in,
-                    caption_type,  # ↓ all the same widgets as the single tab
-                    caption_length,
-                    extra_options,
-                    name_input,
-                    temperature_slider,
-                    top_p_slider,
-                    max_tokens_slider,
-                ],
-                outputs=progress_box,
-            )
+    def record(self, key: str, src: Path, settings: str, error: str | None = None):
+        try:
+            st = src.stat()
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None
+        entry = {"path": key, "size": size, "mtime_ns": mtime_ns,
+                 "settings": settings, "error": error, "time": time.time()}
+        self.entries[key] = entry
+        self._fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._fh.flush()
 
-            run_button.click(
-                chat_joycaption,
-                inputs=[input_image, prompt_box, temperature_slider, top_p_slider, max_tokens_slider],
-                outputs=output_caption,
-            )
+    def close(self):
+        self._fh.close()
+
+
+def image_digest(img: Image.Image) -> str:
+    """Content hash of the decoded pixels: duplicates match across formats and paths."""
+    h = hashlib.sha256(f"{img.mode}:{img.width}x{img.height}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class CaptionCache:
+    """
+    Persistent caption cache (SQLite, ``captions.sqlite`` in CACHE_DIR) keyed
+    by image content + model + load profile + prompt + generation settings
+    (int8/int4 greedy output differs from bf16).  Only greedy
+    (temperature 0) captions are cached, since sampling is not repeatable.
+    The least recently used entries are evicted beyond <max_bytes>.  Safe to
+    share between threads and between batch worker processes.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        import sqlite3
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS captions (key TEXT PRIMARY KEY, "
+                         "caption TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS captions_used ON captions(used)")
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+
+    @staticmethod
+    def cacheable(temperature: float) -> bool:
+        return temperature <= 0
+
+    @staticmethod
+    def key(digest: str, system: str, prompt: str, max_new_tokens: int,
+            constrain_tags: bool = False, loop_stop: bool = False) -> str:
+        blob = json.dumps([model_id(), model_manager.profile or load_profile, digest, system,
+                           prompt, int(max_new_tokens)]
+                          + (["constrain_tags"] if constrain_tags else [])
+                          + (["loop_stop"] if loop_stop else []),
+                          ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._db.execute("SELECT caption FROM captions WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("joycaption_cache_misses_total", cache="caption")
+                return None
+            self.hits += 1
+            metrics.inc("joycaption_cache_hits_total", cache="caption")
+            self._db.execute("UPDATE captions SET used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, caption: str):
+        size = len(key) + len(caption.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM captions WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?)",
+                             (key, caption, size, time.time()))
+            self._bytes += size - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes write too, so re-read the real total first
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+        target = int(self.max_bytes * 0.9)  # hysteresis: don't evict on every put
+        for key, size in self._db.execute("SELECT key, size FROM captions ORDER BY used").fetchall():
+            if self._bytes <= target:
+                break
+            self._db.execute("DELETE FROM captions WHERE key = ?", (key,))
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM captions")
+            self._bytes = 0
+
+
+caption_cache_mb = 512  # --caption-cache-mb; 0 disables the cache
+_caption_cache: CaptionCache | None = None
+
+
+def get_caption_cache() -> CaptionCache | None:
+    """Process-wide CaptionCache, or None when disabled."""
+    global _caption_cache
+    if caption_cache_mb <= 0:
+        return None
+    if _caption_cache is None:
+        _caption_cache = CaptionCache(CACHE_DIR / "captions.sqlite", int(caption_cache_mb * 2**20))
+    return _caption_cache
+
+
+class FeatureCache:
+    """
+    Persistent cache of projected image features (vision tower + projector
+    output), so re-captioning a dataset with new prompts skips preprocessing
+    and the vision tower and goes straight to prefill.  One .npy file per
+    image under CACHE_DIR/features, memory-mapped on read (bf16 is stored as
+    its raw 16-bit pattern).  Keys cover the image content, model, dtype and
+    processor / vision-feature config; an SQLite index tracks sizes so the
+    least recently used files are deleted beyond <max_bytes>.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        import sqlite3
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._namespace: tuple | None = None
+        self._lock = threading.Lock()
+        root.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(root / "index.sqlite", timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, "
+                         "size INTEGER NOT NULL, used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS features_used ON features(used)")
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM features").fetchone()[0]
+
+    def key(self, digest: str) -> str:
+        if self._namespace is None or self._namespace[0] is not model:
+            config = {
+                "model": model_id(),
+                "dtype": str(model.dtype),
+                "processor": processor.image_processor.to_dict(),
+                "layer": model.config.vision_feature_layer,
+                "strategy": model.config.vision_feature_select_strategy,
+            }
+            blob = json.dumps(config, sort_keys=True, default=str)
+            self._namespace = (model, hashlib.sha256(blob.encode()).hexdigest())
+        return hashlib.sha256(f"{self._namespace[1]}:{digest}".encode()).hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get(self, digest: str) -> torch.Tensor | None:
+        """Features of one image (image tokens × hidden), memory-mapped, or None."""
+        import numpy as np
+        import torch
+        key = self.key(digest)
+        try:
+            array = np.load(self._file(key), mmap_mode="c")  # copy-on-write: no torch warning
+        except (OSError, ValueError):
+            with self._lock:  # get() runs on the prefetch threads
+                self.misses += 1
+            metrics.inc("joycaption_cache_misses_total", cache="feature")
+            return None
+        metrics.inc("joycaption_cache_hits_total", cache="feature")
+        with self._lock:
+            self.hits += 1
+            self._db.execute("UPDATE features SET used = ? WHERE key = ?", (time.time(), key))
+        features = torch.from_numpy(array)
+        return features.view(torch.bfloat16) if model.dtype == torch.bfloat16 else features
+
+    def put(self, digest: str, features: torch.Tensor):
+        import numpy as np
+        import torch
+        key = self.key(digest)
+        features = features.detach().cpu()
+        if features.dtype == torch.bfloat16:  # numpy has no bf16
+            features = features.view(torch.int16)
+        dest = self._file(key)
+        dest.parent.mkdir(exist_ok=True)
+        tmp = dest.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp.open("wb") as f:
+            np.save(f, features.numpy())
+        os.replace(tmp, dest)  # readers never see a partial file
+        size = dest.stat().st_size
+        with self._lock:
+            old = self._db.execute("SELECT size FROM features WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?)",
+                             (key, size, time.time()))
+            self._bytes += size - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes write too, so re-read the real total first
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM features").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        for key, size in self._db.execute("SELECT key, size FROM features ORDER BY used").fetchall():
+            if self._bytes <= target:
+                break
+            self._file(key).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM features WHERE key = ?", (key,))
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            for (key,) in self._db.execute("SELECT key FROM features").fetchall():
+                self._file(key).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM features")
+            self._bytes = 0
+
+
+feature_cache_gb = 0.0  # --feature-cache-gb; 0 (default) disables the cache
+_feature_cache: FeatureCache | None = None
+
+
+def get_feature_cache() -> FeatureCache | None:
+    """Process-wide FeatureCache, or None when disabled."""
+    global _feature_cache
+    if feature_cache_gb <= 0:
+        return None
+    if _feature_cache is None:
+        _feature_cache = FeatureCache(CACHE_DIR / "features", int(feature_cache_gb * 2**30))
+    return _feature_cache
+
+
+def _prefetch(chunks: Iterable[List[Path]], depth: int, digests: bool = False,
+              features: bool = False):
+    """
+    Yield (chunk, _load_batch(chunk, digests, features)) in order while up to
+    <depth> later batches are decoded and preprocessed on background threads.
+    depth=0 degrades to the old fully serial behaviour.
+    """
+    pool = ThreadPoolExecutor(max_workers=depth + 1,
+                              thread_name_prefix="joycaption-prefetch")
+    pending: deque = deque()
+    try:
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(_load_batch, chunk, digests, features)))
+            if len(pending) > depth:
+                chunk, fut = pending.popleft()
+                yield chunk, fut.result()
+        while pending:
+            chunk, fut = pending.popleft()
+            yield chunk, fut.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+OUTPUT_DIRNAME = "_joycaption_output"
+
+
+def _split_patterns(patterns: str | Iterable[str] | None) -> List[str]:
+    """Accept a list of globs or one comma/newline separated string (UI textbox)."""
+    if not patterns:
+        return []
+    if isinstance(patterns, str):
+        patterns = patterns.replace("\n", ",").split(",")
+    return [p.strip() for p in patterns if p.strip()]
+
+
+def _path_matches(rel: str, include: List[str], exclude: List[str]) -> bool:
+    """fnmatch <rel> (posix, relative to the root) and its basename against the globs."""
+    name = rel.rsplit("/", 1)[-1]
+
+    def hit(pats: List[str]) -> bool:
+        return any(fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(name, pat) for pat in pats)
+
+    return (not include or hit(include)) and not hit(exclude)
+
+
+def iter_images(root: str | Path,
+                recursive: bool = True,
+                include: str | Iterable[str] | None = None,
+                exclude: str | Iterable[str] | None = None) -> Iterator[Path]:
+    """
+    Stream image paths under <root> with os.scandir, one directory at a time,
+    so the first image is available long before a huge or networked tree has
+    been fully listed.  Directories matching an exclude glob are pruned and
+    the batch output folder is never descended into.
+    """
+    root = Path(root)
+    include, exclude = _split_patterns(include), _split_patterns(exclude)
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        subdirs = []
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            continue  # unreadable / vanished directory
+        with entries:
+            for entry in entries:
+                rel = Path(entry.path).relative_to(root).as_posix()
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    if recursive and entry.name != OUTPUT_DIRNAME and _path_matches(rel, [], exclude):
+                        subdirs.append(entry.path)
+                elif (os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS
+                      and _path_matches(rel, include, exclude)):
+                    yield Path(entry.path)
+        # Depth-first, alphabetical between siblings
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def iter_list_file(list_file: str | Path,
+                   base: str | Path | None = None,
+                   include: str | Iterable[str] | None = None,
+                   exclude: str | Iterable[str] | None = None) -> Iterator[Path]:
+    """Paths from a text file (one per line, '#' comments), or stdin for '-'."""
+    include, exclude = _split_patterns(include), _split_patterns(exclude)
+    fh = sys.stdin if str(list_file) == "-" else open(list_file, encoding="utf-8")
+    try:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            p = Path(line)
+            if base is not None and not p.is_absolute():
+                p = Path(base) / p
+            if _path_matches(p.as_posix(), include, exclude):
+                yield p
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+
+
+class TarMember:
+    """
+    One image inside an uncompressed tar (WebDataset) shard.  Stands in for
+    a Path in the batch pipeline: stat() reports the member's size and
+    mtime for the Manifest, read_bytes() seeks straight to its data, so
+    shards are never extracted.
+    """
+    __slots__ = ("shard", "name", "offset", "size", "mtime")
+
+    def __init__(self, shard: Path, name: str, offset: int, size: int, mtime: float):
+        self.shard, self.name = shard, name
+        self.offset, self.size, self.mtime = offset, size, mtime
+
+    def __repr__(self) -> str:
+        return f"{self.shard}::{self.name}"
+
+    __str__ = __repr__
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, TarMember) and (self.shard, self.name) == (other.shard, other.name)
+
+    def __hash__(self) -> int:
+        return hash((self.shard, self.name))
+
+    @property
+    def suffix(self) -> str:
+        return os.path.splitext(self.name)[1]
+
+    def stat(self):
+        from types import SimpleNamespace
+        return SimpleNamespace(st_size=self.size, st_mtime_ns=int(self.mtime * 1e9))
+
+    def read_bytes(self) -> bytes:
+        with open(self.shard, "rb") as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+
+
+def is_tar_spec(spec: str | Path) -> bool:
+    """A .tar shard, a glob of them, or a brace range like data-{000..099}.tar."""
+    return str(spec).lower().endswith(".tar")
+
+
+def expand_shards(spec: str | Path) -> List[Path]:
+    """Expand {000..099} ranges (zero padding kept) and globs into sorted shard paths."""
+    specs = [str(spec)]
+    while any(re.search(r"\{(\d+)\.\.(\d+)\}", s) for s in specs):
+        expanded = []
+        for s in specs:
+            m = re.search(r"\{(\d+)\.\.(\d+)\}", s)
+            if not m:
+                expanded.append(s)
+                continue
+            lo, hi = m.group(1), m.group(2)
+            expanded += [s[:m.start()] + str(n).zfill(len(lo)) + s[m.end():]
+                         for n in range(int(lo), int(hi) + 1)]
+        specs = expanded
+    paths = []
+    for s in specs:
+        paths += sorted(glob.glob(s)) if glob.has_magic(s) else [s]
+    return [Path(p) for p in paths]
+
+
+def iter_tar_shards(spec: str | Path,
+                    include: str | Iterable[str] | None = None,
+                    exclude: str | Iterable[str] | None = None) -> Iterator[TarMember]:
+    """
+    Image members of every shard in <spec> (see expand_shards), in archive
+    order.  Only headers are read here; include/exclude match member names.
+    """
+    import tarfile
+    include, exclude = _split_patterns(include), _split_patterns(exclude)
+    for shard in expand_shards(spec):
+        try:
+            tf = tarfile.open(shard, "r:")  # random access needs an uncompressed tar
+        except tarfile.ReadError as e:
+            raise ValueError(f"{shard}: not an uncompressed tar shard ({e})") from None
+        with tf:
+            for info in tf:
+                if (info.isfile()
+                        and os.path.splitext(info.name)[1].lower() in IMAGE_EXTS
+                        and _path_matches(info.name, include, exclude)):
+                    yield TarMember(shard, info.name, info.offset_data, info.size, info.mtime)
+
+
+def _open_image(p: Path | TarMember) -> Image.Image:
+    """Image.open for a file path or a tar shard member."""
+    if isinstance(p, TarMember):
+        return Image.open(io.BytesIO(p.read_bytes()))
+    return Image.open(p)
+
+
+# Image decoding.  With fast_decode, JPEGs are decoded at a reduced DCT scale
+# (Image.draft) that still covers the vision tower's input size, and every
+# image is resized to that size on the decode threads, so a 40 MP photo
+# never exists at full resolution.  image_backend "turbojpeg" / "auto" uses
+# PyTurboJPEG for JPEGs when installed; pillow-simd speeds up the rest as a
+# drop-in Pillow replacement.  image_frame picks the frame of multi-frame
+# files (GIF / WebP / APNG animations, TIFF pages, ICO sizes).
+fast_decode = True
+image_backend = "auto"
+image_frame = "largest"
+IMAGE_BACKENDS = ("auto", "pil", "turbojpeg")
+IMAGE_FRAMES = ("largest", "first", "middle")
+ALPHA_BACKGROUND = (255, 255, 255)  # transparent pixels are captioned as on white
+decode_threads = 0  # images decoded in parallel per batch; 0: min(8, CPUs)
+_decode_pool: ThreadPoolExecutor | None = None
+_turbojpeg = None  # TurboJPEG instance, False when unavailable
+
+# EXIF orientation -> transposes that undo it (as ImageOps.exif_transpose)
+_EXIF_TRANSPOSE = {2: (Image.Transpose.FLIP_LEFT_RIGHT,), 3: (Image.Transpose.ROTATE_180,),
+                   4: (Image.Transpose.FLIP_TOP_BOTTOM,), 5: (Image.Transpose.TRANSPOSE,),
+                   6: (Image.Transpose.ROTATE_270,), 7: (Image.Transpose.TRANSVERSE,),
+                   8: (Image.Transpose.ROTATE_90,)}
+
+
+def _vision_input_size(size: tuple[int, int]) -> tuple[int, int] | None:
+    """(width, height) the image processor will resize an image of <size> to, if known."""
+    ip = getattr(processor, "image_processor", None)
+    spec = getattr(ip, "size", None) or {}
+    if not getattr(ip, "do_resize", True):
+        return None
+    if "height" in spec and "width" in spec:
+        return spec["width"], spec["height"]
+    if "shortest_edge" in spec:
+        scale = spec["shortest_edge"] / min(size)
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+    return None
+
+
+def _get_turbojpeg():
+    global _turbojpeg
+    if _turbojpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbojpeg = TurboJPEG()
+        except (ImportError, RuntimeError, OSError):  # module or libturbojpeg missing
+            _turbojpeg = False
+    return _turbojpeg
+
+
+def _select_frame(img: Image.Image) -> Image.Image:
+    n = getattr(img, "n_frames", 1)
+    if n <= 1 or image_frame == "first":
+        return img
+    if image_frame == "middle":
+        img.seek(n // 2)
+        return img
+    best, area = 0, -1
+    for i in range(n):
+        img.seek(i)
+        if img.width * img.height > area:  # ties keep the earliest frame
+            best, area = i, img.width * img.height
+    img.seek(best)
+    return img
+
+
+def _decode_turbojpeg(data: bytes, img: Image.Image, target: tuple[int, int] | None):
+    """Decode JPEG <data> (header already parsed into <img>) at the smallest scale ≥ <target>."""
+    tj = _get_turbojpeg()
+    scale = (1, 1)
+    if target:
+        for num, den in sorted(tj.scaling_factors, key=lambda f: f[0] / f[1]):
+            if img.width * num / den >= target[0] and img.height * num / den >= target[1]:
+                scale = (num, den)
+                break
+    from turbojpeg import TJPF_RGB
+    return Image.fromarray(tj.decode(data, pixel_format=TJPF_RGB, scaling_factor=scale))
+
+
+def load_image(source: Path | TarMember | bytes | Image.Image) -> Image.Image:
+    """
+    Decode <source> for captioning: pick the frame (image_frame), undo the
+    EXIF orientation, composite transparency over ALPHA_BACKGROUND, convert
+    to RGB and, with fast_decode, resize straight to the vision input size
+    (JPEGs are decoded at reduced scale first).
+    """
+    data = None
+    encoded = not isinstance(source, Image.Image)  # a decoded Image has no bytes to re-decode
+    if not encoded:
+        img = source
+    elif isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+        img = Image.open(io.BytesIO(data))
+    else:
+        img = _open_image(source)
+    orientation = img.getexif().get(0x0112, 1)
+    target = _vision_input_size(img.size) if fast_decode else None
+    decode_size = target
+    if target and orientation in (5, 6, 7, 8):  # rotated by 90°: the decode is not yet upright
+        target = _vision_input_size(img.size[::-1])
+        decode_size = target and target[::-1]
+
+    if (encoded and img.format == "JPEG" and image_backend != "pil"
+            and getattr(img, "n_frames", 1) == 1 and img.mode in ("RGB", "L") and _get_turbojpeg()):
+        if data is None:
+            data = source.read_bytes()
+        img = _decode_turbojpeg(data, img, decode_size)
+    else:
+        if (encoded and image_backend == "turbojpeg" and img.format == "JPEG"
+                and not _get_turbojpeg()):
+            raise RuntimeError("image_backend 'turbojpeg' needs PyTurboJPEG and libturbojpeg")
+        img = _select_frame(img)
+        if decode_size and img.format == "JPEG":
+            img.draft("RGB", decode_size)
+        img.load()
+    for method in _EXIF_TRANSPOSE.get(orientation, ()):
+        img = img.transpose(method)
+
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        img = Image.new("RGBA", rgba.size, ALPHA_BACKGROUND + (255,))
+        img.alpha_composite(rgba)
+    img = img.convert("RGB")
+    if target and img.size != target:
+        resample = getattr(processor.image_processor, "resample", Image.Resampling.BICUBIC)
+        img = img.resize(target, resample, reducing_gap=3.0)
+    return img
+
+
+def _load_images(paths: List[Path | TarMember]) -> List[Image.Image | Exception]:
+    """load_image for each path on the shared decode pool (Pillow releases the GIL)."""
+    global _decode_pool
+
+    def one(p):
+        t0 = time.perf_counter()
+        try:
+            return load_image(p)
+        except Exception as e:
+            return e
+        finally:
+            metrics.observe("joycaption_stage_seconds", time.perf_counter() - t0, stage="image_load")
+
+    if len(paths) < 2:
+        return [one(p) for p in paths]
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(max_workers=decode_threads or min(8, os.cpu_count() or 1),
+                                          thread_name_prefix="joycaption-decode")
+    return list(_decode_pool.map(one, paths))
+
+
+class ScanAhead:
+    """
+    Drain a path iterator on a background thread into a bounded queue so the
+    consumer can start captioning immediately while ``found`` keeps growing
+    towards the real total (``finished`` turns True once it is exact).
+    """
+    _END = object()
+
+    def __init__(self, source: Iterable[Path], max_queued: int = 100_000):
+        self.found = 0
+        self.finished = False
+        self.error: BaseException | None = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._stop = threading.Event()
+        self._thread = Thread(target=self._run, args=(source,), daemon=True,
+                              name="joycaption-scan")
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, source: Iterable[Path]):
+        try:
+            for p in source:
+                if not self._put(p):
+                    return
+                self.found += 1
+        except BaseException as e:  # surfaced to the consumer in __iter__
+            self.error = e
+        finally:
+            self.finished = True
+            self._put(self._END)
+
+    def __iter__(self) -> Iterator[Path]:
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        self._stop.set()
+
+
+def _chunked(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _mirror_key(p: Path | TarMember, root: Path) -> str:
+    """
+    Posix path of <p> relative to <root>; outside paths keep their full tree.
+    Tar members map to <shard>/<member name>.
+    """
+    if isinstance(p, TarMember):
+        return f"{_mirror_key(p.shard, root)}/{p.name}"
+    try:
+        return p.relative_to(root).as_posix()
+    except ValueError:
+        return Path(*p.resolve().parts[1:]).as_posix()
+
+
+def _generate_continuous(rows: Iterator[dict | None],
+                         slots: int,
+                         temperature: float,
+                         top_p: float,
+                         max_new_tokens: int,
+                         loop_stop: bool = True,
+                         index: TagIndex | None = None,
+                         active: list | None = None):
+    """
+    Continuous batching over <rows>: dicts with "features" (one image's
+    _image_features), "prompt", "budget" (token cap or None) and
+    "constrain" (tag-list decoding); other keys pass through.  Up to
+    <slots> rows decode together, and rows that finish are replaced by new
+    ones prefilled into the running KV cache, instead of the whole batch
+    waiting for its longest row.  Yields (row, caption, stats) as rows
+    finish and (None, None, None) whenever <rows> yields None, so callers
+    can report progress.  In-flight rows live in <active>, letting callers
+    fail them if this raises.
+    """
+    import torch
+    import torch.nn.functional as F
+    from transformers import (DynamicCache, LogitsProcessorList, TemperatureLogitsWarper,
+                              TopPLogitsWarper)
+
+    lm = model.language_model
+    tok = processor.tokenizer
+    pad = tok.pad_token_id
+    eos = set(_eos_token_ids())
+    device = model.device
+    warp = LogitsProcessorList([TemperatureLogitsWarper(temperature), TopPLogitsWarper(top_p)]
+                               if temperature > 0 else [])
+    constraint = _tag_logits_processor(index) if index is not None else None
+    if constraint is not None:
+        constraint[0].start = 0  # the ids passed below are generated tokens only
+    active = [] if active is None else active
+    rows = iter(rows)
+    # Running state, one row per active entry: KV cache, attention mask
+    # (left-padded), generated ids (left-padded with pad) and the token to
+    # feed next.
+    cache = mask = gen = last = None
+
+    def set_layers(fn):
+        for layer in range(len(cache.key_cache)):
+            cache.key_cache[layer] = fn(cache.key_cache[layer])
+            cache.value_cache[layer] = fn(cache.value_cache[layer])
+
+    def admit(new: List[dict]):
+        nonlocal cache, mask, gen, last
+        active.extend(new)
+        features = torch.stack([r["features"] for r in new]).to(device, model.dtype)
+        inputs = _encode_batch([r["prompt"] for r in new], None, image_features=features)
+        m = inputs["attention_mask"]
+        kv = DynamicCache()
+        logits = lm(inputs_embeds=_merge_image_embeds(inputs["input_ids"], inputs),
+                    attention_mask=m, position_ids=(m.cumsum(-1) - 1).clamp(min=0),
+                    past_key_values=kv, use_cache=True, logits_to_keep=1).logits[:, -1]
+        for r, n in zip(new, m.sum(dim=1).tolist()):
+            r["tokens"], r["prompt_tokens"] = [], n
+        fresh = torch.full((len(new),), pad, dtype=torch.long, device=device)
+        if cache is None:
+            cache, mask, gen, last = kv, m, fresh[:, None][:, :0], fresh
+        else:
+            width = max(mask.shape[1], m.shape[1])
+
+            def left(t, n):
+                return F.pad(t, (0, 0, width - n, 0))  # pad the sequence dim on the left
+
+            n_old = mask.shape[1]
+            for layer in range(len(cache.key_cache)):
+                cache.key_cache[layer] = torch.cat([left(cache.key_cache[layer], n_old),
+                                                    left(kv.key_cache[layer], m.shape[1])])
+                cache.value_cache[layer] = torch.cat([left(cache.value_cache[layer], n_old),
+                                                      left(kv.value_cache[layer], m.shape[1])])
+            mask = torch.cat([F.pad(mask, (width - n_old, 0)), F.pad(m, (width - m.shape[1], 0))])
+            gen = torch.cat([gen, fresh[:, None].expand(-1, gen.shape[1])])
+            last = torch.cat([last, fresh])
+        cache._seen_tokens = mask.shape[1]
+        return logits
+
+    def pick(logits, idx: List[int]):
+        scores = logits.float()
+        ids = gen[idx]
+        if constraint is not None:
+            cons = [n for n, r in enumerate(idx) if active[r]["constrain"]]
+            if cons:
+                scores[cons] = constraint(ids[cons], scores[cons])
+        scores = warp(ids, scores)
+        if temperature > 0:
+            return torch.multinomial(scores.softmax(dim=-1), 1).squeeze(1)
+        return scores.argmax(dim=-1)
+
+    def push(idx: List[int], tokens) -> List[int]:
+        """Record the chosen tokens; returns the rows that are now finished."""
+        nonlocal gen
+        column = torch.full((len(active), 1), pad, dtype=torch.long, device=device)
+        column[idx, 0] = tokens
+        gen = torch.cat([gen, column], dim=1)
+        last[idx] = tokens
+        finished = []
+        for r, t in zip(idx, tokens.tolist()):
+            row = active[r]
+            row["tokens"].append(t)
+            n = len(row["tokens"])
+            if t in eos:
+                reason = "stop"
+            elif row["budget"] is not None and n >= row["budget"]:
+                reason = "budget"
+            elif loop_stop and n >= 24 and (cut := _loop_start(row["tokens"])) is not None:
+                reason = "loop"
+                del row["tokens"][cut:]
+            elif n >= max_new_tokens:
+                reason = "length"
+            else:
+                continue
+            row["finish_reason"] = reason
+            finished.append(r)
+        return finished
+
+    def retire(finished: List[int]):
+        nonlocal cache, mask, gen, last
+        done = [active[r] for r in finished]
+        keep = [r for r in range(len(active)) if r not in set(finished)]
+        active[:] = [active[r] for r in keep]
+        if not keep:
+            cache = mask = gen = last = None
+        elif done:
+            sel = torch.tensor(keep, device=device)
+            set_layers(lambda t: t[sel])
+            mask, gen, last = mask[sel], gen[sel], last[sel]
+            # Drop leading columns that no remaining row attends to
+            start = int(mask.any(dim=0).nonzero()[0])
+            if start:
+                set_layers(lambda t: t[:, :, start:])
+                mask = mask[:, start:]
+                cache._seen_tokens = mask.shape[1]
+            used = (gen != pad).any(dim=0).nonzero()
+            gen = gen[:, int(used[0]):] if len(used) else gen[:, :0]
+        for row in done:
+            metrics.inc("joycaption_tokens_generated_total", len(row["tokens"]))
+            stats = {"prompt_tokens": row["prompt_tokens"], "completion_tokens": len(row["tokens"]),
+                     "finish_reason": row["finish_reason"]}
+            yield row, tok.decode(row["tokens"], skip_special_tokens=True).strip(), stats
+
+    exhausted = False
+    with torch.no_grad():
+        while True:
+            new = []
+            while not exhausted and len(active) + len(new) < slots:
+                row = next(rows, StopIteration)
+                if row is StopIteration:
+                    exhausted = True
+                elif row is None:
+                    yield None, None, None
+                else:
+                    new.append(row)
+            if new:
+                idx = list(range(len(active), len(active) + len(new)))
+                logits = admit(new)
+                yield from retire(push(idx, pick(logits, idx)))
+            if not active:
+                if exhausted:
+                    return
+                continue
+            pos = mask.sum(dim=1, keepdim=True)  # real tokens so far = next position
+            mask = torch.cat([mask, mask.new_ones(len(active), 1)], dim=1)
+            logits = lm(input_ids=last[:, None], attention_mask=mask, position_ids=pos,
+                        past_key_values=cache, use_cache=True).logits[:, -1]
+            idx = list(range(len(active)))
+            yield from retire(push(idx, pick(logits, idx)))
+
+
+def _caption_stream(chunks: Iterable[List[Path]],
+                    prompt: str | List[str],
+                    temperature: float,
+                    top_p: float,
+                    max_new_tokens: int,
+                    prefetch: int,
+                    constrain_tags: bool | List[bool] = False,
+                    budgets: List[int | None] | None = None,
+                    loop_stop: bool = False,
+                    slots: int = 0):
+    """
+    Caption <chunks> in this process.  Yields one
+    (worker, chunk, [(path, caption, info)], [(path, error)], stage_seconds, n_cached)
+    tuple per batch; failures are reported, never raised.  info holds the
+    image digest ("hash") and per-prompt "prompt_tokens" /
+    "completion_tokens" / "finish_reason" lists (None / "cached" for cached
+    captions).  With greedy settings, (image, prompt) pairs found in the
+    CaptionCache skip generation.
+    <constrain_tags> restricts decoding to the tag list (_tag_logits_processor).
+
+    Given a list of prompts (and optionally one constrain flag per prompt),
+    each image is decoded and run through the vision tower once, and all
+    of its prompts are generated in the same batch; captions are then
+    lists in prompt order.  Features found in the FeatureCache skip
+    preprocessing and the vision tower altogether.
+
+    <budgets> caps each prompt's tokens (token_budget) and <loop_stop> ends
+    rows caught repeating themselves (_early_stopping).  With <slots> > 0
+    rows are decoded by _generate_continuous with that many in flight, so
+    batches finish out of order as soon as all their rows are done.
+    """
+    import torch
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+    constrain = (list(constrain_tags) if isinstance(constrain_tags, (list, tuple))
+                 else [bool(constrain_tags)] * len(prompts))
+    budgets = [b if b is not None and b < max_new_tokens else None
+               for b in (budgets or [None] * len(prompts))]
+    cache = get_caption_cache() if CaptionCache.cacheable(temperature) else None
+    feature_cache = get_feature_cache()
+    index = load_tag_index() if any(constrain) else None
+
+    def load(chunk, loaded) -> dict:
+        """Caption-cache lookups and shared vision features for one loaded chunk."""
+        ok, pixel_values, errors, t_decode, t_preprocess, digests, stored = loaded
+        job = {"chunk": chunk, "ok": ok, "errors": errors, "digests": digests, "failed": {},
+               "results": [[None] * len(prompts) for _ in ok],
+               "stats": [[{"prompt_tokens": None, "completion_tokens": None,
+                           "finish_reason": "cached"}] * len(prompts) for _ in ok],
+               "keys": {}, "features": {}, "decode": t_decode, "preprocess": t_preprocess}
+        for i in range(len(ok) if cache is not None else 0):
+            for j, text in enumerate(prompts):
+                job["keys"][i, j] = cache.key(digests[i], BATCH_SYSTEM_PROMPT, text,
+                                              budgets[j] or max_new_tokens, constrain[j], loop_stop)
+                job["results"][i][j] = cache.get(job["keys"][i, j])
+        job["n_cached"] = sum(None not in r for r in job["results"])
+        job["todo"] = [(i, j) for i, r in enumerate(job["results"])
+                       for j, c in enumerate(r) if c is None]
+        images = sorted({i for i, _ in job["todo"]})
+        if images:
+            try:
+                # Vision tower once per image, its features shared by every prompt
+                stored = stored or [None] * len(ok)
+                pixel_row = {i: n for n, i in enumerate(i for i, f in enumerate(stored) if f is None)}
+                need = [i for i in images if stored[i] is None]
+                fresh = _image_features(pixel_values[[pixel_row[i] for i in need]]) if need else []
+                for i, f in zip(need, fresh):
+                    job["features"][i] = f
+                    if feature_cache is not None:
+                        feature_cache.put(digests[i], f)
+                for i in images:
+                    if stored[i] is not None:
+                        job["features"][i] = stored[i].to(model.device, model.dtype)
+            except Exception as e:
+                job["failed"].update((i, f"{type(e).__name__}: {e}") for i in images)
+                job["todo"] = []
+        return job
+
+    def store(job: dict, i: int, j: int, caption: str, stats: dict):
+        job["results"][i][j], job["stats"][i][j] = caption, stats
+        if cache is not None:
+            cache.put(job["keys"][i, j], caption)
+
+    def finish(job: dict):
+        done = [(p, r if len(prompts) > 1 else r[0],
+                 {"hash": digest,
+                  **{k: [s[k] for s in stats]
+                     for k in ("prompt_tokens", "completion_tokens", "finish_reason")}})
+                for i, (p, r, stats, digest) in enumerate(zip(job["ok"], job["results"],
+                                                             job["stats"], job["digests"]))
+                if i not in job["failed"] and None not in r]
+        errors = job["errors"] + [(job["ok"][i], err) for i, err in sorted(job["failed"].items())]
+        return done, errors
+
+    # Held while batches are in flight, so swaps / idle unloads wait for them
+    with model_manager.in_use():
+        loaded_chunks = _prefetch(chunks, prefetch, digests=True, features=feature_cache is not None)
+        if slots:
+            yield from _caption_stream_continuous(loaded_chunks, load, store, finish, prompts,
+                                                  budgets, constrain, temperature, top_p,
+                                                  max_new_tokens, loop_stop, index, slots)
+            return
+
+        t_wait = time.perf_counter()
+        for chunk, loaded in loaded_chunks:
+            t0 = time.perf_counter()
+            job = load(chunk, loaded)
+            todo = job["todo"]
+            if todo:
+                try:
+                    features = torch.stack([job["features"][i] for i, _ in todo])
+                    inputs = _encode_batch([prompts[j] for _, j in todo], None,
+                                           image_features=features)
+                    extra = ({"logits_processor": _tag_logits_processor(
+                                index, rows=None if all(constrain) else [constrain[j] for _, j in todo])}
+                             if index else {})
+                    row_budgets = [budgets[j] for _, j in todo]
+                    if loop_stop or any(b is not None for b in row_budgets):
+                        extra["early_stop"] = _early_stopping(row_budgets, loop_stop)
+                    limit = max_new_tokens if None in row_budgets else max(row_budgets)
+                    stats = []
+                    captions = _generate_batch(inputs, temperature, top_p, limit,
+                                               row_stats=stats, **extra)
+                    for (i, j), caption, row_stats in zip(todo, captions, stats):
+                        store(job, i, j, caption, row_stats)
+                except Exception as e:
+                    job["failed"].update((i, f"{type(e).__name__}: {e}") for i, _ in todo)
+            done, errors = finish(job)
+            stages = {"wait": t0 - t_wait, "decode": job["decode"],
+                      "preprocess": job["preprocess"], "generate": time.perf_counter() - t0}
+            yield "local", chunk, done, errors, stages, job["n_cached"]
+            t_wait = time.perf_counter()
+
+
+def _caption_stream_continuous(loaded_chunks, load, store, finish, prompts, budgets, constrain,
+                               temperature, top_p, max_new_tokens, loop_stop, index, slots):
+    """
+    _caption_stream's continuous-batching path: rows of every loaded chunk
+    feed one _generate_continuous loop, and a chunk is yielded once all of
+    its rows are done.  Stage "generate" is the decode time since the
+    previous yield.
+    """
+    ready: deque = deque()
+
+    def rows():
+        for chunk, loaded in loaded_chunks:
+            job = load(chunk, loaded)
+            job["pending"] = len(job["todo"])
+            if not job["todo"]:
+                ready.append(job)
+                yield None
+            for i, j in job["todo"]:
+                yield {"job": job, "i": i, "j": j, "features": job["features"][i],
+                       "prompt": prompts[j], "budget": budgets[j], "constrain": constrain[j]}
+
+    def settle(row: dict, caption: str | None = None, stats: dict | None = None,
+               error: str | None = None):
+        job = row["job"]
+        if error is None:
+            store(job, row["i"], row["j"], caption, stats)
+        else:
+            job["failed"][row["i"]] = error
+        job["pending"] -= 1
+        if not job["pending"]:
+            job["features"] = {}
+            ready.append(job)
+
+    source = rows()
+    t_mark = time.perf_counter()
+
+    def emit(job: dict):
+        nonlocal t_mark
+        done, errors = finish(job)
+        now = time.perf_counter()
+        stages = {"wait": 0.0, "decode": job["decode"], "preprocess": job["preprocess"],
+                  "generate": now - t_mark}
+        t_mark = now
+        return "local", job["chunk"], done, errors, stages, job["n_cached"]
+
+    while True:
+        active: list = []
+        try:
+            for row, caption, stats in _generate_continuous(source, slots, temperature, top_p,
+                                                            max_new_tokens, loop_stop, index,
+                                                            active):
+                if row is not None:
+                    settle(row, caption, stats)
+                while ready:
+                    yield emit(ready.popleft())
+            break
+        except Exception as e:  # fail what was in flight, carry on with the rest
+            for row in active:
+                settle(row, error=f"{type(e).__name__}: {e}")
+            while ready:
+                yield emit(ready.popleft())
+    while ready:
+        yield emit(ready.popleft())
+
+
+def parse_devices(spec: str | Iterable[str] | None) -> List[str]:
+    """
+    "0,1" → ["cuda:0", "cuda:1"];  "cpu*4" → four CPU workers;  "cuda:0*2"
+    → two workers sharing GPU 0.  Empty means "caption in this process".
+    """
+    items = _split_patterns(spec)
+    devices = []
+    for item in items:
+        dev, _, count = item.partition("*")
+        dev = dev.strip().lower()
+        if dev.isdigit():
+            dev = f"cuda:{dev}"
+        elif dev == "cuda":
+            dev = "cuda:0"
+        devices += [dev] * (int(count) if count.strip() else 1)
+    return devices
+
+
+# Module settings main() takes from the command line; worker processes get
+# a snapshot (_runtime_config) so they run exactly like this one.
+RUNTIME_SETTINGS = ("model_tiny", "model_repo", "load_profile", "compile_model", "gpu_memory_gb",
+                    "speculative_draft", "caption_cache_mb", "feature_cache_gb", "tag_list_path",
+                    "fast_decode", "image_backend", "image_frame", "decode_threads")
+
+
+def _runtime_config() -> dict:
+    return {name: globals()[name] for name in RUNTIME_SETTINGS}
+
+
+def _batch_worker(worker: str,
+                  device: str,
+                  config: dict,
+                  threads: int | None,
+                  prompt: str | List[str],
+                  temperature: float,
+                  top_p: float,
+                  max_new_tokens: int,
+                  prefetch: int,
+                  constrain_tags: bool | List[bool],
+                  budgets: List[int | None] | None,
+                  loop_stop: bool,
+                  slots: int,
+                  tasks,
+                  results):
+    """
+    Worker-process entry point: own model copy, captions the (seq, chunk)
+    tasks on its own queue until a None sentinel and sends every result
+    back on its own pipe, tagged with the chunk's seq.
+    """
+    globals().update(config)
+    try:
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        load_model(device=device)
+        seqs = {}
+
+        def pull():
+            for seq, chunk in iter(tasks.get, None):
+                seqs[id(chunk)] = seq
+                yield chunk
+
+        for item in _caption_stream(pull(), prompt, temperature,
+                                    top_p, max_new_tokens, prefetch, constrain_tags,
+                                    budgets, loop_stop, slots):
+            results.send(("batch", seqs.pop(id(item[1]))) + item[1:])
+    except BaseException as e:
+        results.send(("fatal", f"{type(e).__name__}: {e}"))
+    finally:
+        results.send(("exit", None))
+        results.close()
+
+
+def _caption_stream_workers(chunks: Iterable[List[Path]],
+                            devices: List[str],
+                            prompt: str | List[str],
+                            temperature: float,
+                            top_p: float,
+                            max_new_tokens: int,
+                            prefetch: int,
+                            constrain_tags: bool | List[bool] = False,
+                            budgets: List[int | None] | None = None,
+                            loop_stop: bool = False,
+                            slots: int = 0):
+    """
+    Data-parallel _caption_stream: one spawned process (and model copy) per
+    entry in <devices>.  Each worker has its own task queue and result pipe;
+    a feeder thread hands the next chunk to the least busy worker with fewer
+    than <prefetch> + 2 outstanding, so faster workers simply take more of
+    them.  Results come back here so the caller remains the only writer of
+    captions and manifest.  A worker that dies (crash, OOM kill, fatal
+    error) takes only its own channels with it; the chunks it still held
+    are yielded with every image failed, so the next run retries them.
+    """
+    import multiprocessing as mp
+    from multiprocessing.connection import wait
+
+    ctx = mp.get_context("spawn")  # CUDA cannot be re-initialised in a fork
+    n_cpu = sum(d == "cpu" for d in devices)
+    threads = max(1, (os.cpu_count() or 1) // n_cpu) if n_cpu else None
+    procs, tasks, pipes = {}, {}, {}
+    for n, dev in enumerate(devices):
+        worker = f"{dev}#{n}"
+        tasks[worker] = ctx.Queue()
+        pipes[worker], child_end = ctx.Pipe(duplex=False)
+        procs[worker] = ctx.Process(
+            target=_batch_worker, daemon=True, name=f"joycaption-{worker}",
+            args=(worker, dev, _runtime_config(), threads if dev == "cpu" else None,
+                  prompt, temperature, top_p, max_new_tokens, prefetch, constrain_tags,
+                  budgets, loop_stop, slots, tasks[worker], child_end),
+        )
+        procs[worker].start()
+        child_end.close()  # so a dead worker's pipe reads as EOF here
+
+    credit = prefetch + 2
+    held: dict[str, dict[int, List[Path]]] = {w: {} for w in procs}  # live worker -> seq -> chunk
+    cond = threading.Condition()
+    stop = threading.Event()
+
+    def feed():
+        for seq, chunk in enumerate(chunks):
+            with cond:
+                while not stop.is_set() and not any(len(h) < credit for h in held.values()):
+                    cond.wait(timeout=0.2)
+                if stop.is_set() or not held:
+                    return
+                worker = min(held, key=lambda w: len(held[w]))
+                held[worker][seq] = chunk
+            tasks[worker].put((seq, chunk))
+        with cond:
+            for worker in held:
+                tasks[worker].put(None)
+
+    feeder = Thread(target=feed, daemon=True, name="joycaption-feeder")
+    feeder.start()
+
+    def drop(worker: str, error: str):
+        """Forget <worker>; its unfinished chunks come back as failed."""
+        with cond:
+            lost = held.pop(worker, {})
+            cond.notify_all()
+        pipes.pop(worker).close()
+        tasks[worker].cancel_join_thread()  # nobody reads it any more; do not block exit
+        for seq in sorted(lost):
+            yield (worker, lost[seq], [], [(p, f"worker {worker} {error}") for p in lost[seq]],
+                   dict.fromkeys(("wait", "decode", "preprocess", "generate"), 0.0), 0)
+
+    fatal = {}
+    try:
+        while pipes:
+            ready = wait(list(pipes.values()), timeout=1.0)
+            if not ready:
+                # Belt and braces: a worker that died without its pipe reading EOF
+                for worker in [w for w in pipes if not procs[w].is_alive()]:
+                    fatal.setdefault(worker, f"exited with code {procs[worker].exitcode}")
+                    print(f"❌ worker {worker} {fatal[worker]}", file=sys.stderr)
+                    yield from drop(worker, fatal[worker])
+                continue
+            for worker in [w for w, conn in pipes.items() if conn in ready]:
+                try:
+                    msg = pipes[worker].recv()
+                except (EOFError, OSError):  # killed hard (OOM killer, segfault)
+                    procs[worker].join(timeout=5)
+                    msg = ("exit", None)
+                    fatal.setdefault(worker, f"exited with code {procs[worker].exitcode}")
+                    print(f"❌ worker {worker} {fatal[worker]}", file=sys.stderr)
+                kind = msg[0]
+                if kind == "batch":
+                    with cond:
+                        held[worker].pop(msg[1], None)
+                        cond.notify_all()
+                    yield (worker,) + msg[2:]
+                elif kind == "fatal":
+                    fatal[worker] = msg[1]
+                    print(f"❌ worker {worker} failed: {msg[1]}", file=sys.stderr)
+                else:
+                    yield from drop(worker, f"failed: {fatal.get(worker, 'exited early')}")
+        if fatal and len(fatal) == len(procs):
+            raise RuntimeError("all batch workers failed: " +
+                               "; ".join(f"{w}: {e}" for w, e in fatal.items()))
+    finally:
+        stop.set()
+        for p in procs.values():
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+
+
+class CaptionSink(ABC):
+    """
+    Where run_batch puts finished records (one dict per image).  write()
+    takes a batch of (source, record) pairs and returns those now safely on
+    disk, which run_batch only then marks done in the Manifest, so a crash
+    never skips an image whose caption was still buffered.  close()
+    returns whatever remained buffered.  <tag> is added to the names of
+    shared output files, so work-queue shards never write the same file.
+    """
+
+    def __init__(self, out_dir: Path, labels: List[str] | None, tag: str = ""):
+        self.out_dir = out_dir
+        self.labels = labels  # None: single job ("caption"), else "captions" keys
+        self.tag = tag
+
+    def files(self, key: str) -> List[Path]:
+        """Files that must still exist for <key> to count as done."""
+        return []
+
+    def texts(self, record: dict) -> List[tuple[str, str]]:
+        """(suffix, caption) per job: (".txt", …) or (".<label>.txt", …)."""
+        if self.labels is None:
+            return [(".txt", record["caption"])]
+        return [(f".{label}.txt", record["captions"][label]) for label in self.labels]
+
+    @abstractmethod
+    def write(self, items: List[tuple]) -> List[tuple]:
+        ...
+
+    def close(self) -> List[tuple]:
+        return []
+
+
+class TxtSink(CaptionSink):
+    """One text file per image and job, mirroring the input tree (the original layout)."""
+
+    def files(self, key: str) -> List[Path]:
+        if self.labels is None:
+            return [self.out_dir / Path(key).with_suffix(".txt")]
+        return [self.out_dir / Path(key).with_suffix(f".{label}.txt") for label in self.labels]
+
+    def write(self, items: List[tuple]) -> List[tuple]:
+        for _, record in items:
+            for dest, (_, caption) in zip(self.files(record["path"]), self.texts(record)):
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                dest.write_text(caption, encoding="utf-8")
+        return items
+
+
+class JsonlSink(CaptionSink):
+    """Appends records to <out_dir>/captions<tag>.jsonl through a large buffer, flushed per batch."""
+
+    def __init__(self, out_dir: Path, labels: List[str] | None, tag: str = ""):
+        super().__init__(out_dir, labels, tag)
+        self._fh = (out_dir / f"captions{tag}.jsonl").open("a", encoding="utf-8",
+                                                           buffering=1 << 20)
+
+    def write(self, items: List[tuple]) -> List[tuple]:
+        for _, record in items:
+            self._fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._fh.flush()
+        return items
+
+    def close(self) -> List[tuple]:
+        self._fh.close()
+        return []
+
+
+class ParquetSink(CaptionSink):
+    """
+    Writes captions-<time>.parquet (one file per run, as Parquet cannot be
+    appended to) in row groups of <row_group> records.  Needs pyarrow.
+    """
+
+    def __init__(self, out_dir: Path, labels: List[str] | None, tag: str = "",
+                 row_group: int = 1024):
+        import importlib.util
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ModuleNotFoundError("Parquet output needs pyarrow: pip install pyarrow")
+        import pyarrow as pa
+        super().__init__(out_dir, labels, tag)
+
+        def per_job(t):
+            return pa.struct([(label, t) for label in labels]) if labels else t
+
+        self.schema = pa.schema([
+            ("path", pa.string()),
+            ("hash", pa.string()),
+            ("settings", pa.string()),  # JSON
+            ("prompts" if labels else "prompt", per_job(pa.string())),
+            ("captions" if labels else "caption", per_job(pa.string())),
+            ("prompt_tokens", per_job(pa.int64())),
+            ("completion_tokens", per_job(pa.int64())),
+            ("finish_reason", per_job(pa.string())),
+            ("generate_s", pa.float64()),
+            ("batch_size", pa.int64()),
+        ])
+        self.path = out_dir / (time.strftime("captions-%Y%m%d-%H%M%S") + f"{tag}.parquet")
+        self.row_group = max(1, row_group)
+        self._writer = None
+        self._pending: List[tuple] = []
+
+    def _flush(self) -> List[tuple]:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self._pending:
+            return []
+        rows = [dict(record, settings=json.dumps(record["settings"], ensure_ascii=False))
+                for _, record in self._pending]
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        self._writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        flushed, self._pending = self._pending, []
+        return flushed
+
+    def write(self, items: List[tuple]) -> List[tuple]:
+        self._pending += items
+        return self._flush() if len(self._pending) >= self.row_group else []
+
+    def close(self) -> List[tuple]:
+        flushed = self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        return flushed
+
+
+class WebDatasetSink(CaptionSink):
+    """
+    WebDataset tar shards (captions-<time>-00000.tar, …) holding each image's
+    original bytes next to its caption(s) (<key>.txt or <key>.<label>.txt)
+    and record (<key>.json).  A new shard starts every <shard_size> images.
+    """
+
+    def __init__(self, out_dir: Path, labels: List[str] | None, tag: str = "",
+                 shard_size: int = 1000):
+        super().__init__(out_dir, labels, tag)
+        self.stem = time.strftime("captions-%Y%m%d-%H%M%S") + tag
+        self.shard_size = max(1, shard_size)
+        self._tar = None
+        self._shard = self._count = 0
+
+    @staticmethod
+    def sample_key(path: str) -> str:
+        # WebDataset splits a member name at the first '.' of its basename
+        folder, _, name = path.rpartition("/")
+        stem = os.path.splitext(name)[0].replace(".", "_")
+        return f"{folder}/{stem}" if folder else stem
+
+    def _add(self, name: str, data: bytes):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime = len(data), int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def write(self, items: List[tuple]) -> List[tuple]:
+        import tarfile
+        for src, record in items:
+            if self._tar is None or self._count >= self.shard_size:
+                if self._tar is not None:
+                    self._tar.close()
+                    self._shard += 1
+                self._tar = tarfile.open(self.out_dir / f"{self.stem}-{self._shard:05d}.tar", "w")
+                self._count = 0
+            key = self.sample_key(record["path"])
+            self._add(key + src.suffix.lower(), src.read_bytes())
+            for suffix, caption in self.texts(record):
+                self._add(key + suffix, caption.encode("utf-8"))
+            self._add(key + ".json", json.dumps(record, ensure_ascii=False).encode("utf-8"))
+            self._count += 1
+        if self._tar is not None:
+            self._tar.fileobj.flush()
+        return items
+
+    def close(self) -> List[tuple]:
+        if self._tar is not None:
+            self._tar.close()
+        return []
+
+
+OUTPUT_SINKS = {"txt": TxtSink, "jsonl": JsonlSink, "parquet": ParquetSink,
+                "webdataset": WebDatasetSink}
+OUTPUT_FORMATS = tuple(OUTPUT_SINKS)
+
+
+def parse_job(spec: str) -> tuple[str, str, list[str]]:
+    """
+    "Booru-like tag list | any | opt one; opt two" → (caption_type, length,
+    extra options).  Length defaults to "long"; the type may be given in
+    any case.
+    """
+    caption_type, _, rest = spec.partition("|")
+    length, _, options = rest.partition("|")
+    caption_type = caption_type.strip()
+    match = next((t for t in CAPTION_TYPE_MAP if t.lower() == caption_type.lower()), None)
+    if match is None:
+        raise ValueError(f"unknown caption type {caption_type!r} in job {spec!r}")
+    length = length.strip() or "long"
+    if not (length.isdigit() or length in CAPTION_LENGTH_CHOICES):
+        raise ValueError(f"unknown caption length {length!r} in job {spec!r}")
+    return match, length, [o.strip() for o in options.split(";") if o.strip()]
+
+
+def parse_jobs(text: str | Iterable[str] | None) -> List[tuple[str, str, list[str]]]:
+    """parse_job for each non-empty line (or item); '#' starts a comment line."""
+    lines = text.splitlines() if isinstance(text, str) else list(text or [])
+    return [parse_job(line) for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+
+def job_labels(jobs: List[tuple]) -> List[str]:
+    """
+    File-name-safe label per job: the caption type ("booru-like-tag-list"),
+    plus the length where a type repeats, plus an index if still ambiguous.
+    """
+    def slug(s) -> str:
+        return re.sub(r"[^a-z0-9]+", "-", str(s).lower()).strip("-")
+
+    types = [slug(t) for t, *_ in jobs]
+    labels = [f"{t}-{slug(length)}" if types.count(t) > 1 else t
+              for t, (_, length, *_) in zip(types, jobs)]
+    return [f"{label}-{n}" if labels.count(label) > 1 else label
+            for n, label in enumerate(labels)]
+
+
+def run_batch(in_dir: str,
+              caption_type: str,
+              caption_length: str | int,
+              extra_opts: list[str],
+              name_field: str,
+              temperature: float,
+              top_p: float,
+              max_new_tokens: int,
+              batch_size: int = 1,
+              prefetch: int = 2,
+              recursive: bool = True,
+              include: str | Iterable[str] | None = None,
+              exclude: str | Iterable[str] | None = None,
+              list_file: str | None = None,
+              devices: str | Iterable[str] | None = None,
+              tag_mode: str = "normalize",
+              jobs: str | Iterable[tuple] | None = None,
+              output_format: str = "txt",
+              early_stop: bool = True,
+              continuous: bool = False,
+              out_dir: str | Path | None = None,
+              tag: str = "",
+              stats: dict | None = None):
+    """
+    Iterate over all images in <in_dir> using *current* UI settings.
+    Images already captioned with the same settings (see Manifest) are skipped.
+
+    The folder is scanned recursively in the background while captioning
+    runs; captions mirror the input tree under <in_dir>/_joycaption_output.
+    With <list_file> ('-' for stdin) only the listed paths are captioned;
+    relative entries are resolved against <in_dir>.
+
+    <devices> (see parse_devices) shards the stream over worker processes,
+    each with its own model copy; otherwise this process's model is used.
+
+    Tag-list caption types are cleaned up against the tag list according to
+    <tag_mode> (TAG_MODES, see TagIndex.normalize / _tag_logits_processor).
+
+    <jobs> adds more (caption_type, caption_length, extra_opts) captions per
+    image (or parse_jobs text); every image is still decoded and encoded once.
+    With several jobs captions go to <stem>.<label>.txt (job_labels).
+
+    <output_format> picks the CaptionSink (OUTPUT_SINKS): txt files, or
+    records with path, hash, prompt, settings, caption, token counts and
+    timing in captions.jsonl, a Parquet file, or WebDataset tar shards.
+    <in_dir> may also be a tar shard spec (see expand_shards), read in place.
+
+    With <early_stop> each job is capped at the token_budget of its caption
+    length and rows caught looping end early; tokens saved against
+    <max_new_tokens> are reported.  <continuous> decodes with continuous
+    batching (_generate_continuous, batch_size × jobs rows in flight).
+
+    <out_dir> overrides <in_dir>/_joycaption_output; with a <tag> the
+    manifest and shared output files get it in their names, so several runs
+    can write into one folder (see queue_work).  <stats>, if given, is kept
+    updated with the running counts.
+    """
+    devices = parse_devices(devices)
+    if not devices:
+        load_model()
+    root = Path(in_dir)
+    if is_tar_spec(in_dir) and not list_file:
+        shards = expand_shards(in_dir)
+        if not shards or not all(p.is_file() for p in shards):
+            yield f"❌ No tar shards found for {in_dir}."
+            return
+        root = shards[0].parent
+        source = (m for shard in shards for m in iter_tar_shards(shard, include, exclude))
+    elif list_file:
+        source = iter_list_file(list_file, root, include, exclude)
+    elif root.is_dir():
+        source = iter_images(root, recursive, include, exclude)
+    else:
+        yield f"❌ {in_dir} is not a folder."
+        return
+
+    out_dir = Path(out_dir) if out_dir else root / OUTPUT_DIRNAME
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Same settings for every image, so the prompts only need building once
+    try:
+        jobs = parse_jobs(jobs) if isinstance(jobs, str) else list(jobs or [])
+    except ValueError as e:
+        yield f"❌ {e}"
+        return
+    jobs = [(caption_type, caption_length, extra_opts)] + jobs
+    prompts = [build_prompt(t, length, opts, name_field) for t, length, opts in jobs]
+    labels = job_labels(jobs)
+    if not any(t in TAG_CAPTION_TYPES for t, *_ in jobs):
+        tag_mode = "off"
+    if tag_mode != "off":
+        try:
+            load_tag_index()
+        except Exception as e:
+            yield f"⚠ Tag list unavailable ({type(e).__name__}: {e}) – writing tags unchecked."
+            tag_mode = "off"
+    job_tag_modes = [tag_mode if t in TAG_CAPTION_TYPES else "off" for t, *_ in jobs]
+    budgets = [token_budget(t, length, max_new_tokens) if early_stop else max_new_tokens
+               for t, length, _ in jobs]
+    # Workers load their own copies, so the profile comes from their devices then
+    profile = model_manager.profile or ",".join(sorted(
+        {_effective_profile(d, load_profile) for d in devices or [None]}))
+    generation = dict(model=model_id(), profile=profile, temperature=temperature, top_p=top_p,
+                      max_new_tokens=max_new_tokens,
+                      **({"tag_mode": tag_mode} if tag_mode != "off" else {}),
+                      **({} if early_stop else {"early_stop": False}))
+    settings = Manifest.settings_hash(
+        prompt=prompts[0] if len(jobs) == 1 else prompts, **generation,
+        **({"output": output_format} if output_format != "txt" else {}),
+    )
+    try:
+        sink = OUTPUT_SINKS[output_format](out_dir, None if len(jobs) == 1 else labels, tag)
+    except (KeyError, ModuleNotFoundError) as e:
+        yield f"❌ Output format {output_format!r} unavailable: {e}"
+        return
+    manifest = Manifest(out_dir, f"manifest{tag}.jsonl")
+
+    def make_record(p, captions: List[str], info: dict, generate_s: float, n_images: int) -> dict:
+        def one(values):
+            return values[0] if len(jobs) == 1 else dict(zip(labels, values))
+
+        prompt_key, caption_key = ("prompt", "caption") if len(jobs) == 1 else ("prompts", "captions")
+        return {
+            "path": _mirror_key(p, root),
+            "hash": info["hash"],
+            "settings": dict(generation, hash=settings),
+            prompt_key: one(prompts),
+            caption_key: one(captions),
+            "prompt_tokens": one(info["prompt_tokens"]),
+            "completion_tokens": one(info["completion_tokens"]),
+            "finish_reason": one(info["finish_reason"]),
+            "generate_s": round(generate_s / max(1, n_images), 4),  # batch share
+            "batch_size": n_images,
+        }
+
+    def commit(items: List[tuple]):
+        for p, record in items:
+            manifest.record(record["path"], p, settings)
+
+    scan = ScanAhead(source)
+    skipped = 0
+
+    def todo():
+        nonlocal skipped
+        for p in scan:
+            try:
+                key = _mirror_key(p, root)
+                done = manifest.is_done(key, p, settings, sink.files(key))
+            except OSError:
+                done = False  # missing file: let _load_batch record the error
+            if done:
+                skipped += 1
+            else:
+                yield p
+
+    # Cumulative seconds per stage, summed over workers.  decode/preprocess
+    # run on the prefetch threads; "wait" is how long generation sat idle
+    # waiting for them.
+    stages = dict.fromkeys(("wait", "decode", "preprocess", "generate", "write"), 0.0)
+    per_worker: dict[str, int] = {}
+
+    chunks = _chunked(todo(), max(1, int(batch_size)))
+    prefetch = max(0, int(prefetch))
+    gen_args = (prompts[0] if len(jobs) == 1 else prompts, temperature, top_p, max_new_tokens,
+                prefetch, [m == "constrained" for m in job_tag_modes],
+                [b if b < max_new_tokens else None for b in budgets], early_stop,
+                max(1, int(batch_size)) * len(jobs) if continuous else 0)
+    if devices:
+        stream = _caption_stream_workers(chunks, devices, *gen_args)
+    else:
+        stream = _caption_stream(chunks, *gen_args)
+
+    start = time.time()
+    i = failed = cached = saved = 0
+    try:
+        for worker, chunk, done, errors, batch_stages, n_cached in stream:
+            t0 = time.perf_counter()
+            items = []
+            for p, captions, info in done:
+                # Early stops, counted against running every row to max_new_tokens
+                saved += sum(max_new_tokens - n for n, why in zip(info["completion_tokens"],
+                                                                 info["finish_reason"])
+                             if why in ("budget", "loop"))
+                if len(jobs) == 1:
+                    captions = [captions]
+                captions = [postprocess_tags(c, t, m)
+                            for c, (t, *_), m in zip(captions, jobs, job_tag_modes)]
+                items.append((p, make_record(p, captions, info, batch_stages["generate"], len(chunk))))
+                metrics.log_event("caption", source="batch", path=str(p), worker=worker,
+                                  batch_size=len(chunk), chars=sum(map(len, captions)),
+                                  generate_s=round(batch_stages["generate"], 3))
+            try:
+                commit(sink.write(items))
+            except OSError as e:
+                errors = errors + [(p, f"write: {type(e).__name__}: {e}") for p, _ in items]
+            for p, err in errors:
+                manifest.record(_mirror_key(p, root), p, settings, error=err)
+                metrics.log_event("caption", source="batch", path=str(p), worker=worker, error=err)
+            for k, v in batch_stages.items():
+                stages[k] += v
+            stages["write"] += time.perf_counter() - t0
+            metrics.inc("joycaption_requests_total", len(chunk), path="batch")
+            metrics.inc("joycaption_errors_total", len(errors), stage="batch")
+            metrics.observe("joycaption_stage_seconds", time.perf_counter() - t0, stage="write")
+            if devices:  # worker processes keep their own (unexported) metrics
+                metrics.observe("joycaption_stage_seconds", batch_stages["generate"], stage="generate")
+
+            i += len(chunk)
+            failed += len(errors)
+            cached += n_cached
+            per_worker[worker] = per_worker.get(worker, 0) + len(chunk)
+            if stats is not None:
+                stats.update(images=i, failed=failed, skipped=skipped, cached=cached,
+                             tokens_saved=saved, found=scan.found)
+            # Total is a lower bound ("+") until the background scan finishes
+            total = scan.found - skipped
+            eta = (time.time() - start) / i * max(0, total - i)
+            timing = " · ".join(f"{k} {v:.1f}s" for k, v in stages.items())
+            if devices:
+                timing += " | " + " · ".join(f"{w} {n}" for w, n in sorted(per_worker.items()))
+            yield (f"{i}/{total}{'' if scan.finished else '+'} done "
+                   f"({failed} failed, {skipped} skipped, {cached} cached, {saved} tokens saved)"
+                   f" – ETA {int(eta)//60:02d}:{int(eta)%60:02d}  [{timing}]")
+    except (RuntimeError, ValueError) as e:  # ValueError: unreadable tar shard
+        yield f"❌ {e}"
+        return
+    finally:
+        stream.close()
+        scan.close()
+        commit(sink.close())
+        manifest.close()
+
+    if stats is not None:
+        stats.update(images=i, failed=failed, skipped=skipped, cached=cached,
+                     tokens_saved=saved, found=scan.found)
+    if not scan.found:
+        yield "❌ No images found."
+        return
+    yield (f"✅ Finished {i} images ({failed} failed, {skipped} skipped, {cached} cached, "
+           f"{saved} tokens saved) → {out_dir}")
+
+
+def benchmark_batching(n_images: int,
+                       batch_size: int,
+                       max_new_tokens: int = 32) -> dict:
+    """Time the per-image loop against batched generate() on synthetic images."""
+    load_model(tiny=True)
+    imgs = [Image.effect_noise((384, 384), 64).convert("RGB")
+            for _ in range(n_images)]
+    prompt = build_prompt("Descriptive", "long", [], "")
+    # Greedy and a fixed token count so both paths do identical work
+    fixed = {"min_new_tokens": max_new_tokens}
+    _caption_batch(imgs[:1], [prompt], 0.0, 0.9, max_new_tokens, **fixed)  # warm-up
+
+    start = time.time()
+    for img in imgs:
+        _caption_once(img, prompt, 0.0, 0.9, max_new_tokens, **fixed)
+    per_image = time.time() - start
+
+    start = time.time()
+    for lo in range(0, n_images, batch_size):
+        chunk = imgs[lo:lo + batch_size]
+        _caption_batch(chunk, [prompt] * len(chunk), 0.0, 0.9, max_new_tokens, **fixed)
+    batched = time.time() - start
+
+    # Shared-prefix KV reuse must not change greedy output
+    inputs = _encode_batch([prompt] * batch_size, _preprocess_images(imgs[:batch_size]))
+    prefix_ok = (_generate_batch(inputs, 0.0, 0.9, max_new_tokens, prefix_cache=True, **fixed)
+                 == _generate_batch(inputs, 0.0, 0.9, max_new_tokens, prefix_cache=False, **fixed))
+
+    return {
+        "images": n_images,
+        "batch_size": batch_size,
+        "prefix_cache_matches_greedy": prefix_ok,
+        "max_new_tokens": max_new_tokens,
+        "per_image_img_per_s": n_images / per_image,
+        "batched_img_per_s": n_images / batched,
+        "speedup": per_image / batched,
+    }
+
+
+def peak_memory_mb() -> dict:
+    """Process peak RSS and, on CUDA, peak allocated GPU memory (MiB)."""
+    import torch
+    out = {}
+    try:
+        # VmHWM starts afresh in an exec'd child; ru_maxrss carries the parent's over
+        with open("/proc/self/status") as f:
+            hwm = next(line for line in f if line.startswith("VmHWM:"))
+        out["cpu_peak_rss_mb"] = int(hwm.split()[1]) / 1024
+    except (OSError, StopIteration):
+        try:
+            import resource  # not on Windows
+            out["cpu_peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        except ImportError:
+            pass
+    if torch.cuda.is_available():
+        out["gpu_peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    return out
+
+
+def profile_report(n_images: int = 8, batch_size: int = 4, max_new_tokens: int = 64) -> dict:
+    """
+    Load the model with the current profile and report load time, weight
+    footprint, peak memory and decode throughput on synthetic images, for
+    deciding how many instances fit on a node.
+    """
+    import torch
+    t0 = time.perf_counter()
+    load_model()
+    load_s = time.perf_counter() - t0
+    imgs = [Image.effect_noise((384, 384), 64).convert("RGB") for _ in range(n_images)]
+    prompt = build_prompt("Descriptive", "long", [], "")
+    _caption_batch(imgs[:1], [prompt], 0.0, 0.9, 8)  # warm-up (and compile)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for lo in range(0, n_images, batch_size):
+        chunk = imgs[lo:lo + batch_size]
+        _caption_batch(chunk, [prompt] * len(chunk), 0.0, 0.9, max_new_tokens,
+                       min_new_tokens=max_new_tokens)  # fixed amount of work
+    elapsed = time.perf_counter() - start
+    return {
+        "profile": model_manager.profile,
+        "compiled": compile_model,
+        "device": str(model.device),
+        "load_s": round(load_s, 2),
+        "weights_mb": round(model.get_memory_footprint() / 2**20, 1),
+        "images": n_images,
+        "batch_size": batch_size,
+        "max_new_tokens": max_new_tokens,
+        "images_per_s": n_images / elapsed,
+        "tokens_per_s": n_images * max_new_tokens / elapsed,
+        **{k: round(v, 1) for k, v in peak_memory_mb().items()},
+    }
+
+
+def _bench_meta() -> dict:
+    """Environment of a benchmark run, so result files can be compared."""
+    import platform
+    import subprocess
+    import torch
+    import transformers
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=Path(__file__).parent, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit or None,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model_id(),
+        "profile": model_manager.profile,
+        "compiled": compile_model,
+        "device": str(model.device),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def run_benchmark(sizes: Iterable[int] = (256, 1024),
+                  batch_sizes: Iterable[int] = (1, 4),
+                  caption_types: Iterable[str] = ("Descriptive", "Booru-like tag list"),
+                  max_new_tokens: Iterable[int] = (32, 128),
+                  n_images: int = 8,
+                  ttft_runs: int = 3,
+                  speculative: int = 0,
+                  decode_mp: float = 0,
+                  log=None) -> dict:
+    """
+    Time the real build_prompt -> processor -> generate -> decode path on
+    synthetic images for every combination of the arguments.  Per config:
+    images/s, prefill time (a 1-token generate) vs per-token decode time,
+    the streaming chat_joycaption time-to-first-token (median, first run on a
+    new image, and repeats of the same image), and peak memory.
+    Generation is greedy with a fixed token count so runs are comparable;
+    the caption cache is bypassed.
+
+    With <speculative> draft tokens, single-image captions are also decoded
+    with _generate_speculative (free-running, no fixed count) and compared
+    to the plain path: speedup, draft acceptance rate, tokens per forward
+    pass and whether the greedy captions match.
+
+    With <decode_mp>, image loading is compared on synthetic photos of that
+    many megapixels: full-resolution decode vs load_image's fast path
+    (_bench_decode), ms/image and peak RSS each.
+    """
+    global caption_cache_mb
+    import statistics
+    import torch
+    load_model()
+    log = log or (lambda line: None)
+    results, spec = [], []
+    saved_cache_mb, caption_cache_mb = caption_cache_mb, 0
+    try:
+        for size in sizes:
+            imgs = [Image.effect_noise((size, size), 64).convert("RGB") for _ in range(n_images)]
+            for caption_type in caption_types:
+                prompt = build_prompt(caption_type, "long", [], "")
+                for tokens in max_new_tokens:
+                    _caption_batch(imgs[:1], [prompt], 0.0, 0.9, 4)  # warm-up
+                    ttft = []
+                    _pixel_cache.clear()  # the first run sees a new image
+                    for _ in range(ttft_runs):
+                        t0 = time.perf_counter()
+                        for _ in chat_joycaption(imgs[0], prompt, 0.0, 0.9, tokens):
+                            ttft.append(time.perf_counter() - t0)
+                            break  # closing the generator cancels the rest
+                    for batch_size in batch_sizes:
+                        n_batches = -(-n_images // batch_size)
+                        if torch.cuda.is_available():
+                            torch.cuda.reset_peak_memory_stats()
+                        prefill = decode = preprocess = 0.0
+                        start = time.perf_counter()
+                        for lo in range(0, n_images, batch_size):
+                            chunk = imgs[lo:lo + batch_size]
+                            t0 = time.perf_counter()
+                            inputs = _encode_batch([prompt] * len(chunk),
+                                                   _preprocess_images(chunk))
+                            t1 = time.perf_counter()
+                            _generate_batch(inputs, 0.0, 0.9, tokens, min_new_tokens=tokens)
+                            t2 = time.perf_counter()
+                            _generate_batch(inputs, 0.0, 0.9, 1)  # ≈ prefill only
+                            preprocess += t1 - t0
+                            prefill += time.perf_counter() - t2
+                            decode += t2 - t1
+                        # The 1-token probes are not part of the throughput
+                        elapsed = time.perf_counter() - start - prefill
+                        decode -= prefill
+                        row = {
+                            "image_size": size,
+                            "batch_size": batch_size,
+                            "caption_type": caption_type,
+                            "max_new_tokens": tokens,
+                            "images": n_images,
+                            "images_per_s": n_images / elapsed,
+                            "tokens_per_s": n_images * tokens / elapsed,
+                            "preprocess_ms_per_image": preprocess / n_images * 1000,
+                            "prefill_ms_per_batch": prefill / n_batches * 1000,
+                            "decode_ms_per_token": max(decode, 0.0) / (n_batches * tokens) * 1000,
+                            "ttft_ms": statistics.median(ttft) * 1000 if ttft else None,
+                            # New image vs the same image again (prompt edit / re-click)
+                            "ttft_first_ms": ttft[0] * 1000 if ttft else None,
+                            "ttft_repeat_ms": statistics.median(ttft[1:]) * 1000
+                            if len(ttft) > 1 else None,
+                            **peak_memory_mb(),
+                        }
+                        results.append(row)
+                        log(f"{size}px bs={batch_size} {caption_type!r} {tokens} tok: "
+                            f"{row['images_per_s']:.2f} img/s · "
+                            f"prefill {row['prefill_ms_per_batch']:.0f} ms · "
+                            f"decode {row['decode_ms_per_token']:.1f} ms/tok · "
+                            f"TTFT {row['ttft_ms']:.0f} ms (first {row['ttft_first_ms']:.0f} ms)")
+                    if speculative:  # free-running: no fixed token count
+                        spec.append(_bench_speculative(imgs, prompt, tokens, speculative))
+                        spec[-1].update(image_size=size, caption_type=caption_type)
+                        log(f"{size}px {caption_type!r} {tokens} tok speculative: "
+                            f"{spec[-1]['speedup']:.2f}x · accepted "
+                            f"{spec[-1]['acceptance_rate']:.0%} of drafts · "
+                            f"{spec[-1]['tokens_per_forward']:.2f} tok/forward · "
+                            f"{'matches' if spec[-1]['matches_greedy'] else 'DIFFERS from'} greedy")
+    finally:
+        caption_cache_mb = saved_cache_mb
+    decode = _bench_decode(decode_mp) if decode_mp else []
+    for full, fast in zip(decode[::2], decode[1::2]):
+        log(f"decode {full['megapixels']} MP {full['format']}: "
+            f"{full['ms_per_image']:.0f} → {fast['ms_per_image']:.0f} ms/img, peak RSS "
+            f"{full['peak_rss_mb']:.0f} → {fast['peak_rss_mb']:.0f} MB ({fast['backend']})")
+    return {"meta": _bench_meta(), "results": results,
+            **({"speculative": spec} if speculative else {}), **({"decode": decode} if decode else {})}
+
+
+def _bench_decode_child(paths: List[str], image_processor, fast: bool, backend: str, results):
+    """Spawned per mode so peak RSS is this mode's alone: load + preprocess each file."""
+    global processor, fast_decode, image_backend
+    from types import SimpleNamespace
+    processor = SimpleNamespace(image_processor=image_processor)  # no weights needed
+    fast_decode, image_backend = fast, backend
+    baseline = peak_memory_mb()["cpu_peak_rss_mb"]
+    start = time.perf_counter()
+    for p in paths:
+        _preprocess_images([load_image(Path(p))])
+    results.put({"ms_per_image": (time.perf_counter() - start) / len(paths) * 1000,
+                 "peak_rss_mb": round(peak_memory_mb()["cpu_peak_rss_mb"], 1),
+                 "baseline_rss_mb": round(baseline, 1)})
+
+
+def _bench_decode(megapixels: float, n_images: int = 4) -> List[dict]:
+    """
+    Decode + preprocess ms/image and peak RSS of full-resolution decoding vs
+    load_image's fast path, on synthetic JPEG and PNG photos of <megapixels>.
+    """
+    import multiprocessing as mp
+    import tempfile
+    side = int((megapixels * 1e6 / 12) ** 0.5)
+    size = (4 * side, 3 * side)
+    photo = Image.blend(Image.linear_gradient("L").resize(size).convert("RGB"),
+                        Image.effect_noise(size, 32).convert("RGB"), 0.3)
+    backend = "turbojpeg" if image_backend != "pil" and _get_turbojpeg() else "pil"
+    ctx = mp.get_context("spawn")
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="joycaption-decode-") as tmp:
+        for fmt in ("jpeg", "png"):
+            path = Path(tmp) / f"photo.{fmt}"
+            photo.save(path, **({"quality": 90} if fmt == "jpeg" else {"compress_level": 1}))
+            for mode, fast in (("full", False), ("fast", True)):
+                results = ctx.Queue()
+                proc = ctx.Process(target=_bench_decode_child,
+                                   args=([str(path)] * n_images, processor.image_processor,
+                                         fast, backend if fast else "pil", results))
+                proc.start()
+                row = results.get()
+                proc.join()
+                rows.append(dict(format=fmt, megapixels=round(size[0] * size[1] / 1e6, 1),
+                                 mode=mode, backend=backend if fast and fmt == "jpeg" else "pil",
+                                 images=n_images, **row))
+    return rows
+
+
+def _bench_speculative(imgs: List[Image.Image], prompt: str, max_new_tokens: int,
+                       n_draft: int) -> dict:
+    """Plain vs prompt-lookup greedy decoding of <imgs>, one image at a time."""
+    plain = fast = 0.0
+    totals = dict.fromkeys(("drafted", "accepted", "forwards", "completion_tokens"), 0)
+    same = True
+    for img in imgs:
+        inputs = _encode_batch([prompt], _preprocess_images([img]))
+        t0 = time.perf_counter()
+        ref = _generate_batch(inputs, 0.0, 0.9, max_new_tokens)[0]
+        t1 = time.perf_counter()
+        stats = {}
+        out = _generate_speculative(inputs, 0.0, 0.9, max_new_tokens, n_draft, stats=stats)
+        fast += time.perf_counter() - t1
+        plain += t1 - t0
+        same &= out == ref
+        for k in totals:
+            totals[k] += stats[k]
+    return {
+        "max_new_tokens": max_new_tokens,
+        "draft_tokens": n_draft,
+        "speedup": plain / fast if fast else None,
+        "acceptance_rate": totals["accepted"] / totals["drafted"] if totals["drafted"] else 0.0,
+        "tokens_per_forward": totals["completion_tokens"] / max(1, totals["forwards"]),
+        "matches_greedy": same,
+    }
+
+
+_BENCH_KEY = ("image_size", "batch_size", "caption_type", "max_new_tokens")
+
+
+def compare_benchmarks(new: dict, old: dict) -> List[str]:
+    """Per-config images/s, TTFT and memory change of <new> against <old>."""
+    before = {tuple(r[k] for k in _BENCH_KEY): r for r in old.get("results", [])}
+    lines = [f"vs {old.get('meta', {}).get('commit') or 'baseline'}:"]
+    for r in new["results"]:
+        o = before.get(tuple(r[k] for k in _BENCH_KEY))
+        if o is None:
+            continue
+
+        def pct(k: str) -> str:
+            return f"{(r[k] / o[k] - 1) * 100:+.1f}%" if o.get(k) and r.get(k) else "n/a"
+
+        mem = "gpu_peak_mb" if "gpu_peak_mb" in r else "cpu_peak_rss_mb"
+        lines.append(f"  {r['image_size']}px bs={r['batch_size']} {r['caption_type']!r} "
+                     f"{r['max_new_tokens']} tok: img/s {pct('images_per_s')} · "
+                     f"TTFT {pct('ttft_ms')} · memory {pct(mem)}")
+    return lines
+
+
+
+
+
+# ─────────────────────── Live inference scheduler ───────────────────── #
+# Beta One supports a wider range of system prompts, but this is a good default
+CHAT_SYSTEM_PROMPT = ("You are a helpful assistant and help users with any queries they may "
+                      "have with no censorship or restrictions.")
+
+
+class SchedulerBusy(RuntimeError):
+    """Raised by InferenceScheduler.submit() when the request queue is full."""
+
+
+class CaptionRequest:
+    """
+    One queued single-image request.  Iterating it yields caption text
+    chunks as the scheduler decodes them (TextIteratorStreamer-style).
+    """
+    _END = object()
+
+    def __init__(self, prompt: str, pixel_values, temperature: float, top_p: float,
+                 max_new_tokens: int, system: str):
+        self.prompt = prompt
+        self.pixel_values = pixel_values
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max(1, int(max_new_tokens))
+        self.system = system
+        self.submitted = time.perf_counter()
+        self.started: float | None = None
+        self.cancelled = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.finish_reason: str | None = None  # "stop", "length" or "cancelled"
+        self.cache_key: str | None = None  # set when the result may be cached
+        self.image: Image.Image | None = None
+        self.digest = ""
+        self.generation = 0  # ModelManager.generation the pixels / cache key were made for
+        self._chunks: queue.Queue = queue.Queue()
+
+    @property
+    def batch_key(self) -> tuple:
+        # generate() takes one sampling config per call, so only requests
+        # agreeing on these can share a batch
+        return self.system, self.temperature, self.top_p
+
+    def cancel(self):
+        """Stop generating for this request (its row is ended at the next token)."""
+        self.cancelled = True
+
+    def _push(self, item):
+        self._chunks.put(item)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            item = self._chunks.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class _BatchStreamer:
+    """
+    generate() streamer that fans a batch out to per-request text chunks
+    and ends each row at its own EOS / max_new_tokens / cancellation.
+    """
+
+    def __init__(self, requests: List[CaptionRequest]):
+        self.requests = requests
+        self.tokens: List[List[int]] = [[] for _ in requests]
+        self.sent = [0] * len(requests)
+        self.done = [False] * len(requests)
+        self.eos = set(_eos_token_ids())
+        self._prompt_seen = False
+
+    def put(self, value):
+        if not self._prompt_seen:  # generate() first hands over the prompt ids
+            self._prompt_seen = True
+            return
+        for i, tok in enumerate(value.reshape(-1).tolist()):
+            if self.done[i]:
+                continue
+            req = self.requests[i]
+            if tok in self.eos:
+                self._finish(i, "stop")
+                continue
+            self.tokens[i].append(tok)
+            text = processor.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+            if not text.endswith("\ufffd"):  # wait for the rest of a multi-byte char
+                if len(text) > self.sent[i]:
+                    req._push(text[self.sent[i]:])
+                self.sent[i] = len(text)
+            if req.cancelled:
+                self._finish(i, "cancelled")
+            elif len(self.tokens[i]) >= req.max_new_tokens:
+                self._finish(i, "length")
+
+    def _finish(self, i: int, reason: str):
+        req = self.requests[i]
+        self.done[i] = True
+        req.completion_tokens = len(self.tokens[i])
+        req.finish_reason = reason
+        text = processor.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+        if len(text) > self.sent[i]:
+            req._push(text[self.sent[i]:])
+        if req.cache_key and reason != "cancelled":
+            get_caption_cache().put(req.cache_key, text)
+        self.requests[i]._push(CaptionRequest._END)
+
+    def end(self):
+        for i, done in enumerate(self.done):
+            if not done:
+                self._finish(i, "length")
+
+
+def _eos_token_ids() -> List[int]:
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = processor.tokenizer.eos_token_id
+    return list(eos) if isinstance(eos, (list, tuple)) else [eos]
+
+
+def _row_stopping_criteria(requests: List[CaptionRequest]):
+    """Per-row stop: each request's own token budget or cancellation."""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class RowLimits(StoppingCriteria):
+        def __init__(self):
+            self.steps = 0
+
+        def __call__(self, input_ids, scores, **kwargs):
+            self.steps += 1
+            return torch.tensor([r.cancelled or self.steps >= r.max_new_tokens for r in requests],
+                                device=input_ids.device)
+
+    return StoppingCriteriaList([RowLimits()])
+
+
+class InferenceScheduler:
+    """
+    Owns generate() for the interactive path.  Single-image requests are
+    queued; a background thread waits up to <window_ms> after the oldest
+    one for others with the same sampling settings and runs them as one
+    batch of at most <max_batch>, streaming every row back to its caller.
+    More than <max_queue> waiting requests are rejected (SchedulerBusy)
+    instead of piling up behind the GPU.
+    """
+
+    def __init__(self, max_batch: int = 8, window_ms: float = 25, max_queue: int = 64):
+        self.max_batch = max(1, int(max_batch))
+        self.window = max(0.0, window_ms) / 1000
+        self.max_queue = max(1, int(max_queue))
+        self._pending: deque[CaptionRequest] = deque()
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._served = self._batches = self._rejected = 0
+        self._wait_total = self._wait_last = self._wait_max = 0.0
+        self._batch_last = 0
+        self._thread = Thread(target=self._loop, daemon=True, name="joycaption-scheduler")
+        self._thread.start()
+
+    def submit(self, image: Image.Image, prompt: str, temperature: float, top_p: float,
+               max_new_tokens: int, system: str = CHAT_SYSTEM_PROMPT) -> CaptionRequest:
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                self._rejected += 1
+                metrics.inc("joycaption_rejected_total")
+                raise SchedulerBusy(f"Server busy – {len(self._pending)} requests queued, "
+                                    "please try again shortly.")
+        image = image.convert("RGB")
+        digest = image_digest(image)
+        request = CaptionRequest(prompt, None, temperature, top_p, max_new_tokens, system)
+        request.image, request.digest = image, digest
+        # Pixel preprocessing stays on the caller's thread, off the GPU loop,
+        # and is skipped for an image captioned moments ago.  in_use() keeps
+        # the model from being swapped or unloaded halfway through.
+        with model_manager.in_use():
+            self._prepare(request)
+            text = request.cache_key and get_caption_cache().get(request.cache_key)
+            if text is None:
+                request.pixel_values = _cached_pixels(image, digest)
+        if text is not None:
+            request.finish_reason = "stop"
+            request._push(text)
+            request._push(CaptionRequest._END)
+            return request
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        return request
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "served": self._served,
+                "rejected": self._rejected,
+                "batches": self._batches,
+                "last_batch_size": self._batch_last,
+                "avg_batch_size": round(self._served / self._batches, 2) if self._batches else 0.0,
+                "last_wait_ms": round(self._wait_last * 1000, 1),
+                "avg_wait_ms": round(self._wait_total / self._served * 1000, 1) if self._served else 0.0,
+                "max_wait_ms": round(self._wait_max * 1000, 1),
+            }
+
+    def _next_batch(self) -> List[CaptionRequest]:
+        with self._cond:
+            while True:
+                while self._pending and self._pending[0].cancelled:
+                    dropped = self._pending.popleft()
+                    dropped.finish_reason = "cancelled"
+                    dropped._push(CaptionRequest._END)
+                if self._pending:
+                    break
+                self._cond.wait()
+            head = self._pending[0]
+            deadline = head.submitted + self.window
+            while True:
+                batch = [r for r in self._pending
+                         if r.batch_key == head.batch_key and not r.cancelled][:self.max_batch]
+                remaining = deadline - time.perf_counter()
+                if len(batch) >= self.max_batch or remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+            for r in batch:
+                self._pending.remove(r)
+            now = time.perf_counter()
+            for r in batch:
+                r.started = now
+                wait = now - r.submitted
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                metrics.observe("joycaption_queue_wait_seconds", wait)
+            metrics.observe("joycaption_batch_size", len(batch),
+                            buckets=(1, 2, 4, 8, 16, 32, 64, float("inf")))
+            self._wait_last = now - head.submitted
+            self._in_flight = len(batch)
+            return batch
+
+    @staticmethod
+    def _prepare(request: CaptionRequest):
+        """Tie <request> to the loaded model (inside in_use()): its cache key and generation."""
+        cache = get_caption_cache() if CaptionCache.cacheable(request.temperature) else None
+        request.cache_key = cache and cache.key(request.digest, request.system, request.prompt,
+                                                request.max_new_tokens)
+        request.generation = model_manager.generation
+
+    def _run(self, batch: List[CaptionRequest]):
+        import torch
+        # Queued while another model was loaded: its pixels and cache key are stale
+        for r in batch:
+            if r.generation != model_manager.generation:
+                self._prepare(r)
+                r.pixel_values = _cached_pixels(r.image, r.digest)
+        inputs = _encode_batch([r.prompt for r in batch],
+                               torch.cat([r.pixel_values for r in batch]),
+                               system=batch[0].system)
+        for r, n in zip(batch, inputs["attention_mask"].sum(dim=1).tolist()):
+            r.prompt_tokens = n
+        streamer = _BatchStreamer(batch)
+        if speculative_draft and len(batch) == 1:
+            # Lone request: latency matters more than batching
+            streamer.put(inputs["input_ids"])
+            _generate_speculative(
+                inputs, batch[0].temperature, batch[0].top_p, batch[0].max_new_tokens,
+                on_token=lambda tok: streamer.put(torch.tensor([tok])) or streamer.done[0],
+            )
+        else:
+            _generate_batch(
+                inputs, batch[0].temperature, batch[0].top_p,
+                max(r.max_new_tokens for r in batch),
+                streamer=streamer,
+                stopping_criteria=_row_stopping_criteria(batch),
+                suppress_tokens=None,
+                top_k=None,
+            )
+        streamer.end()
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with model_manager.in_use():  # a swap / idle unload waits for this batch
+                    self._run(batch)
+            except Exception as e:
+                metrics.inc("joycaption_errors_total", len(batch), stage="generate")
+                for r in batch:
+                    r._push(e)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._served += len(batch)
+                    self._batches += 1
+                    self._batch_last = len(batch)
+
+
+scheduler: InferenceScheduler | None = None
+
+
+def get_scheduler(**options) -> InferenceScheduler:
+    """Process-wide scheduler, created on first use (options only apply then)."""
+    global scheduler
+    if scheduler is None:
+        scheduler = InferenceScheduler(**options)
+    return scheduler
+
+
+def server_status() -> dict:
+    """Snapshot for the UI status panel and GET /v1/status."""
+    cache, features = get_caption_cache(), get_feature_cache()
+    return {"model": model_id(), "loaded": model is not None,
+            "model_manager": model_manager.status(),
+            "scheduler": get_scheduler().stats(),
+            "caption_cache": cache.stats() if cache else None,
+            "feature_cache": features.stats() if features else None}
+
+
+def swap_model(repo: str) -> dict:
+    """UI action: start loading another checkpoint in the background."""
+    if repo and repo.strip() and repo.strip() != model_id():
+        model_manager.swap(repo.strip(), background=True)
+    return server_status()
+
+
+def unload_model() -> dict:
+    """UI action: free the model now; the next request loads it again."""
+    model_manager.unload()
+    return server_status()
+
+
+def chat_joycaption(
+    input_image: Image.Image,
+    prompt: str,
+    temperature: float,
+    top_p: float,
+    max_new_tokens: int,
+) -> Generator[str, None, None]:
+    """
+    Single-image streaming caption.  Requests from concurrent users are
+    batched together by the shared InferenceScheduler.
+    """
+    if input_image is None:
+        yield "No image provided. Please upload an image."
+        return
+
+    # if log_prompt:
+    #     print(f"PromptLog: {repr(prompt)}")
+
+    metrics.inc("joycaption_requests_total", path="chat")
+    start = time.perf_counter()
+    if not model_manager.ready:
+        yield "⏳ Loading the model…"  # submit() waits for it
+    try:
+        request = get_scheduler().submit(input_image, prompt, temperature, top_p, max_new_tokens)
+    except SchedulerBusy as e:
+        yield f"⏳ {e}"
+        return
+
+    outputs = []
+    first = None
+    try:
+        for text in request:
+            if first is None:
+                first = time.perf_counter()
+                metrics.observe("joycaption_ttft_seconds", first - start)
+            outputs.append(text)
+            yield "".join(outputs)
+    finally:
+        request.cancel()  # no-op once finished; frees the row if the user left
+        if metrics.log_stream is not None:
+            metrics.log_event(
+                "caption", source="chat",
+                cached=request.pixel_values is None,
+                queue_wait_ms=round((request.started - request.submitted) * 1000, 1)
+                if request.started else None,
+                ttft_ms=round((first - start) * 1000, 1) if first else None,
+                total_ms=round((time.perf_counter() - start) * 1000, 1),
+                prompt_tokens=request.prompt_tokens,
+                completion_tokens=request.completion_tokens,
+                finish_reason=request.finish_reason,
+            )
+
+# ─────────────────────────── Headless API ───────────────────────── #
+
+class Captioner:
+    """
+    Importable, UI-free front-end over build_prompt() + the batch helpers.
+    The model is loaded on the first caption call, not on construction.
+
+        cap = Captioner(caption_type="Booru-like tag list", caption_length="any")
+        cap.caption("cat.jpg")
+        for rec in cap.caption_many(Path("dataset").glob("*.png")):
+            print(rec["path"], rec.get("caption") or rec["error"])
+
+    With extra <jobs> (see parse_jobs) caption_many records carry
+    ``"captions": {label: caption}`` for all of them instead of "caption".
+    <early_stop> caps caption_many's jobs at their token_budget and ends
+    looping rows early (see run_batch).
+    """
+
+    def __init__(self,
+                 caption_type: str = "Descriptive",
+                 caption_length: str | int = "long",
+                 extra_options: Iterable[str] = (),
+                 name: str = "",
+                 temperature: float = 0.6,
+                 top_p: float = 0.9,
+                 max_new_tokens: int = 512,
+                 batch_size: int = 4,
+                 prefetch: int = 2,
+                 tiny: bool = False,
+                 tag_mode: str = "normalize",
+                 jobs: Iterable[tuple] = (),
+                 early_stop: bool = True):
+        self.prompt = build_prompt(caption_type, caption_length, list(extra_options), name)
+        self.caption_type = caption_type
+        self.tag_mode = tag_mode if caption_type in TAG_CAPTION_TYPES else "off"
+        self.jobs = [(caption_type, caption_length, list(extra_options))] + list(jobs)
+        self.prompts = [build_prompt(t, length, list(opts), name) for t, length, opts in self.jobs]
+        self.labels = job_labels(self.jobs)
+        self.tag_modes = [tag_mode if t in TAG_CAPTION_TYPES else "off" for t, *_ in self.jobs]
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = max(1, batch_size)
+        self.prefetch = max(0, prefetch)
+        self.tiny = tiny
+        self.early_stop = early_stop
+        self.budgets = [token_budget(t, length, max_new_tokens) if early_stop else None
+                        for t, length, _ in self.jobs]
+
+    def caption(self, image: str | Path | Image.Image) -> str:
+        """Caption one image given as a path or an already opened PIL image."""
+        load_model(tiny=self.tiny)
+        image = load_image(image if isinstance(image, Image.Image) else Path(image))
+        extra = ({"logits_processor": _tag_logits_processor(load_tag_index())}
+                 if self.tag_mode == "constrained" else {})
+        with model_manager.in_use():
+            caption = _caption_once(image, self.prompt,
+                                    self.temperature, self.top_p, self.max_new_tokens, **extra)
+        return postprocess_tags(caption, self.caption_type, self.tag_mode)
+
+    def caption_many(self, paths: Iterable[str | Path | TarMember]) -> Iterator[dict]:
+        """
+        Stream ``{"path", "caption"}`` (or ``{"path", "error"}``) records in
+        input order, batching and prefetching like run_batch.
+        """
+        load_model(tiny=self.tiny)
+        multi = len(self.jobs) > 1
+        chunks = _chunked((p if isinstance(p, TarMember) else Path(p) for p in paths),
+                          self.batch_size)
+        for _, chunk, done, errors, _, _ in _caption_stream(
+                chunks, self.prompts if multi else self.prompt, self.temperature, self.top_p,
+                self.max_new_tokens, self.prefetch, [m == "constrained" for m in self.tag_modes],
+                self.budgets, self.early_stop):
+            captions, failed = {p: c for p, c, _ in done}, dict(errors)
+            metrics.inc("joycaption_requests_total", len(chunk), path="caption")
+            metrics.inc("joycaption_errors_total", len(errors), stage="caption")
+            for p in chunk:
+                metrics.log_event("caption", source="caption", path=str(p), error=failed.get(p))
+                if p not in captions:
+                    yield {"path": str(p), "error": failed[p]}
+                elif multi:
+                    yield {"path": str(p), "captions": {
+                        label: postprocess_tags(c, t, m) for label, c, (t, *_), m
+                        in zip(self.labels, captions[p], self.jobs, self.tag_modes)}}
+                else:
+                    yield {"path": str(p),
+                           "caption": postprocess_tags(captions[p], self.caption_type, self.tag_mode)}
+
+
+def _iter_input_paths(args) -> Iterator[Path]:
+    """
+    Expand CLI inputs: folders are walked (see iter_images), tar shards are
+    read in place (iter_tar_shards), '-' reads a path list from stdin,
+    anything else is taken as an image file.
+    """
+    for item in args.inputs:
+        p = Path(item)
+        if item == "-":
+            yield from iter_list_file("-", None, args.include, args.exclude)
+        elif is_tar_spec(item):
+            yield from iter_tar_shards(item, args.include, args.exclude)
+        elif p.is_dir():
+            yield from iter_images(p, not args.no_recursive, args.include, args.exclude)
+        else:
+            yield p
+    if args.list:
+        yield from iter_list_file(args.list, None, args.include, args.exclude)
+
+
+def _cmd_caption(args) -> int:
+    captioner = Captioner(
+        caption_type=args.caption_type,
+        caption_length=args.caption_length,
+        extra_options=args.extra_option or (),
+        name=args.name,
+        temperature=args.temperature,
+        top_p=args.top_p,
+        max_new_tokens=args.max_new_tokens,
+        batch_size=args.batch_size,
+        prefetch=args.prefetch,
+        tiny=args.tiny,
+        tag_mode=args.tags,
+        jobs=args.job or (),
+        early_stop=not args.no_early_stop,
+    )
+    out = open(args.jsonl, "a", encoding="utf-8") if args.jsonl else sys.stdout
+    failed = 0
+    try:
+        for rec in captioner.caption_many(_iter_input_paths(args)):
+            failed += "error" in rec
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
+
+
+def _cmd_benchmark(args) -> int:
+    global model_tiny
+    model_tiny = args.tiny
+
+    def ints(spec: str) -> List[int]:
+        return [int(x) for x in spec.split(",") if x.strip()]
+
+    caption_types = [t.strip() for t in args.caption_types.split(",") if t.strip()]
+    unknown = [t for t in caption_types if t not in CAPTION_TYPE_MAP]
+    if unknown:
+        print(f"❌ Unknown caption types: {unknown}", file=sys.stderr)
+        return 2
+    report = run_benchmark(ints(args.sizes), ints(args.batch_sizes), caption_types,
+                           ints(args.max_new_tokens), max(1, args.images),
+                           speculative=speculative_draft, decode_mp=args.decode_mp,
+                           log=lambda line: print(line, file=sys.stderr, flush=True))
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        for line in compare_benchmarks(report, old):
+            print(line, file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+def _cmd_batch(args) -> int:
+    global model_tiny
+    model_tiny = args.tiny  # run_batch loads it here, or once per --devices worker
+    last = ""
+    for last in run_batch(
+        args.folder, args.caption_type, args.caption_length,
+        args.extra_option or [], args.name,
+        args.temperature, args.top_p, args.max_new_tokens,
+        batch_size=args.batch_size, prefetch=args.prefetch,
+        recursive=not args.no_recursive, include=args.include,
+        exclude=args.exclude, list_file=args.list, devices=args.devices,
+        tag_mode=args.tags, jobs=args.job, output_format=args.output_format,
+        early_stop=not args.no_early_stop, continuous=args.continuous,
+    ):
+        print(last, file=sys.stderr, flush=True)
+    return 0 if last.startswith("✅") else 1
+
+
+# ───────────────────────── Distributed work queue ───────────────────────── #
+# A queue is a folder on a shared filesystem; there is no coordinator.
+#
+#   job.json           settings every worker captions with (written last)
+#   todo/00042.txt     one shard: image paths, relative to the job's root
+#   claimed/00042.<worker>.txt   taken by os.rename (atomic: one winner)
+#   done/00042.txt + .json       finished, with the shard's counts
+#   failed/00042.txt + .json     run_batch gave up; move back to todo/ to retry
+#   workers/<worker>.json        progress, rewritten on every heartbeat
+#
+# A worker touches its claim every heartbeat; claims older than the stale
+# timeout (by the filesystem's clock, not the node's) go back to todo/.
+# Each shard keeps its own manifest-<shard>.jsonl under the output folder,
+# so a re-queued shard resumes where the dead worker left off.
+
+QUEUE_DIRS = ("todo", "claimed", "done", "failed", "workers")
+
+
+def _write_json(path: Path, data: dict):
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)  # readers on other nodes never see a partial file
+
+
+def _read_json(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _fs_now(queue_dir: Path) -> float:
+    """Current time on the shared filesystem's clock (mtime of a fresh file)."""
+    probe = queue_dir / f".now-{uuid.uuid4().hex}"
+    probe.touch()
+    try:
+        return probe.stat().st_mtime
+    finally:
+        probe.unlink(missing_ok=True)
+
+
+def queue_create(queue_dir: str | Path,
+                 inputs: Iterable[str],
+                 settings: dict,
+                 shard_size: int = 1000,
+                 output: str | Path | None = None,
+                 recursive: bool = True,
+                 include: str | Iterable[str] | None = None,
+                 exclude: str | Iterable[str] | None = None,
+                 list_file: str | None = None):
+    """
+    Split <inputs> (folders, image files) into shards of <shard_size> paths
+    under <queue_dir>/todo for queue_work.  <settings> are run_batch's
+    caption arguments (caption_type, …, output_format); captions go to
+    <output> (default <queue_dir>/output).
+    """
+    queue_dir = Path(queue_dir).resolve()
+    if (queue_dir / "job.json").exists():
+        yield f"❌ {queue_dir} already holds a job."
+        return
+    inputs = [Path(item).resolve() for item in inputs]
+    tars = [str(p) for p in inputs if is_tar_spec(str(p))]
+    if tars:
+        yield f"❌ Tar shards are not supported in a queue yet ({tars[0]}); use batch per shard."
+        return
+    root = Path(os.path.commonpath([p if p.is_dir() else p.parent for p in inputs]
+                                   or [Path.cwd()]))
+    for name in QUEUE_DIRS:
+        (queue_dir / name).mkdir(parents=True, exist_ok=True)
+
+    def paths():
+        for p in inputs:
+            if p.is_dir():
+                yield from iter_images(p, recursive, include, exclude)
+            else:
+                yield p
+        if list_file:
+            yield from iter_list_file(list_file, None, include, exclude)
+
+    def line(p: Path) -> str:
+        try:
+            return p.relative_to(root).as_posix()
+        except ValueError:
+            return p.resolve().as_posix()  # outside the root: keep it absolute
+
+    n_images = n_shards = 0
+    for n_shards, chunk in enumerate(_chunked(paths(), max(1, int(shard_size))), 1):
+        dest = queue_dir / "todo" / f"{n_shards - 1:05d}.txt"
+        tmp = dest.with_suffix(".tmp")
+        tmp.write_text("".join(line(p) + "\n" for p in chunk), encoding="utf-8")
+        os.replace(tmp, dest)
+        n_images += len(chunk)
+        if n_shards % 100 == 0:
+            yield f"{n_images} images in {n_shards} shards…"
+    if not n_images:
+        yield "❌ No images found."
+        return
+    _write_json(queue_dir / "job.json", {
+        **settings,
+        "model": model_repo, "tiny": bool(model_tiny), "tag_list": tag_list_path,
+        "root": str(root),
+        "output": str(Path(output).resolve() if output else queue_dir / "output"),
+        "shard_size": shard_size, "n_shards": n_shards, "n_images": n_images,
+        "created": time.time(),
+    })
+    yield f"✅ {n_images} images in {n_shards} shards → {queue_dir}"
+
+
+def _requeue_stale(queue_dir: Path, stale_s: float) -> List[str]:
+    """Move claims not touched for <stale_s> seconds back to todo/."""
+    now, requeued = _fs_now(queue_dir), []
+    for claim in (queue_dir / "claimed").glob("*.txt"):
+        shard = claim.name.split(".", 1)[0]
+        try:
+            if now - claim.stat().st_mtime > stale_s:
+                os.rename(claim, queue_dir / "todo" / f"{shard}.txt")
+                requeued.append(shard)
+        except FileNotFoundError:
+            pass  # finished, or another worker re-queued it first
+    return requeued
+
+
+def _claim_shard(queue_dir: Path, worker: str) -> Path | None:
+    for shard in sorted((queue_dir / "todo").glob("*.txt")):
+        claim = queue_dir / "claimed" / f"{shard.stem}.{worker}.txt"
+        try:
+            os.rename(shard, claim)
+        except FileNotFoundError:
+            continue  # another worker won it
+        os.utime(claim)  # rename keeps the old mtime; start the heartbeat clock now
+        return claim
+    return None
+
+
+def queue_work(queue_dir: str | Path,
+               batch_size: int = 1,
+               prefetch: int = 2,
+               device: str | None = None,
+               continuous: bool = False,
+               root: str | Path | None = None,
+               output: str | Path | None = None,
+               heartbeat_s: float = 30,
+               stale_s: float = 300,
+               max_shards: int = 0):
+    """
+    Claim shards from <queue_dir> and caption them with run_batch until the
+    queue is empty (or <max_shards> are done).  Any number of workers may
+    run, on any node that mounts the queue; <root> / <output> override the
+    job's paths where this node mounts them elsewhere.  Stops at the first
+    shard that fails, leaving it in failed/.
+    """
+    import socket
+    global model_tiny, model_repo, tag_list_path
+    queue_dir = Path(queue_dir).resolve()
+    job = _read_json(queue_dir / "job.json")
+    if job is None:
+        yield f"❌ {queue_dir} is not a queue (no job.json)."
+        return
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    # Every worker captions with the job's checkpoint, whatever its own flags
+    model_tiny, model_repo, tag_list_path = job["tiny"], job["model"], job["tag_list"]
+    load_model(device=device)  # before "started", so the rate leaves out load time
+    root = Path(root or job["root"])
+    output = Path(output or job["output"])
+    status_path = queue_dir / "workers" / f"{worker}.json"
+    status = {"worker": worker, "host": socket.gethostname(), "pid": os.getpid(),
+              "state": "running", "shard": None, "shards": 0, "images": 0,
+              "shard_images": 0, "images_per_s": 0.0, "started": time.time()}
+
+    def publish(stats: dict | None = None):
+        if stats is not None:
+            status["shard_images"] = stats.get("images", 0) + stats.get("skipped", 0)
+        elapsed = time.time() - status["started"]
+        captioned = status["images"] + (stats or {}).get("images", 0)
+        status.update(updated=time.time(), images_per_s=round(captioned / max(elapsed, 1e-6), 3))
+        _write_json(status_path, status)
+
+    shards = 0
+    try:
+        while not max_shards or shards < max_shards:
+            requeued = _requeue_stale(queue_dir, stale_s)
+            if requeued:
+                yield f"⚠ Re-queued stale shards {', '.join(requeued)}"
+            claim = _claim_shard(queue_dir, worker)
+            if claim is None:
+                busy = len(list((queue_dir / "claimed").glob("*.txt")))
+                if not busy:
+                    break
+                # Wait: a busy shard goes back to todo/ if its worker dies
+                status.update(state="waiting", shard=None)
+                publish()
+                time.sleep(heartbeat_s)
+                continue
+            shard = claim.name.split(".", 1)[0]
+            stats: dict = {}
+            lost, stop = threading.Event(), threading.Event()
+            status.update(state="running", shard=shard, shard_images=0)
+            publish(stats)
+
+            def beat():
+                while not stop.wait(heartbeat_s):
+                    try:
+                        os.utime(claim)
+                    except FileNotFoundError:
+                        lost.set()  # re-queued as stale: another worker owns it now
+                        return
+                    publish(stats)
+
+            beater = Thread(target=beat, daemon=True)
+            beater.start()
+            stream = run_batch(
+                str(root), job["caption_type"], job["caption_length"], job["extra_opts"],
+                job["name_field"], job["temperature"], job["top_p"], job["max_new_tokens"],
+                batch_size=batch_size, prefetch=prefetch, list_file=str(claim),
+                tag_mode=job["tag_mode"], jobs=job["jobs"], output_format=job["output_format"],
+                early_stop=job["early_stop"], continuous=continuous,
+                out_dir=output, tag=f"-{shard}", stats=stats,
+            )
+            last, finished = "", False
+            try:
+                for last in stream:
+                    yield f"[{shard}] {last}"
+                    if lost.is_set():
+                        break
+                finished = True
+            finally:
+                stream.close()
+                stop.set()
+                beater.join()
+                if not finished and not lost.is_set():  # interrupted: hand the shard back
+                    try:
+                        os.rename(claim, queue_dir / "todo" / f"{shard}.txt")
+                    except FileNotFoundError:
+                        pass
+            status["images"] += stats.get("images", 0)
+            if lost.is_set():
+                yield f"⚠ Lost the claim on shard {shard} (stale); moving on."
+                continue
+            state = "done" if last.startswith("✅") else "failed"
+            result = dict(stats, worker=worker, message=last, finished=time.time())
+            try:
+                os.rename(claim, queue_dir / state / f"{shard}.txt")
+            except FileNotFoundError:
+                yield f"⚠ Lost the claim on shard {shard} (stale); moving on."
+                continue
+            _write_json(queue_dir / state / f"{shard}.json", result)
+            if state == "failed":
+                yield f"❌ Shard {shard} failed: {last}"
+                return
+            shards += 1
+            status["shards"] = shards
+    finally:
+        status.update(state="exited", shard=None, shard_images=0)
+        publish()
+    yield f"✅ {worker}: {shards} shards, {status['images']} images."
+
+
+def queue_status(queue_dir: str | Path, stale_s: float = 300) -> dict:
+    """
+    Shard counts, images finished, combined throughput of the live workers
+    and ETA, from the files in <queue_dir>.
+    """
+    queue_dir = Path(queue_dir).resolve()
+    job = _read_json(queue_dir / "job.json")
+    if job is None:
+        raise FileNotFoundError(f"{queue_dir} is not a queue (no job.json)")
+    now = _fs_now(queue_dir)
+    shards = {name: len(list((queue_dir / name).glob("*.txt")))
+              for name in ("todo", "claimed", "done", "failed")}
+    finished = failed = 0
+    for state in ("done", "failed"):
+        for path in (queue_dir / state).glob("*.json"):
+            stats = _read_json(path) or {}
+            finished += stats.get("found", 0)
+            failed += stats.get("failed", 0)
+    workers = []
+    for path in sorted((queue_dir / "workers").glob("*.json")):
+        w = _read_json(path)
+        try:
+            age = now - path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if w is None:
+            continue
+        w["alive"] = w.get("state") != "exited" and age <= stale_s
+        workers.append(w)
+    live = [w for w in workers if w["alive"]]
+    in_progress = sum(w.get("shard_images", 0) for w in live if w.get("shard"))
+    rate = sum(w.get("images_per_s", 0.0) for w in live)
+    remaining = max(0, job["n_images"] - finished - in_progress)
+    return {
+        "queue": str(queue_dir),
+        "shards": dict(shards, total=job["n_shards"]),
+        "images": job["n_images"],
+        "images_done": finished,
+        "images_in_progress": in_progress,
+        "images_failed": failed,
+        "workers_alive": len(live),
+        "images_per_s": round(rate, 3),
+        "eta_s": round(remaining / rate) if rate else None,
+        "workers": [{k: w.get(k) for k in ("worker", "state", "shard", "shards", "images",
+                                           "images_per_s", "alive")} for w in workers],
+    }
+
+
+def _cmd_queue(args) -> int:
+    global model_tiny
+    if args.queue_command == "status":
+        try:
+            report = queue_status(args.queue_dir, stale_s=args.stale)
+        except FileNotFoundError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return 0
+    if args.queue_command == "create":
+        model_tiny = args.tiny
+        settings = dict(
+            caption_type=args.caption_type, caption_length=args.caption_length,
+            extra_opts=args.extra_option or [], name_field=args.name,
+            temperature=args.temperature, top_p=args.top_p, max_new_tokens=args.max_new_tokens,
+            tag_mode=args.tags, jobs=args.job or [], output_format=args.output_format,
+            early_stop=not args.no_early_stop,
+        )
+        stream = queue_create(args.queue_dir, args.inputs, settings, shard_size=args.shard_size,
+                              output=args.output, recursive=not args.no_recursive,
+                              include=args.include, exclude=args.exclude, list_file=args.list)
+    else:
+        stream = queue_work(args.queue_dir, batch_size=args.batch_size, prefetch=args.prefetch,
+                            device=args.device or None, continuous=args.continuous,
+                            root=args.root, output=args.output, heartbeat_s=args.heartbeat,
+                            stale_s=args.stale, max_shards=args.max_shards)
+    last = ""
+    for last in stream:
+        print(last, file=sys.stderr, flush=True)
+    return 0 if last.startswith("✅") else 1
+
+
+# ──────────────────────────── HTTP API ──────────────────────────── #
+API_MAX_IMAGES = 256  # per /v1/caption request
+API_MAX_NEW_TOKENS = 2048  # larger max_new_tokens / max_tokens are clamped (the UI slider's limit)
+
+
+def _decode_image(data: bytes | str) -> Image.Image:
+    """Raw bytes, base64 or a ``data:image/...;base64,`` URL -> RGB image."""
+    if isinstance(data, str):
+        if data.startswith("data:"):
+            data = data.partition(",")[2]
+        elif data.startswith(("http://", "https://")):
+            raise ValueError("remote image URLs are not fetched; send base64 or a data: URL")
+        data = base64.b64decode(data, validate=False)
+    return load_image(data)
+
+
+def _api_prompt(fields: dict) -> str:
+    """An explicit ``prompt`` wins; otherwise the same build_prompt() as the UI."""
+    if fields.get("prompt"):
+        return str(fields["prompt"])
+    caption_type = fields.get("caption_type") or "Descriptive"
+    if caption_type not in CAPTION_TYPE_MAP:
+        raise ValueError(f"unknown caption_type {caption_type!r}; "
+                         f"expected one of {list(CAPTION_TYPE_MAP)}")
+    extra = fields.get("extra_options") or []
+    if isinstance(extra, str):
+        extra = [extra]
+    return build_prompt(caption_type, str(fields.get("caption_length") or "long"),
+                        list(extra), fields.get("name") or "")
+
+
+def _caption_via_scheduler(images: List[Image.Image], prompt: str, temperature: float,
+                           top_p: float, max_new_tokens: int) -> List[str]:
+    """
+    Caption many images through the shared scheduler, one max_batch-sized wave
+    at a time so a large upload cannot fill the queue for everybody else.
+    """
+    sched = get_scheduler()
+    captions: List[str] = []
+    for wave in _chunked(images, sched.max_batch):
+        requests: List[CaptionRequest] = []
+        try:
+            for img in wave:
+                requests.append(sched.submit(img, prompt, temperature, top_p, max_new_tokens,
+                                             system=BATCH_SYSTEM_PROMPT))
+            for r in requests:
+                captions.append("".join(r).strip())
+        finally:
+            for r in requests:
+                r.cancel()
+    return captions
+
+
+def build_api():
+    """
+    FastAPI app exposing the loaded model over HTTP; mounted next to the
+    Gradio UI by main(), or served alone by the ``serve`` command.
+
+      POST /v1/caption           multipart ``image`` files or JSON ``images``
+                                 (base64 / data URLs) + build_prompt() fields
+      POST /v1/chat/completions  OpenAI-style, image_url parts, SSE if ``stream``
+      GET  /v1/models, /v1/status
+      GET  /v1/ready             503 while the model loads / warms up / swaps
+      POST /v1/models/load       {"model": repo or folder}: swap checkpoints
+      POST /v1/models/unload
+    """
+    from fastapi import FastAPI, HTTPException
+    from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.concurrency import run_in_threadpool
+
+    app = FastAPI(title="JoyCaption API")
+
+    @app.exception_handler(SchedulerBusy)
+    async def _busy(request, exc: SchedulerBusy):
+        return JSONResponse({"error": {"message": str(exc), "type": "server_busy"}},
+                            status_code=503, headers={"Retry-After": "1"})
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        if not metrics.enabled:
+            return PlainTextResponse("metrics disabled; start with --metrics\n", status_code=404)
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/v1/models")
+    def models():
+        return {"object": "list",
+                "data": [{"id": model_id(), "object": "model", "owned_by": "local"}]}
+
+    @app.get("/v1/status")
+    def status():
+        return server_status()
+
+    @app.get("/v1/ready")
+    def ready():
+        # 503 while loading, warming up, swapping or after a failed load.  An
+        # unloaded (idle) model is ready: the next request reloads it.
+        state = model_manager.status()
+        return JSONResponse(state, status_code=200 if state["state"] in ("ready", "unloaded")
+                            else 503)
+
+    @app.post("/v1/models/load")
+    def load_checkpoint(body: dict):
+        repo, tiny = str(body.get("model") or "").strip(), bool(body.get("tiny"))
+        if not repo and not tiny:
+            raise HTTPException(400, "give a model repo id or local folder in 'model'")
+        model_manager.swap(repo or model_repo, tiny, background=True)  # poll /v1/ready
+        return JSONResponse(model_manager.status(), status_code=202)
+
+    @app.post("/v1/models/unload")
+    def unload_checkpoint():
+        model_manager.unload()
+        return model_manager.status()
+
+    # Plain Starlette route: gets the raw request for JSON *or* multipart bodies
+    async def caption(request):
+        images: List[Image.Image | None] = []
+        errors: dict[int, str] = {}
+        if request.headers.get("content-type", "").startswith("multipart/"):
+            form = await request.form()
+            fields = {k: v for k, v in form.items() if isinstance(v, str)}
+            fields["extra_options"] = [v for v in form.getlist("extra_options") if isinstance(v, str)]
+            raw = [await f.read() for f in form.getlist("image") + form.getlist("images")
+                   if not isinstance(f, str)]
+        else:
+            try:
+                fields = await request.json()
+            except ValueError:
+                raise HTTPException(400, "expected multipart/form-data or a JSON body")
+            if not isinstance(fields, dict):
+                raise HTTPException(400, "the JSON body must be an object")
+            raw = fields.get("images") or ([fields["image"]] if fields.get("image") else [])
+        if not raw:
+            raise HTTPException(400, "no images supplied")
+        if len(raw) > API_MAX_IMAGES:
+            raise HTTPException(413, f"at most {API_MAX_IMAGES} images per request")
+        try:
+            prompt = _api_prompt(fields)
+            temperature = float(fields.get("temperature", 0.6))
+            top_p = float(fields.get("top_p", 0.9))
+            max_new_tokens = min(int(fields.get("max_new_tokens", 512)), API_MAX_NEW_TOKENS)
+            tag_mode = fields.get("tags") or "normalize"
+            if tag_mode not in TAG_MODES:
+                raise ValueError(f"tags must be one of {list(TAG_MODES)}")
+        except (TypeError, ValueError) as e:
+            raise HTTPException(400, str(e))
+        caption_type = fields.get("caption_type") or "Descriptive"
+
+        metrics.inc("joycaption_requests_total", len(raw), path="api")
+        start = time.perf_counter()
+        for i, data in enumerate(raw):
+            t0 = time.perf_counter()
+            try:
+                images.append(_decode_image(data))
+            except Exception as e:
+                images.append(None)
+                errors[i] = f"{type(e).__name__}: {e}"
+                metrics.inc("joycaption_errors_total", stage="image_load")
+            metrics.observe("joycaption_stage_seconds", time.perf_counter() - t0, stage="image_load")
+        ok = [i for i, img in enumerate(images) if img is not None]
+        texts = await run_in_threadpool(_caption_via_scheduler, [images[i] for i in ok],
+                                       prompt, temperature, top_p, max_new_tokens)
+        # The live scheduler does not constrain decoding; "constrained" acts as "strict"
+        if fields.get("prompt") or caption_type not in TAG_CAPTION_TYPES:
+            tag_mode = "off"
+        texts = [postprocess_tags(t, caption_type, "strict" if tag_mode == "constrained" else tag_mode)
+                 for t in texts]
+        captions = dict(zip(ok, texts))
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+        for i in range(len(raw)):
+            metrics.log_event("caption", source="api", index=i, images=len(raw),
+                              total_ms=elapsed_ms, error=errors.get(i))
+        return JSONResponse({
+            "model": model_id(),
+            "prompt": prompt,
+            "captions": [{"index": i, "caption": captions[i]} if i in captions
+                         else {"index": i, "error": errors[i]} for i in range(len(raw))],
+        })
+
+    app.add_route("/v1/caption", caption, methods=["POST"])
+
+    @app.post("/v1/chat/completions")
+    def chat_completions(body: dict):
+        system, prompt, image = CHAT_SYSTEM_PROMPT, "", None
+        # Single-turn model: system text + the last user message's text and image
+        for message in body.get("messages") or []:
+            content = message.get("content") or []
+            parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+            text = "\n".join(p.get("text", "") for p in parts if p.get("type") == "text")
+            if message.get("role") == "system":
+                system = text
+            elif message.get("role") == "user":
+                prompt = text
+                for p in parts:
+                    if p.get("type") == "image_url":
+                        url = p["image_url"]
+                        try:
+                            image = _decode_image(url["url"] if isinstance(url, dict) else url)
+                        except Exception as e:
+                            raise HTTPException(400, f"bad image_url: {type(e).__name__}: {e}")
+        if image is None:
+            raise HTTPException(400, "the last user message needs an image_url part")
+
+        request = get_scheduler().submit(
+            image, prompt,
+            float(body.get("temperature", 0.6)), float(body.get("top_p", 0.9)),
+            min(int(body.get("max_completion_tokens") or body.get("max_tokens") or 512),
+                API_MAX_NEW_TOKENS),
+            system=system,
+        )
+        cid, created = f"chatcmpl-{uuid.uuid4().hex}", int(time.time())
+
+        def chunk(delta: dict, finish_reason: str | None = None) -> str:
+            return "data: " + json.dumps({
+                "id": cid, "object": "chat.completion.chunk", "created": created,
+                "model": model_id(),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }, ensure_ascii=False) + "\n\n"
+
+        def finish_reason() -> str:
+            return "length" if request.finish_reason == "length" else "stop"
+
+        def events():
+            try:
+                yield chunk({"role": "assistant", "content": ""})
+                for text in request:
+                    yield chunk({"content": text})
+                yield chunk({}, finish_reason())
+                yield "data: [DONE]\n\n"
+            finally:
+                request.cancel()
+
+        if body.get("stream"):
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        try:
+            text = "".join(request)
+        finally:
+            request.cancel()
+        return {
+            "id": cid, "object": "chat.completion", "created": created, "model": model_id(),
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant", "content": text.strip()},
+                         "finish_reason": finish_reason()}],
+            "usage": {"prompt_tokens": request.prompt_tokens,
+                      "completion_tokens": request.completion_tokens,
+                      "total_tokens": request.prompt_tokens + request.completion_tokens},
+        }
+
+    return app
+
+
+# ──────────────────────────── Gradio UI ─────────────────────────── #
+def build_ui(batch_size: int = 4, prefetch: int = 2):
+    """Build the Gradio Blocks app; gradio is only imported here."""
+    import gradio as gr
+
+    with gr.Blocks(title="JoyCaption – local") as demo:
+        gr.HTML(TITLE)
+
+        gr.Markdown(
+            "<h2 style='text-align:center'>JoyCaption – local build</h2>"
+            "<p style='text-align:center'>Single image *or* folder batch-mode</p>"
+        )
+
+        with gr.Tabs():
+            # ──────────── Tab 1 – Single image (unchanged) ──────────── #
+            with gr.Tab("Single image"):
+                with gr.Row():
+                    with gr.Column():
+                        input_image = gr.Image(type="pil", label="Input Image", height=512, width=512)
+
+                        caption_type = gr.Dropdown(
+                            choices=list(CAPTION_TYPE_MAP.keys()),
+                            value="Descriptive",
+                            label="Caption Type",
+                        )
+
+                        caption_length = gr.Dropdown(
+                            choices=CAPTION_LENGTH_CHOICES,
+                            label="Caption Length",
+                            value="long",
+                        )
+
+                        with gr.Accordion("Extra Options", open=False):
+                            extra_options = gr.CheckboxGroup(
+                                choices=EXTRA_OPTIONS,
+                                label="Select one or more",
+                            )
+
+                        name_input = gr.Textbox(label="Person / Character Name", visible=False)
+
+                        with gr.Accordion("Generation settings", open=False):
+                            temperature_slider = gr.Slider(
+                                minimum=0.0, maximum=2.0, value=0.6, step=0.05,
+                                label="Temperature",
+                                info="Higher values make the output more random, lower values make it more deterministic."
+                            )
+                            top_p_slider = gr.Slider(
+                                minimum=0.0, maximum=1.0, value=0.9, step=0.01,
+                                label="Top-p"
+                            )
+                            max_tokens_slider = gr.Slider(
+                                minimum=1, maximum=2048, value=512, step=1,
+                                label="Max New Tokens",
+                                info="Maximum number of tokens to generate.  The model will stop generating if it reaches this limit."
+                            )
+
+                        # log_prompt = gr.Checkbox(value=True, label="Help improve JoyCaption by logging your text query")
+
+                    with gr.Column():
+                        prompt_box = gr.Textbox(lines=4, label="Prompt", interactive=True)
+
+                        # Show the name input box only when the specific option is selected
+                        extra_options.change(
+                            toggle_name_box,
+                            inputs=extra_options,
+                            outputs=name_input,
+                        )
+
+                        # Auto-update prompt box whenever any of the inputs change
+                        for ctrl in (caption_type, caption_length, extra_options, name_input):
+                            ctrl.change(
+                                build_prompt,
+                                inputs=[caption_type, caption_length, extra_options, name_input],
+                                outputs=prompt_box,
+                            )
+
+                        run_button = gr.Button("Caption")
+
+                        output_caption = gr.Textbox(label="Caption")
+
+                        with gr.Accordion("Server status", open=False):
+                            status_json = gr.JSON(label="Scheduler / caption cache")
+                            status_btn = gr.Button("Refresh", size="sm")
+                            status_btn.click(server_status, outputs=status_json)
+                            with gr.Row():
+                                checkpoint_in = gr.Textbox(
+                                    label="Checkpoint", value=model_id, scale=4,
+                                    placeholder="Hugging Face repo id or local folder",
+                                )
+                                swap_btn = gr.Button("Load", size="sm")
+                                unload_btn = gr.Button("Unload", size="sm")
+                            swap_btn.click(swap_model, inputs=checkpoint_in, outputs=status_json)
+                            unload_btn.click(unload_model, outputs=status_json)
+
+            # ──────────────────────── Batch tab UI wiring ───────────────────────
+            with gr.Tab("Batch folder"):
+                folder_in = gr.Textbox(
+                    label="Input folder",
+                    placeholder="C:\\path\\to\\images  or  /home/me/dataset  or  /data/shard-{000..099}.tar",
+                )
+                batch_size_slider = gr.Slider(
+                    minimum=1, maximum=64, value=batch_size, step=1,
+                    label="Batch size",
+                    info="Images captioned per generate() call.  Raise until VRAM runs out."
+                )
+                prefetch_slider = gr.Slider(
+                    minimum=0, maximum=16, value=prefetch, step=1,
+                    label="Prefetch depth",
+                    info="Batches decoded and preprocessed in the background while the model generates."
+                )
+                devices_in = gr.Textbox(
+                    label="Devices (optional)",
+                    placeholder="0,1  or  cpu*4  – one worker process + model copy each; empty = this app's model",
+                )
+                tag_mode_in = gr.Radio(
+                    choices=list(TAG_MODES), value="normalize",
+                    label="Tag cleanup (tag-list caption types)",
+                    info="normalize: dedupe, resolve aliases, sort · strict: also drop unknown tags · "
+                         "constrained: the model can only write known tags",
+                )
+                with gr.Row():
+                    early_stop_box = gr.Checkbox(
+                        value=True, label="Early stop",
+                        info="Cap tokens by caption length and end captions stuck in a loop",
+                    )
+                    continuous_box = gr.Checkbox(
+                        value=False, label="Continuous batching",
+                        info="Start new images as soon as others finish instead of per batch",
+                    )
+                with gr.Accordion("More caption types per image", open=False):
+                    jobs_in = gr.Textbox(
+                        lines=3, label="Extra jobs",
+                        placeholder="One per line: Caption Type | length | extra option; extra option\n"
+                                    "e.g.  Booru-like tag list | any",
+                        info="Captioned alongside the settings above; each image is decoded "
+                             "and encoded once.  Files become <name>.<type>.txt",
+                    )
+                    output_format_in = gr.Radio(
+                        choices=list(OUTPUT_FORMATS), value="txt", label="Output",
+                        info="txt files, or one record per image (path, hash, prompt, settings, "
+                             "caption, tokens, timing) in captions.jsonl, a Parquet file or "
+                             "WebDataset .tar shards that also hold the images",
+                    )
+                with gr.Accordion("Input selection", open=False):
+                    recursive_box = gr.Checkbox(value=True, label="Include sub-folders")
+                    include_in = gr.Textbox(
+                        label="Include globs",
+                        placeholder="*.png, characters/*  (comma separated; empty = all images)",
+                    )
+                    exclude_in = gr.Textbox(
+                        label="Exclude globs",
+                        placeholder="*_thumb.jpg, raw/*",
+                    )
+                    list_file_in = gr.Textbox(
+                        label="Path list file (optional)",
+                        placeholder="One image path per line; relative paths resolve against the input folder",
+                    )
+                run_batch_btn = gr.Button("Run batch caption")
+                progress_box = gr.Textbox(label="Progress / ETA", interactive=False)
+
+                run_batch_btn.click(
+                    run_batch,
+                    inputs=[
+                        folder_in,
+                        caption_type,  # ↓ all the same widgets as the single tab
+                        caption_length,
+                        extra_options,
+                        name_input,
+                        temperature_slider,
+                        top_p_slider,
+                        max_tokens_slider,
+                        batch_size_slider,
+                        prefetch_slider,
+                        recursive_box,
+                        include_in,
+                        exclude_in,
+                        list_file_in,
+                        devices_in,
+                        tag_mode_in,
+                        jobs_in,
+                        output_format_in,
+                        early_stop_box,
+                        continuous_box,
+                    ],
+                    outputs=progress_box,
+                )
+
+                run_button.click(
+                    chat_joycaption,
+                    inputs=[input_image, prompt_box, temperature_slider, top_p_slider, max_tokens_slider],
+                    outputs=output_caption,
+                    concurrency_limit=None,  # the scheduler batches / limits instead
+                )
+
+                # Initial prompt
+                prompt_box.value = build_prompt(caption_type.value, caption_length.value, extra_options.value,
+                                                name_input.value)
+
+                gr.Markdown(DESCRIPTION)
+
+    return demo
+
+
+# ────────────────────────────── CLI ─────────────────────────────── #
+def _subcommand_option(p: argparse.ArgumentParser):
+    """
+    add_argument for options the root parser also has: without a default on
+    the subcommand, a value given before it (``--tiny batch …``) survives.
+    """
+    return lambda *names, **kwargs: p.add_argument(*names, **dict(kwargs, default=argparse.SUPPRESS))
+
+
+def _add_runtime_args(p: argparse.ArgumentParser, subcommand: bool = False):
+    add = _subcommand_option(p) if subcommand else p.add_argument
+    add("--batch-size", type=int, default=4,
+        help="Images per generate() call in batch mode")
+    add("--prefetch", type=int, default=2,
+        help="Batches decoded/preprocessed ahead of generation")
+    add("--tiny", action="store_true",
+        help="Use the tiny random stand-in model on CPU (testing only)")
+    add("--model", default=MODEL_REPO, metavar="REPO|DIR",
+        help="JoyCaption checkpoint: Hugging Face repo id or local folder "
+             f"(default {MODEL_REPO})")
+    add("--profile", choices=LOAD_PROFILES, default="bf16",
+        help="Model load profile: bf16 on GPU, int8/int4 weight-only quantised "
+             "(bitsandbytes), offload (layers beyond --gpu-memory in CPU RAM), "
+             "or cpu")
+    add("--gpu-memory", type=float, metavar="GB",
+        help="GPU budget for --profile offload (default: 90%% of free memory)")
+    add("--compile", action="store_true",
+        help="torch.compile the language model; compiles on the first batches, "
+             "so check the gain with --profile-report")
+    add("--speculative", type=int, default=0, metavar="N",
+        help="Prompt-lookup speculative decoding with N draft tokens per step for "
+             "single-image captions (Caption-tab requests that do not share a batch, "
+             "Captioner.caption); greedy output is unchanged.  "
+             "benchmark then also reports speedup and acceptance rate")
+    add("--log-json", metavar="FILE",
+        help="Append one structured JSON line per caption here ('-' for stderr)")
+    add("--caption-cache-mb", type=float, default=512,
+        help="Size of the on-disk cache of greedy (temperature 0) captions; 0 disables")
+    add("--feature-cache-gb", type=float, default=0,
+        help="Keep projected image features on disk (memory-mapped) so re-captioning "
+             "the same images with new prompts skips the vision tower; 0 (default) "
+             "disables.  Roughly 6 MB per image with the bf16 model")
+    add("--full-decode", action="store_true",
+        help="Decode images at full resolution and let the image processor resize "
+             "them (default: reduced-scale JPEG decode, resized on the decode threads)")
+    add("--image-backend", choices=IMAGE_BACKENDS, default="auto",
+        help="JPEG decoder: turbojpeg needs PyTurboJPEG; auto uses it when installed")
+    add("--image-frame", choices=IMAGE_FRAMES, default="largest",
+        help="Frame of animations / multi-page TIFFs / ICOs to caption")
+    add("--decode-threads", type=int, default=0, metavar="N",
+        help="Images decoded in parallel within a batch (0: min(8, CPUs))")
+
+
+def _add_server_args(p: argparse.ArgumentParser, subcommand: bool = False):
+    add = _subcommand_option(p) if subcommand else p.add_argument
+    add("--port", type=int, default=None,
+        help="HTTP port (web UI and /v1 API; default 7860, 8000 for serve)")
+    add("--serve-max-batch", type=int, default=8,
+        help="Max concurrent single-image requests batched into one generate()")
+    add("--serve-window-ms", type=float, default=25,
+        help="How long the scheduler waits for more requests to batch")
+    add("--serve-max-queue", type=int, default=64,
+        help="Queued single-image requests before new ones are rejected")
+    add("--metrics", action="store_true",
+        help="Collect timing/counter metrics and export them on GET /metrics")
+    add("--idle-unload-min", type=float, default=0, metavar="MIN",
+        help="Unload the model after this many minutes without requests; "
+             "the next request loads it again (0 = keep it loaded)")
+    add("--no-warmup", action="store_true",
+        help="Skip the warm-up caption after loading the model")
+
+
+def _add_prompt_args(p: argparse.ArgumentParser):
+    p.add_argument("--caption-type", default="Descriptive",
+                   choices=list(CAPTION_TYPE_MAP))
+    p.add_argument("--caption-length", default="long",
+                   help="'any', a descriptor like 'short', or a word count")
+    p.add_argument("--extra-option", action="append", metavar="TEXT",
+                   help="Extra instruction appended to the prompt (repeatable)")
+    p.add_argument("--name", default="",
+                   help="Name used by the person/character extra option")
+    p.add_argument("--job", action="append", type=parse_job, metavar="TYPE|LENGTH|OPT;OPT",
+                   help="Extra caption of another type per image, sharing the image "
+                        "decode and vision encoding (repeatable), e.g. "
+                        "--job 'Booru-like tag list|any'")
+    p.add_argument("--tags", choices=TAG_MODES, default="normalize",
+                   help="Tag-list caption types: check output against the tag list "
+                        "(normalize: dedupe/alias/sort, strict: also drop unknown tags, "
+                        "constrained: only let the model write known tags)")
+    p.add_argument("--tag-list", metavar="FILE",
+                   help="Tag list (JSON or CSV) instead of the e621 master list")
+    p.add_argument("--temperature", type=float, default=0.6)
+    p.add_argument("--top-p", type=float, default=0.9)
+    p.add_argument("--max-new-tokens", type=int, default=512)
+    p.add_argument("--no-early-stop", action="store_true",
+                   help="Generate up to --max-new-tokens even for short caption lengths "
+                        "and rows stuck repeating themselves")
+
+
+def _add_input_args(p: argparse.ArgumentParser):
+    p.add_argument("--list", metavar="FILE",
+                   help="Text file of image paths, one per line ('-' for stdin)")
+    p.add_argument("--include", action="append", metavar="GLOB",
+                   help="Only caption paths matching this glob (repeatable)")
+    p.add_argument("--exclude", action="append", metavar="GLOB",
+                   help="Skip paths/folders matching this glob (repeatable)")
+    p.add_argument("--no-recursive", action="store_true",
+                   help="Do not descend into sub-folders")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="JoyCaption – launches the web UI unless a command is given."
+    )
+    _add_server_args(parser)
+    parser.add_argument("--profile-report", action="store_true",
+                        help="Load the model with --profile and print load time, memory "
+                             "and tokens/s as JSON, then exit")
+    parser.add_argument("--bench-batch", type=int, default=0, metavar="N",
+                        help="Compare per-image vs batched throughput on N synthetic "
+                             "images with a tiny CPU stand-in model, then exit")
+    _add_runtime_args(parser)
+
+    sub = parser.add_subparsers(dest="command")
+    cap = sub.add_parser("caption", help="Caption images headlessly (no Gradio)")
+    cap.add_argument("inputs", nargs="+",
+                     help="Image files, folders of images, or '-' to read paths from stdin")
+    cap.add_argument("--jsonl", metavar="FILE",
+                     help="Append JSONL records here instead of printing to stdout")
+    _add_input_args(cap)
+    _add_prompt_args(cap)
+    _add_runtime_args(cap, subcommand=True)
+
+    batch = sub.add_parser("batch", help="Headless equivalent of the Batch tab: "
+                                         "write <folder>/_joycaption_output/**.txt")
+    batch.add_argument("folder", help="Input folder (captions are written under it), or "
+                                      "uncompressed tar shards: a.tar, '*.tar', 'a-{000..099}.tar'")
+    batch.add_argument("--devices", default="",
+                       help="Shard over worker processes, one model copy each: "
+                            "'0,1' (GPUs), 'cpu*4' (CPU workers), 'cuda:0*2'")
+    batch.add_argument("--output-format", choices=OUTPUT_FORMATS, default="txt",
+                       help="txt: one caption file per image and job (<stem>.<type>.txt "
+                            "with --job); jsonl / parquet: one record per image with path, "
+                            "hash, prompt, settings, caption, tokens and timing; "
+                            "webdataset: tar shards of image + caption + record")
+    batch.add_argument("--continuous", action="store_true",
+                       help="Continuous batching: refill finished rows with new images "
+                            "mid-generation (batches may complete out of order)")
+    _add_input_args(batch)
+    _add_prompt_args(batch)
+    _add_runtime_args(batch, subcommand=True)
+
+    que = sub.add_parser("queue", help="Distributed batch job: shards in a shared folder, "
+                                       "claimed by any number of workers on any node")
+    que_sub = que.add_subparsers(dest="queue_command", required=True)
+    create = que_sub.add_parser("create", help="Split the inputs into shards and record the "
+                                               "caption settings in QUEUE_DIR/job.json")
+    create.add_argument("queue_dir", help="Queue folder on a filesystem every node mounts")
+    create.add_argument("inputs", nargs="+", help="Image folders or files")
+    create.add_argument("--shard-size", type=int, default=1000,
+                        help="Images per shard (the unit a worker claims)")
+    create.add_argument("--output", metavar="DIR",
+                        help="Caption output folder (default: QUEUE_DIR/output)")
+    create.add_argument("--output-format", choices=OUTPUT_FORMATS, default="txt")
+    _add_input_args(create)
+    _add_prompt_args(create)
+    _add_runtime_args(create, subcommand=True)
+    work = que_sub.add_parser("work", help="Caption claimed shards until the queue is empty")
+    work.add_argument("queue_dir")
+    work.add_argument("--device", default="",
+                      help="Model device for this worker ('cuda:1', 'cpu'); start one "
+                           "worker per GPU")
+    work.add_argument("--continuous", action="store_true",
+                      help="Continuous batching (see batch --continuous)")
+    work.add_argument("--root", metavar="DIR",
+                      help="Where this node mounts the job's input root, if elsewhere")
+    work.add_argument("--output", metavar="DIR",
+                      help="Where this node mounts the job's output folder, if elsewhere")
+    work.add_argument("--heartbeat", type=float, default=30, metavar="S",
+                      help="Seconds between claim / progress updates")
+    work.add_argument("--stale", type=float, default=300, metavar="S",
+                      help="Re-queue claims whose worker has not updated them for S seconds")
+    work.add_argument("--max-shards", type=int, default=0,
+                      help="Exit after this many shards (0: until the queue is empty)")
+    _add_runtime_args(work, subcommand=True)
+    status = que_sub.add_parser("status", help="Progress, throughput and ETA as JSON")
+    status.add_argument("queue_dir")
+    status.add_argument("--stale", type=float, default=300, metavar="S",
+                        help="Workers silent for S seconds count as dead")
+
+    bench = sub.add_parser("benchmark", help="Throughput / latency suite on synthetic images "
+                                             "(use --tiny to run on CPU without the weights)")
+    bench.add_argument("--sizes", default="256,1024",
+                       help="Comma-separated square image sizes")
+    bench.add_argument("--batch-sizes", default="1,4",
+                       help="Comma-separated batch sizes")
+    bench.add_argument("--caption-types", default="Descriptive,Booru-like tag list",
+                       help="Comma-separated CAPTION_TYPE_MAP keys")
+    bench.add_argument("--max-new-tokens", default="32,128",
+                       help="Comma-separated generation lengths")
+    bench.add_argument("--images", type=int, default=8,
+                       help="Synthetic images per configuration")
+    bench.add_argument("--decode-mp", type=float, default=24, metavar="MP",
+                       help="Also compare full vs fast image decoding on synthetic photos of "
+                            "this many megapixels (0 skips)")
+    bench.add_argument("--output", metavar="FILE",
+                       help="Write the JSON results here (default: stdout)")
+    bench.add_argument("--compare", metavar="FILE",
+                       help="Earlier --output file to print relative changes against")
+    _add_runtime_args(bench, subcommand=True)
+
+    serve = sub.add_parser("serve", help="HTTP API only (/v1/caption, /v1/chat/completions), "
+                                         "no Gradio UI")
+    serve.add_argument("--host", default="0.0.0.0")
+    _add_server_args(serve, subcommand=True)
+    _add_runtime_args(serve, subcommand=True)
+    return parser
+
+
+def main(argv: List[str] | None = None) -> int:
+    global caption_cache_mb, feature_cache_gb, tag_list_path, load_profile, compile_model, \
+        gpu_memory_gb, model_tiny, speculative_draft, model_repo, fast_decode, image_backend, \
+        image_frame, decode_threads
+    args = build_parser().parse_args(argv)
+    fast_decode, image_backend, image_frame = not args.full_decode, args.image_backend, args.image_frame
+    decode_threads = max(0, args.decode_threads)
+    model_repo = args.model
+    speculative_draft = max(0, args.speculative)
+    caption_cache_mb, feature_cache_gb = args.caption_cache_mb, args.feature_cache_gb
+    tag_list_path = getattr(args, "tag_list", None)
+    load_profile, compile_model, gpu_memory_gb = args.profile, args.compile, args.gpu_memory
+    metrics.enabled = getattr(args, "metrics", False)
+    if args.log_json:
+        metrics.log_stream = (sys.stderr if args.log_json == "-"
+                              else open(args.log_json, "a", encoding="utf-8"))
+
+    if args.command == "caption":
+        return _cmd_caption(args)
+    if args.command == "batch":
+        return _cmd_batch(args)
+    if args.command == "benchmark":
+        return _cmd_benchmark(args)
+    if args.command == "queue":
+        return _cmd_queue(args)
 
-            # Initial prompt
-            prompt_box.value = build_prompt(caption_type.value, caption_length.value, extra_options.value,
-                                            name_input.value)
+    if args.bench_batch:
+        print(json.dumps(benchmark_batching(args.bench_batch, args.batch_size), indent=2))
+        return 0
+    if args.profile_report:
+        model_tiny = args.tiny
+        print(json.dumps(profile_report(batch_size=args.batch_size), indent=2))
+        return 0
 
-            gr.Markdown(DESCRIPTION)
+    import uvicorn
+    # Load in the background so the port is up at once; /v1/ready reports when done
+    model_manager.set_idle_timeout(args.idle_unload_min * 60)
+    model_manager.start(tiny=args.tiny, warmup=not args.no_warmup)
+    get_scheduler(max_batch=args.serve_max_batch, window_ms=args.serve_window_ms,
+                  max_queue=args.serve_max_queue)
+    app = build_api()
+    if args.command == "serve":
+        uvicorn.run(app, host=args.host, port=args.port or 8000)
+        return 0
 
-import argparse, os
+    import gradio as gr
+    # The UI is served from / and the API from /v1 on the same port
+    app = gr.mount_gradio_app(app, build_ui(args.batch_size, args.prefetch), path="")
+    uvicorn.run(app, host="0.0.0.0", port=args.port or 7860)
+    return 0
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--port", type=int, default=7860,
-                    help="Gradio server port")
-args = parser.parse_args()
 
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", server_port=args.port)
+    sys.exit(main())
 
@@ -0,0 +1,50 @@
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import app2  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def tiny():
+    """app2 with the tiny random stand-in loaded on CPU and no caption cache."""
+    app2.caption_cache_mb = 0
+    app2.load_model(tiny=True)
+    return app2
+
+
+@pytest.fixture(scope="session")
+def image_dir(tmp_path_factory):
+    """A few small images of different sizes and colours."""
+    folder = tmp_path_factory.mktemp("images")
+    for n, (size, colour) in enumerate([((80, 60), "red"), ((60, 80), "green"),
+                                        ((64, 64), "blue"), ((100, 40), "white"),
+                                        ((40, 40), "black")]):
+        Image.new("RGB", size, colour).save(folder / f"{n}.png")
+    return folder
+
+
+@pytest.fixture
+def images(image_dir, tmp_path):
+    """A fresh copy of image_dir, so captions written next to it start empty."""
+    return Path(shutil.copytree(image_dir, tmp_path / "images"))
+
+
+@pytest.fixture(scope="session")
+def cli():
+    """Run ``python app2.py …`` with the tiny model; returns the CompletedProcess."""
+    def run(*args, check=True, **kwargs):
+        proc = subprocess.run([sys.executable, str(ROOT / "app2.py"), *map(str, args)],
+                              capture_output=True, text=True, timeout=600, **kwargs)
+        if check and proc.returncode:
+            raise AssertionError(f"app2.py {' '.join(map(str, args))} exited with "
+                                 f"{proc.returncode}:\n{proc.stderr[-3000:]}")
+        return proc
+    return run
@@ -0,0 +1,163 @@
+"""HTTP API on the tiny stand-in model through FastAPI's TestClient."""
+import base64
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+GREEDY = {"temperature": 0, "max_new_tokens": 8}
+
+
+def _png(colour, size=(48, 40)) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, colour).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _data_url(data: bytes) -> str:
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+@pytest.fixture
+def client(tiny, monkeypatch):
+    monkeypatch.setattr(tiny, "scheduler", None)  # a fresh one with default limits
+    return TestClient(tiny.build_api())
+
+
+def _captions(response):
+    assert response.status_code == 200, response.text
+    return [c.get("caption", c.get("error")) for c in response.json()["captions"]]
+
+
+def test_caption_multipart(tiny, client):
+    response = client.post("/v1/caption", files={"image": ("red.png", _png("red"), "image/png")},
+                           data={"caption_type": "Descriptive", "caption_length": "short",
+                                 **{k: str(v) for k, v in GREEDY.items()}})
+    assert _captions(response)[0]
+    assert response.json()["prompt"] == tiny.build_prompt("Descriptive", "short", [], "")
+
+
+def test_caption_base64_matches_multipart(client):
+    data = _png("green")
+    multipart = client.post("/v1/caption", files={"image": ("g.png", data, "image/png")},
+                            data={k: str(v) for k, v in GREEDY.items()})
+    raw = client.post("/v1/caption", json={"image": base64.b64encode(data).decode(), **GREEDY})
+    url = client.post("/v1/caption", json={"image": _data_url(data), **GREEDY})
+    assert _captions(raw) == _captions(url) == _captions(multipart)
+
+
+def test_caption_batch_keeps_order(client):
+    colours = ["red", "green", "blue", "white"]
+    singles = [_captions(client.post("/v1/caption", json={"image": _data_url(_png(c)), **GREEDY}))[0]
+               for c in colours]
+    batch = client.post("/v1/caption", json={
+        "images": [_data_url(_png(c)) for c in colours[:2]] + ["bm90IGFuIGltYWdl"]
+                  + [_data_url(_png(c)) for c in colours[2:]],
+        **GREEDY})
+    captions = batch.json()["captions"]
+    assert [c["index"] for c in captions] == [0, 1, 2, 3, 4]
+    assert "error" in captions[2]
+    assert [c["caption"] for c in captions if "caption" in c] == singles
+
+    files = [("image", (f"{c}.png", _png(c), "image/png")) for c in colours]
+    assert _captions(client.post("/v1/caption", files=files,
+                                 data={k: str(v) for k, v in GREEDY.items()})) == singles
+
+
+def test_caption_rejects_bad_requests(client):
+    assert client.post("/v1/caption", json={}).status_code == 400
+    assert client.post("/v1/caption", json={"image": _data_url(_png("red")),
+                                            "caption_type": "Nope"}).status_code == 400
+    for body in ([], "x", 3, None):
+        assert client.post("/v1/caption", json=body).status_code == 400
+
+
+def test_token_budget_is_clamped(tiny, client, monkeypatch):
+    budgets = []
+    submit = tiny.InferenceScheduler.submit
+
+    def watch(self, image, prompt, temperature, top_p, max_new_tokens, **kwargs):
+        budgets.append(max_new_tokens)
+        return submit(self, image, prompt, temperature, top_p, 1, **kwargs)
+
+    monkeypatch.setattr(tiny.InferenceScheduler, "submit", watch)
+    assert client.post("/v1/caption", json={"image": _data_url(_png("red")), "temperature": 0,
+                                            "max_new_tokens": 10**9}).status_code == 200
+    body = dict(_chat_body(stream=False), max_tokens=10**9)
+    assert client.post("/v1/chat/completions", json=body).status_code == 200
+    assert budgets == [tiny.API_MAX_NEW_TOKENS] * 2
+
+
+def _chat_body(stream: bool) -> dict:
+    return {"model": "joycaption", "stream": stream, "temperature": 0, "max_tokens": 8,
+            "messages": [{"role": "user", "content": [
+                {"type": "text", "text": "Write a short caption for this image."},
+                {"type": "image_url", "image_url": {"url": _data_url(_png("blue"))}}]}]}
+
+
+def test_chat_completions(client):
+    response = client.post("/v1/chat/completions", json=_chat_body(stream=False))
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body["object"] == "chat.completion"
+    choice = body["choices"][0]
+    assert choice["message"]["role"] == "assistant" and choice["message"]["content"]
+    assert choice["finish_reason"] in ("stop", "length")
+    usage = body["usage"]
+    assert 0 < usage["completion_tokens"] <= 8
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+
+
+def test_chat_completions_stream(client):
+    plain = client.post("/v1/chat/completions", json=_chat_body(stream=False)).json()
+    response = client.post("/v1/chat/completions", json=_chat_body(stream=True))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [line[len("data: "):] for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    assert all(c["object"] == "chat.completion.chunk" and c["id"] == chunks[0]["id"] for c in chunks)
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert chunks[-1]["choices"][0]["finish_reason"] == plain["choices"][0]["finish_reason"]
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+    assert text.strip() == plain["choices"][0]["message"]["content"]
+
+
+def test_full_queue_returns_503(tiny, monkeypatch):
+    # One slot, and a long batching window that keeps the first request queued
+    sched = tiny.InferenceScheduler(max_batch=8, window_ms=10_000, max_queue=1)
+    monkeypatch.setattr(tiny, "scheduler", sched)
+    client = TestClient(tiny.build_api())
+    waiting = sched.submit(Image.new("RGB", (48, 40), "red"), "Caption this.", 0.0, 0.9, 8)
+    try:
+        assert sched.stats()["queue_depth"] == 1
+        for response in (client.post("/v1/caption", json={"image": _data_url(_png("red")), **GREEDY}),
+                         client.post("/v1/chat/completions", json=_chat_body(stream=False))):
+            assert response.status_code == 503
+            assert response.headers["retry-after"] == "1"
+            assert response.json()["error"]["type"] == "server_busy"
+        assert sched.stats()["rejected"] == 2
+    finally:
+        waiting.cancel()
+
+
+def test_requests_queued_across_a_model_swap_are_reprepared(tiny, monkeypatch):
+    users = []
+    cached_pixels = tiny._cached_pixels
+
+    def watch(img, digest):
+        users.append(tiny.model_manager._users)
+        return cached_pixels(img, digest)
+
+    monkeypatch.setattr(tiny, "_cached_pixels", watch)
+    sched = tiny.InferenceScheduler(window_ms=500)
+    image = Image.new("RGB", (48, 40), "red")
+    before = "".join(sched.submit(image, "Caption this.", 0.0, 0.9, 8))
+    request = sched.submit(image, "Caption this.", 0.0, 0.9, 8)
+    # Another model is loaded while the request waits for its batch
+    monkeypatch.setattr(tiny.model_manager, "generation", tiny.model_manager.generation + 1)
+    assert "".join(request) == before
+    assert request.generation == tiny.model_manager.generation
+    assert len(users) == 3 and all(users)  # pixels are only ever made inside in_use()
@@ -0,0 +1,69 @@
+"""run_batch resume: what the manifest treats as already captioned (tiny stand-in model)."""
+import json
+import re
+
+import pytest
+
+ARGS = ("Descriptive", "short", [], "", 0.0, 0.9, 8)
+
+
+def _finished(tiny, folder, **kwargs):
+    *_, last = tiny.run_batch(str(folder), *ARGS, batch_size=2, **kwargs)
+    match = re.match(r"✅ Finished (\d+) images \((\d+) failed, (\d+) skipped", last)
+    assert match, last
+    return tuple(map(int, match.groups()))
+
+
+def test_rerun_skips_captioned_images(tiny, images):
+    assert _finished(tiny, images) == (5, 0, 0)
+    assert _finished(tiny, images) == (0, 0, 5)
+
+
+def test_other_load_profile_recaptions(tiny, images, monkeypatch):
+    assert _finished(tiny, images) == (5, 0, 0)
+    monkeypatch.setattr(tiny.model_manager, "profile", "int8")
+    assert _finished(tiny, images) == (5, 0, 0)
+    assert _finished(tiny, images) == (0, 0, 5)
+
+
+def test_other_settings_recaption(tiny, images):
+    assert _finished(tiny, images) == (5, 0, 0)
+    *_, last = tiny.run_batch(str(images), "Descriptive", "short", [], "", 0.0, 0.9, 12,
+                              batch_size=2)
+    assert last.startswith("✅ Finished 5 images (0 failed, 0 skipped")
+
+
+@pytest.mark.parametrize("jobs", [None, [("Straightforward", "any", [])]])
+def test_parquet_keeps_every_record_field(tiny, images, tmp_path, jobs):
+    pq = pytest.importorskip("pyarrow.parquet")
+    out = {fmt: tmp_path / fmt for fmt in ("jsonl", "parquet")}
+    for fmt, folder in out.items():
+        *_, last = tiny.run_batch(str(images), *ARGS, batch_size=2, jobs=jobs,
+                                  output_format=fmt, out_dir=folder)
+        assert last.startswith("✅ Finished 5 images (0 failed"), last
+
+    records = sorted((json.loads(line) for line in
+                      (out["jsonl"] / "captions.jsonl").read_text(encoding="utf-8").splitlines()),
+                     key=lambda r: r["path"])
+    rows = sorted(pq.read_table(next(out["parquet"].glob("captions-*.parquet"))).to_pylist(),
+                  key=lambda r: r["path"])
+    assert set(rows[0]) == set(records[0])
+    for row, record in zip(rows, records):
+        settings = json.loads(row.pop("settings"))
+        assert settings.pop("hash") != record["settings"].pop("hash")  # covers the format
+        assert settings == record.pop("settings")
+        row.pop("generate_s"), record.pop("generate_s")
+        assert row == record
+
+
+@pytest.mark.parametrize("options", [dict(batch_size=4), dict(batch_size=4, continuous=True)])
+def test_batched_captions_match_one_image_per_call(tiny, images, tmp_path, options):
+    captions = {}
+    for name, kwargs in (("single", dict(batch_size=1)), ("batched", options)):
+        *_, last = tiny.run_batch(str(images), *ARGS[:-1], 16, early_stop=False,
+                                  out_dir=tmp_path / name, **kwargs)
+        assert last.startswith("✅ Finished 5 images (0 failed"), last
+        captions[name] = {p.name: p.read_text(encoding="utf-8")
+                          for p in (tmp_path / name).glob("*.txt")}
+    assert len(captions["single"]) == 5
+    assert captions["batched"] == captions["single"]
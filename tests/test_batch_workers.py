@@ -0,0 +1,79 @@
+"""run_batch fan-out over --devices worker processes (tiny stand-in model)."""
+import ast
+import inspect
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import signal
+
+from PIL import Image
+
+GREEDY = ("--tiny", "--temperature", "0", "--max-new-tokens", "8",
+          "--caption-cache-mb", "0", "--batch-size", "2")
+
+
+def _captions(folder):
+    out = folder / "_joycaption_output"
+    return {p.name: p.read_text(encoding="utf-8") for p in sorted(out.glob("*.txt"))}
+
+
+def test_cpu_workers_match_in_process(images, tmp_path, cli):
+    fanned = shutil.copytree(images, tmp_path / "fanned")
+    cli("batch", images, *GREEDY)
+    proc = cli("batch", fanned, *GREEDY, "--devices", "cpu*2")
+
+    assert proc.stderr.count("✅ Loaded") == 2  # one model copy per worker
+    assert "Finished 5 images (0 failed" in proc.stderr
+    expected = _captions(images)
+    assert len(expected) == 5
+    assert _captions(fanned) == expected
+
+
+def test_rerun_skips_worker_output(images, cli):
+    cli("batch", images, *GREEDY, "--devices", "cpu*2")
+    proc = cli("batch", images, *GREEDY, "--devices", "cpu*2")
+    assert "Finished 0 images (0 failed, 5 skipped" in proc.stderr
+
+
+def test_killed_worker_chunks_fail_instead_of_vanishing(tiny, tmp_path):
+    for n in range(12):
+        Image.new("RGB", (40 + 4 * n, 40), (20 * n, 0, 0)).save(tmp_path / f"{n:02d}.png")
+    args = (str(tmp_path), "Descriptive", "short", [], "", 0.0, 0.9, 8)
+
+    messages = []
+    for message in tiny.run_batch(*args, batch_size=1, prefetch=2, devices="cpu*2"):
+        if not messages:
+            # The worker behind the first result already holds its prefetched chunks
+            worker = re.search(r"\| (cpu#\d) 1", message).group(1)
+            victim, = [p for p in multiprocessing.active_children()
+                       if p.name == f"joycaption-{worker}"]
+            os.kill(victim.pid, signal.SIGKILL)
+        messages.append(message)
+
+    finished = re.match(r"✅ Finished (\d+) images \((\d+) failed", messages[-1])
+    assert finished, messages[-1]
+    images, failed = map(int, finished.groups())
+    assert images == 12 and failed > 0
+    out = tmp_path / "_joycaption_output"
+    assert len(list(out.glob("*.txt"))) == 12 - failed
+
+    # The failed images are retried by the next run; nothing else is redone
+    *_, last = tiny.run_batch(*args, batch_size=4)
+    assert last.startswith(f"✅ Finished {failed} images (0 failed, {12 - failed} skipped")
+    assert len(list(out.glob("*.txt"))) == 12
+
+
+def test_workers_get_every_runtime_setting(tiny, monkeypatch):
+    # Everything main() sets from the command line must reach the workers
+    main = next(node for node in ast.parse(inspect.getsource(tiny)).body
+                if isinstance(node, ast.FunctionDef) and node.name == "main")
+    assigned = {name for node in ast.walk(main) if isinstance(node, ast.Global)
+                for name in node.names}
+    assert assigned <= set(tiny.RUNTIME_SETTINGS)
+
+    monkeypatch.setattr(tiny, "gpu_memory_gb", 3.5)
+    monkeypatch.setattr(tiny, "speculative_draft", 4)
+    config = pickle.loads(pickle.dumps(tiny._runtime_config()))
+    assert config["gpu_memory_gb"] == 3.5 and config["speculative_draft"] == 4
@@ -0,0 +1,64 @@
+"""Benchmark helpers on the tiny stand-in model."""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def config_watch(tiny, monkeypatch):
+    """min_new_tokens of the shared generation config at every generate() call."""
+    seen = []
+    generate = tiny.model.generate
+
+    def watch(*args, **kwargs):
+        seen.append(tiny.model.generation_config.min_new_tokens)
+        return generate(*args, **kwargs)
+
+    monkeypatch.setattr(tiny.model, "generate", watch)
+    return seen
+
+
+def test_fixed_length_is_per_call(tiny, config_watch):
+    tiny.benchmark_batching(4, 2, max_new_tokens=6)
+    tiny.profile_report(n_images=2, batch_size=2, max_new_tokens=6)
+    tiny.run_benchmark(sizes=(64,), batch_sizes=(2,), caption_types=("Descriptive",),
+                       max_new_tokens=(6,), n_images=2, ttft_runs=2, speculative=3)
+    assert config_watch and set(config_watch) == {None}
+
+
+def test_batching_benchmark(tiny):
+    result = tiny.benchmark_batching(6, 3, max_new_tokens=6)
+    assert result["prefix_cache_matches_greedy"]
+    assert result["per_image_img_per_s"] > 0 and result["batched_img_per_s"] > 0
+    assert result["speedup"] == pytest.approx(result["batched_img_per_s"]
+                                              / result["per_image_img_per_s"])
+
+
+def test_cpu_benchmark(tiny, monkeypatch):
+    monkeypatch.setattr(tiny, "caption_cache_mb", 64)
+    lines = []
+    report = tiny.run_benchmark(sizes=(64,), batch_sizes=(1, 2),
+                                caption_types=("Descriptive", "Straightforward"),
+                                max_new_tokens=(4,), n_images=2, ttft_runs=2, log=lines.append)
+    assert tiny.caption_cache_mb == 64  # only bypassed while running
+    rows = report["results"]
+    assert [(r["batch_size"], r["caption_type"]) for r in rows] == [
+        (1, "Descriptive"), (2, "Descriptive"), (1, "Straightforward"), (2, "Straightforward")]
+    assert len(lines) == len(rows)
+    for r in rows:
+        assert r["images_per_s"] > 0 and r["tokens_per_s"] == pytest.approx(4 * r["images_per_s"])
+        assert r["ttft_first_ms"] > 0 and r["ttft_repeat_ms"] > 0
+        assert r["cpu_peak_rss_mb"] > 0 and "gpu_peak_mb" not in r
+    assert report["meta"]["model"] == tiny.model_id()
+    assert "speculative" not in report and "decode" not in report
+    assert all("+0.0%" in line for line in tiny.compare_benchmarks(report, report)[1:])
+
+
+def test_benchmark_cli(tmp_path, cli):
+    out = tmp_path / "bench.json"
+    args = ("benchmark", "--tiny", "--sizes", "64", "--batch-sizes", "2", "--caption-types",
+            "Descriptive", "--max-new-tokens", "4", "--images", "2", "--decode-mp", "0")
+    cli(*args, "--output", out)
+    assert len(json.loads(out.read_text())["results"]) == 1
+    proc = cli(*args, "--output", tmp_path / "again.json", "--compare", out)
+    assert "bs=2 'Descriptive' 4 tok: img/s" in proc.stderr
@@ -0,0 +1,147 @@
+"""load_image: decoder choice, orientation, transparency and frames (tiny stand-in model)."""
+import io
+
+import pytest
+from PIL import Image, ImageOps
+
+
+def _jpeg(size=(80, 60), colour="red") -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, colour).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def _halves(size=(80, 60), mode="RGB", left="red", right="blue") -> Image.Image:
+    """Two-colour image, so flips and rotations are visible."""
+    img = Image.new(mode, size, left)
+    img.paste(Image.new(mode, (size[0] // 2, size[1]), right), (size[0] // 2, 0))
+    return img
+
+
+@pytest.fixture
+def pil(tiny, monkeypatch):
+    """Plain Pillow decoding at full size (no resize to the vision input)."""
+    monkeypatch.setattr(tiny, "image_backend", "pil")
+    monkeypatch.setattr(tiny, "fast_decode", False)
+    return tiny
+
+
+@pytest.fixture
+def fake_turbojpeg(tiny, monkeypatch):
+    """A stand-in PyTurboJPEG that records which sources were sent to it."""
+    decoded = []
+
+    def decode(data, img, target):
+        decoded.append(data)
+        return Image.open(io.BytesIO(data)).convert("RGB")
+
+    monkeypatch.setattr(tiny, "_get_turbojpeg", lambda: object())
+    monkeypatch.setattr(tiny, "_decode_turbojpeg", decode)
+    monkeypatch.setattr(tiny, "image_backend", "auto")
+    return decoded
+
+
+@pytest.mark.parametrize("backend", ["auto", "turbojpeg"])
+def test_decoded_jpeg_image_skips_turbojpeg(tiny, fake_turbojpeg, monkeypatch, backend):
+    monkeypatch.setattr(tiny, "image_backend", backend)
+    img = Image.open(io.BytesIO(_jpeg()))
+    assert img.format == "JPEG"
+    out = tiny.load_image(img)
+    assert out.mode == "RGB" and out.size == (32, 32)
+    assert fake_turbojpeg == []
+
+
+def test_jpeg_bytes_and_files_use_turbojpeg(tiny, fake_turbojpeg, tmp_path):
+    data = _jpeg()
+    (tmp_path / "a.jpg").write_bytes(data)
+    assert tiny.load_image(data).size == (32, 32)
+    assert tiny.load_image(tmp_path / "a.jpg").size == (32, 32)
+    assert fake_turbojpeg == [data, data]
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_exif_orientation(pil, orientation):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    _halves().save(buf, format="JPEG", exif=exif)
+    expected = ImageOps.exif_transpose(Image.open(io.BytesIO(buf.getvalue())))
+    out = pil.load_image(buf.getvalue())
+    assert out.size == expected.size == ((60, 80) if orientation >= 5 else (80, 60))
+    assert out.tobytes() == expected.convert("RGB").tobytes()
+
+
+def test_rotated_jpeg_is_resized_to_its_upright_shape(tiny, monkeypatch):
+    # A shortest-edge processor keeps the aspect ratio, so the target depends on rotation
+    monkeypatch.setattr(tiny.processor.image_processor, "size", {"shortest_edge": 30})
+    monkeypatch.setattr(tiny, "image_backend", "pil")
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buf = io.BytesIO()
+    _halves((800, 600)).save(buf, format="JPEG", exif=exif)
+    assert tiny.load_image(buf.getvalue()).size == (30, 40)
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "LA", "P"])
+def test_transparency_is_composited_over_white(pil, mode):
+    img = Image.new("RGBA", (40, 40), (0, 0, 0, 0))
+    img.paste((0, 0, 0, 255), (0, 0, 20, 40))
+    if mode == "LA":
+        img = img.convert("LA")
+    elif mode == "P":
+        img = Image.new("P", (40, 40), 1)
+        img.putpalette([0, 0, 0, 0, 255, 0])
+        img.paste(0, (0, 0, 20, 40))
+        img.info["transparency"] = 1
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    out = pil.load_image(buf.getvalue())
+    assert out.mode == "RGB"
+    assert out.getpixel((5, 5)) == (0, 0, 0)
+    assert out.getpixel((35, 5)) == pil.ALPHA_BACKGROUND
+
+
+def test_half_transparent_pixels_blend_with_white(pil):
+    buf = io.BytesIO()
+    Image.new("RGBA", (8, 8), (255, 0, 0, 128)).save(buf, format="PNG")
+    r, g, b = pil.load_image(buf.getvalue()).getpixel((0, 0))
+    assert r == 255 and abs(g - 127) <= 1 and g == b
+
+
+@pytest.mark.parametrize("frame,expected", [("largest", ((90, 90), "blue")),
+                                            ("first", ((40, 30), "red")),
+                                            ("middle", ((60, 50), "green"))])
+def test_frame_selection(pil, tmp_path, monkeypatch, frame, expected):
+    monkeypatch.setattr(pil, "image_frame", frame)
+    frames = [Image.new("RGB", size, colour) for size, colour in
+              [((40, 30), "red"), ((90, 90), "blue"), ((60, 50), "green"), ((20, 20), "white")]]
+    frames[0].save(tmp_path / "pages.tiff", save_all=True, append_images=frames[1:])
+    out = pil.load_image(tmp_path / "pages.tiff")
+    size, colour = expected
+    assert out.size == size
+    assert out.getpixel((0, 0)) == Image.new("RGB", (1, 1), colour).getpixel((0, 0))
+
+
+def test_large_jpeg_is_decoded_at_reduced_scale(tiny, monkeypatch):
+    from PIL import JpegImagePlugin
+
+    monkeypatch.setattr(tiny, "image_backend", "pil")
+    decoded = []
+    draft = JpegImagePlugin.JpegImageFile.draft
+
+    def watch(self, mode, size):
+        result = draft(self, mode, size)
+        decoded.append(self.size)
+        return result
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", watch)
+    data = _jpeg((1024, 768))
+    out = tiny.load_image(data)
+    assert out.size == (32, 32)
+    # Smallest DCT scale (1/8) still covering the 32x32 vision input
+    assert decoded == [(128, 96)]
+
+    monkeypatch.setattr(tiny, "fast_decode", False)
+    full = tiny.load_image(data)
+    assert full.size == (1024, 768)
+    assert out.getpixel((16, 16)) == full.resize((32, 32)).getpixel((16, 16))
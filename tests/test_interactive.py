@@ -0,0 +1,63 @@
+"""Single-image (Caption tab) path: streaming and preprocessed-pixel reuse (tiny stand-in model)."""
+import io
+import json
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def preprocessed(tiny, monkeypatch):
+    """Images that went through the image processor, and an empty pixel cache."""
+    seen = []
+    preprocess = tiny._preprocess_images
+
+    def watch(imgs):
+        seen.extend(imgs)
+        return preprocess(imgs)
+
+    monkeypatch.setattr(tiny, "_preprocess_images", watch)
+    tiny._pixel_cache.clear()
+    return seen
+
+
+def _caption(app2, image, prompt="Write a short caption for this image."):
+    *_, last = app2.chat_joycaption(image, prompt, 0.0, 0.9, 12)
+    return last
+
+
+def test_streams_growing_text_and_logs_ttft(tiny, preprocessed, monkeypatch):
+    log = io.StringIO()
+    monkeypatch.setattr(tiny.metrics, "log_stream", log)
+    chunks = list(tiny.chat_joycaption(Image.new("RGB", (80, 60), "red"),
+                                       "Write a short caption for this image.", 0.0, 0.9, 12))
+    assert chunks[-1]
+    assert all(b.startswith(a) for a, b in zip(chunks, chunks[1:]))
+    event = json.loads(log.getvalue().splitlines()[-1])
+    assert event["event"] == "caption" and event["source"] == "chat"
+    assert 0 < event["ttft_ms"] <= event["total_ms"]
+    assert event["completion_tokens"] <= 12
+
+
+def test_repeat_image_reuses_pixels(tiny, preprocessed):
+    image = Image.new("RGB", (80, 60), "red")
+    first = _caption(tiny, image)
+    other_prompt = _caption(tiny, image.copy(), "Describe this image.")
+    assert _caption(tiny, image.copy()) == first
+    assert len(preprocessed) == 1  # same pixels: preprocessed once
+    tiny._pixel_cache.clear()
+    assert _caption(tiny, image) == first
+    assert _caption(tiny, image, "Describe this image.") == other_prompt
+    assert len(preprocessed) == 2
+
+
+def test_pixel_cache_keeps_recent_images(tiny, preprocessed):
+    colours = [(16 * n, 0, 0) for n in range(9)]
+    for colour in colours:
+        _caption(tiny, Image.new("RGB", (40, 40), colour))
+    _caption(tiny, Image.new("RGB", (40, 40), colours[-1]))
+    assert len(preprocessed) == 9
+    _caption(tiny, Image.new("RGB", (40, 40), colours[0]))  # evicted by the 9th
+    assert len(preprocessed) == 10
+    pixels = tiny._pixel_cache.get(tiny.image_digest(Image.new("RGB", (40, 40), colours[-1])))
+    assert pixels.device == tiny.model.device and pixels.dtype == tiny.model.dtype
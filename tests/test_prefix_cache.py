@@ -0,0 +1,64 @@
+"""Shared-prefix KV reuse must not change greedy output (tiny stand-in model)."""
+import torch
+from PIL import Image
+
+
+def _images(n):
+    colours = ["red", "green", "blue", "white", "black", "yellow"]
+    return [Image.new("RGB", (64 + 8 * i, 48), colours[i % len(colours)]) for i in range(n)]
+
+
+def _shares_prefix(app2, inputs):
+    with torch.no_grad():  # as in _generate_batch: the prefix KV is cached
+        return app2._with_prefix_cache(inputs) is not None
+
+
+def _both(app2, inputs, max_new_tokens, **kwargs):
+    cached = app2._generate_batch(inputs, 0.0, 0.9, max_new_tokens, prefix_cache=True, **kwargs)
+    plain = app2._generate_batch(inputs, 0.0, 0.9, max_new_tokens, prefix_cache=False, **kwargs)
+    return cached, plain
+
+
+def test_identical_prompts(tiny):
+    app2 = tiny
+    prompt = app2.build_prompt("Descriptive", "long", [], "")
+    inputs = app2._encode_batch([prompt] * 4, app2._preprocess_images(_images(4)))
+    assert _shares_prefix(app2, inputs)
+    cached, plain = _both(app2, inputs, 8, min_new_tokens=8)
+    assert cached == plain
+
+
+def test_mixed_prompts_move_padding(tiny):
+    app2 = tiny
+    prompts = [app2.build_prompt("Descriptive", "long", [], ""),
+               app2.build_prompt("Booru-like tag list", "any", [], ""),
+               app2.build_prompt("Descriptive", "40", [app2.EXTRA_OPTIONS[0]], "Alice"),
+               app2.build_prompt("Straightforward", "short", [], "")]
+    inputs = app2._encode_batch(prompts, app2._preprocess_images(_images(4)))
+    assert len(set(inputs["attention_mask"].sum(dim=1).tolist())) > 1  # rows are padded
+    assert _shares_prefix(app2, inputs)
+    cached, plain = _both(app2, inputs, 8, min_new_tokens=8)
+    assert cached == plain
+
+
+def test_rows_stopping_at_eos(tiny, monkeypatch):
+    app2 = tiny
+    assert app2.model.generation_config.min_new_tokens is None
+    prompts = [app2.build_prompt("Descriptive", "long", [], ""),
+               app2.build_prompt("Booru-like tag list", "any", [], "")] * 2
+    inputs = app2._encode_batch(prompts, app2._preprocess_images(_images(4)))
+    # The random model never picks its real EOS: make a token row 0 emits
+    # part-way through the EOS, so rows end at different steps.
+    width = inputs["input_ids"].shape[1]
+    with torch.no_grad():
+        tokens = app2.model.generate(**inputs, max_new_tokens=16, do_sample=False,
+                                     pad_token_id=app2.processor.tokenizer.pad_token_id)
+    monkeypatch.setattr(app2.model.generation_config, "eos_token_id", int(tokens[0, width + 5]))
+
+    cached_stats, plain_stats = [], []
+    cached = app2._generate_batch(inputs, 0.0, 0.9, 16, prefix_cache=True, row_stats=cached_stats)
+    plain = app2._generate_batch(inputs, 0.0, 0.9, 16, prefix_cache=False, row_stats=plain_stats)
+    assert cached == plain
+    assert cached_stats == plain_stats
+    assert cached_stats[0]["finish_reason"] == "stop"
+    assert cached_stats[0]["completion_tokens"] < 16
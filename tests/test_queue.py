@@ -0,0 +1,96 @@
+"""File-based work queue: create / work / status across processes (tiny stand-in model)."""
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+APP = Path(__file__).resolve().parents[1] / "app2.py"
+SETTINGS = ("--tiny", "--temperature", "0", "--max-new-tokens", "8")
+WORKER = ("--caption-cache-mb", "0", "--batch-size", "2", "--heartbeat", "1")
+
+
+def _status(cli, queue_dir, *args):
+    return json.loads(cli("queue", "status", queue_dir, *args).stdout)
+
+
+def _captions(folder):
+    return {p.name: p.read_text(encoding="utf-8") for p in sorted(Path(folder).glob("*.txt"))}
+
+
+def test_create_and_status(images, tmp_path, cli):
+    queue_dir = tmp_path / "queue"
+    cli("queue", "create", queue_dir, images, *SETTINGS, "--shard-size", "2")
+
+    job = json.loads((queue_dir / "job.json").read_text())
+    assert job["tiny"] is True and job["max_new_tokens"] == 8
+    assert (job["n_shards"], job["n_images"]) == (3, 5)
+    listed = [line for shard in sorted((queue_dir / "todo").glob("*.txt"))
+              for line in shard.read_text().splitlines()]
+    assert sorted(listed) == sorted(p.name for p in images.glob("*.png"))
+
+    report = _status(cli, queue_dir)
+    assert report["shards"] == {"todo": 3, "claimed": 0, "done": 0, "failed": 0, "total": 3}
+    assert (report["images"], report["images_done"], report["workers_alive"]) == (5, 0, 0)
+
+
+def test_two_workers_share_the_queue(images, tmp_path, cli):
+    queue_dir = tmp_path / "queue"
+    cli("queue", "create", queue_dir, images, *SETTINGS, "--shard-size", "1")
+    workers = [subprocess.Popen([sys.executable, str(APP), "queue", "work", str(queue_dir), *WORKER],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+               for _ in range(2)]
+    for proc in workers:
+        _, err = proc.communicate(timeout=600)
+        assert proc.returncode == 0, err[-3000:]
+
+    done = sorted((queue_dir / "done").glob("*.json"))
+    assert [p.stem for p in done] == [f"{n:05d}" for n in range(5)]  # each shard exactly once
+    assert not list((queue_dir / "claimed").iterdir())
+    report = _status(cli, queue_dir)
+    assert report["shards"] == {"todo": 0, "claimed": 0, "done": 5, "failed": 0, "total": 5}
+    assert (report["images_done"], report["images_failed"]) == (5, 0)
+    assert len(report["workers"]) == 2
+
+    cli("batch", images, *SETTINGS, "--caption-cache-mb", "0")
+    expected = _captions(images / "_joycaption_output")
+    assert len(expected) == 5
+    assert _captions(queue_dir / "output") == expected
+
+
+def test_stale_claim_is_requeued(images, tmp_path, cli):
+    queue_dir = tmp_path / "queue"
+    cli("queue", "create", queue_dir, images, *SETTINGS, "--shard-size", "2")
+    # A worker that died holding shard 00001: its claim stopped being touched
+    claim = queue_dir / "claimed" / "00001.deadnode-1.txt"
+    os.rename(queue_dir / "todo" / "00001.txt", claim)
+    old = time.time() - 3600
+    os.utime(claim, (old, old))
+
+    report = _status(cli, queue_dir)
+    assert report["shards"]["claimed"] == 1
+    assert report["images_in_progress"] == 0  # no live worker holds it
+
+    proc = cli("queue", "work", queue_dir, *WORKER, "--stale", "60")
+    assert "Re-queued stale shards 00001" in proc.stderr
+    report = _status(cli, queue_dir)
+    assert report["shards"] == {"todo": 0, "claimed": 0, "done": 3, "failed": 0, "total": 3}
+    assert report["images_done"] == 5
+    assert len(_captions(queue_dir / "output")) == 5
+
+
+def test_fresh_claim_is_left_alone(images, tmp_path, cli):
+    queue_dir = tmp_path / "queue"
+    cli("queue", "create", queue_dir, images, *SETTINGS, "--shard-size", "2")
+    claim = queue_dir / "claimed" / "00001.busynode-1.txt"
+    os.rename(queue_dir / "todo" / "00001.txt", claim)
+    os.utime(claim)
+
+    # The worker would wait for the live claim; stop once the rest is done
+    proc = cli("queue", "work", queue_dir, *WORKER, "--stale", "600", "--max-shards", "2")
+    assert "Re-queued" not in proc.stderr
+    assert claim.exists()
+    report = _status(cli, queue_dir)
+    assert report["shards"] == {"todo": 0, "claimed": 1, "done": 2, "failed": 0, "total": 3}
+    assert report["images_done"] == 3
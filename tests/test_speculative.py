@@ -0,0 +1,59 @@
+"""Prompt-lookup speculative decoding must reproduce greedy output (tiny stand-in model)."""
+import pytest
+import torch
+from PIL import Image
+
+PROMPTS = [("Descriptive", "long"), ("Booru-like tag list", "any"), ("Straightforward", "short")]
+
+
+def _inputs(app2, caption_type, length, colour):
+    prompt = app2.build_prompt(caption_type, length, [], "")
+    return app2._encode_batch([prompt], app2._preprocess_images([Image.new("RGB", (64, 48), colour)]))
+
+
+@pytest.mark.parametrize("n_draft", [1, 3, 8])
+@pytest.mark.parametrize("caption_type,length", PROMPTS)
+def test_greedy_matches_generate_batch(tiny, caption_type, length, n_draft):
+    for colour in ("red", "blue"):
+        inputs = _inputs(tiny, caption_type, length, colour)
+        stats = {}
+        fast = tiny._generate_speculative(inputs, 0.0, 0.9, 24, n_draft, stats=stats,
+                                          min_new_tokens=24)
+        assert fast == tiny._generate_batch(inputs, 0.0, 0.9, 24, min_new_tokens=24)[0]
+        assert stats["completion_tokens"] == 24 and stats["finish_reason"] == "length"
+        assert 0 <= stats["accepted"] <= stats["drafted"]
+        assert stats["forwards"] <= 24
+
+
+def test_greedy_matches_at_eos(tiny, monkeypatch):
+    inputs = _inputs(tiny, "Descriptive", "long", "green")
+    width = inputs["input_ids"].shape[1]
+    with torch.no_grad():
+        tokens = tiny.model.generate(**inputs, max_new_tokens=16, do_sample=False,
+                                     pad_token_id=tiny.processor.tokenizer.pad_token_id)
+    # The random model never picks its real EOS: make it a token emitted part-way
+    monkeypatch.setattr(tiny.model.generation_config, "eos_token_id", int(tokens[0, width + 5]))
+    stats = {}
+    fast = tiny._generate_speculative(inputs, 0.0, 0.9, 16, 4, stats=stats)
+    assert fast == tiny._generate_batch(inputs, 0.0, 0.9, 16)[0]
+    assert stats["finish_reason"] == "stop" and stats["completion_tokens"] < 16
+
+
+def test_caller_can_stop(tiny):
+    seen, stats = [], {}
+    tiny._generate_speculative(_inputs(tiny, "Descriptive", "long", "red"), 0.0, 0.9, 24, 4,
+                               on_token=lambda tok: seen.append(tok) or len(seen) == 5,
+                               stats=stats, min_new_tokens=24)
+    assert len(seen) == 5 and stats["finish_reason"] == "caller"
+
+
+def test_lone_scheduler_request_uses_it(tiny, monkeypatch):
+    image = Image.new("RGB", (64, 48), "white")
+    plain = "".join(tiny.InferenceScheduler().submit(image, "Caption this.", 0.0, 0.9, 16))
+    calls = []
+    speculative = tiny._generate_speculative
+    monkeypatch.setattr(tiny, "_generate_speculative",
+                        lambda *args, **kwargs: calls.append(args) or speculative(*args, **kwargs))
+    monkeypatch.setattr(tiny, "speculative_draft", 4)
+    assert "".join(tiny.InferenceScheduler().submit(image, "Caption this.", 0.0, 0.9, 16)) == plain
+    assert calls